@@ -0,0 +1,200 @@
+"""
+Standalone benchmark of the DBInitOperator and StructureMonitoringOperator stages, Airflow is not needed.
+
+A synthetic tree is generated in a temporary directory and loaded into a temporary SQLite database,
+then the churn is applied and the monitoring stages are run against it. Every stage reports its wall time,
+peak RSS and the amount of SQL statements. Results are saved as a JSON baseline, the next run compared
+with the baseline fails on the regression.
+
+    python -m benchmarks.run_benchmarks --depth 4 --fanout 5 --files 20 --churn 0.05 \
+        --output benchmarks/baseline.json --compare benchmarks/baseline.json
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import resource
+import tempfile
+import threading
+from datetime import datetime
+from contextlib import contextmanager
+from typing import Dict
+
+from sqlalchemy import event
+
+from benchmarks.synthetic_tree import generate_tree, apply_churn
+from custom_operator.instrumentation import RunMetrics, collecting
+from custom_operator.database_initialization import configure_database, get_engine, dispose_engine
+from custom_operator.filesystem_parser import scan_struct
+from custom_operator.tree_snapshot import TreeSnapshot
+from custom_operator.db_init import model_creation, bulk_initial_load
+from custom_operator.structure_monitoring import struct_changes_discovery, changes_prepare, changes_write
+
+# interval of the RSS sampling during a stage, seconds
+RSS_SAMPLE_INTERVAL = 0.005
+# relative slowdown of a stage against the baseline treated as the regression
+DEFAULT_TOLERANCE = 0.25
+
+
+def current_rss():
+    """
+    :return: resident set size of the process in bytes
+    """
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        # not Linux, fall back to the peak of the whole process (kilobytes on Linux, bytes on macOS)
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return max_rss if sys.platform == "darwin" else max_rss * 1024
+
+
+class StageRecorder:
+    """
+    Collects wall time, peak RSS and SQL statement count of the benchmark stages
+    """
+    def __init__(self):
+        self.stages: Dict = {}
+        self.statement_count = 0
+        event.listen(get_engine(), "before_cursor_execute", self.count_statement)
+
+    def count_statement(self, conn, cursor, statement, parameters, context, executemany):
+        self.statement_count += 1
+
+    @contextmanager
+    def stage(self, name):
+        peak_rss = [current_rss()]
+        sampling = threading.Event()
+
+        def sample_rss():
+            while not sampling.wait(RSS_SAMPLE_INTERVAL):
+                peak_rss[0] = max(peak_rss[0], current_rss())
+
+        sampler = threading.Thread(target=sample_rss, daemon=True)
+        sampler.start()
+        statements_before = self.statement_count
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            sampling.set()
+            sampler.join()
+            peak_rss[0] = max(peak_rss[0], current_rss())
+            self.stages[name] = {"seconds": round(seconds, 4),
+                                 "peak_rss_mb": round(peak_rss[0] / 1024 / 1024, 1),
+                                 "sql_statements": self.statement_count - statements_before}
+            print(f"{name}: {self.stages[name]}")
+
+
+def run_benchmark(work_dir, depth, fanout, files_per_dir, churn_rate, seed=0):
+    """
+    Run all stages against the synthetic tree and the SQLite database in the working directory
+    :return: dictionary of the benchmark parameters, tree size and stage results
+    """
+    root_folder = os.path.join(work_dir, "root_folder")
+    tree_size = generate_tree(root_folder, depth, fanout, files_per_dir, seed=seed)
+    configure_database(url=f"sqlite:///{os.path.join(work_dir, 'benchmark.db')}")
+    recorder = StageRecorder()
+    metrics = RunMetrics("benchmark")
+    with collecting(metrics):
+        churn, detected = run_stages(recorder, root_folder, churn_rate, seed)
+
+    dispose_engine()
+    return {"params": {"depth": depth, "fanout": fanout, "files_per_dir": files_per_dir,
+                       "churn_rate": churn_rate, "seed": seed},
+            "tree": tree_size,
+            "churn": churn,
+            "detected": detected,
+            "counters": metrics.counters,
+            "stages": recorder.stages}
+
+
+def run_stages(recorder, root_folder, churn_rate, seed):
+    """
+    Load the tree, apply the churn and detect it, every stage is recorded by the recorder
+    :return: tuple of the churn summary of apply_churn and the amounts of the detected changes
+    """
+    with recorder.stage("walk"):
+        records = list(scan_struct(root_folder))
+    with recorder.stage("tree_build"):
+        TreeSnapshot.from_records(records)
+    del records
+    with recorder.stage("load"):
+        model_creation()
+        bulk_initial_load(root_folder)
+
+    churn = apply_churn(root_folder, churn_rate, seed=seed)
+
+    with recorder.stage("diff"):
+        added_frame, modified_frame, deleted_frame = struct_changes_discovery(root_folder=root_folder)
+    with recorder.stage("versioning"):
+        cur_date = datetime.now()
+        write_batch = changes_prepare(added_frame, modified_frame, deleted_frame, cur_date)
+    # the change set is written in one transaction, the same as by the monitoring operator
+    with recorder.stage("apply"):
+        changes_write(write_batch, cur_date)
+    return churn, {"added": int(added_frame.shape[0]), "modified": int(modified_frame.shape[0]),
+                   "deleted": int(deleted_frame.shape[0])}
+
+
+def compare_with_baseline(result, baseline, tolerance):
+    """
+    :return: list of the regression descriptions, empty if there is none
+    """
+    regressions = []
+    if baseline.get("params") != result["params"]:
+        print("Baseline was recorded with other parameters, comparison skipped")
+        return regressions
+    for stage_name, stage in result["stages"].items():
+        base_stage = baseline["stages"].get(stage_name)
+        if base_stage is None:
+            continue
+        if stage["seconds"] > base_stage["seconds"] * (1 + tolerance):
+            regressions.append(f"{stage_name}: {stage['seconds']}s against {base_stage['seconds']}s")
+        if stage["sql_statements"] > base_stage["sql_statements"]:
+            regressions.append(f"{stage_name}: {stage['sql_statements']} SQL statements "
+                               f"against {base_stage['sql_statements']}")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark of the operator stages on a synthetic tree")
+    parser.add_argument("--depth", type=int, default=3)
+    parser.add_argument("--fanout", type=int, default=4)
+    parser.add_argument("--files", type=int, default=10, help="files per directory")
+    parser.add_argument("--churn", type=float, default=0.05, help="share of the changed files")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="file to save the results as the JSON baseline")
+    parser.add_argument("--compare", help="JSON baseline to compare the results with")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE)
+    args = parser.parse_args(argv)
+
+    baseline = None
+    if args.compare and os.path.isfile(args.compare):
+        with open(args.compare, "r") as f:
+            baseline = json.load(f)
+
+    work_dir = tempfile.mkdtemp(prefix="dwh_ex_bench_")
+    try:
+        result = run_benchmark(work_dir, args.depth, args.fanout, args.files, args.churn, args.seed)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    print(json.dumps(result, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(result, f, indent=2)
+
+    if baseline is not None:
+        regressions = compare_with_baseline(result, baseline, args.tolerance)
+        for regression in regressions:
+            print(f"Regression: {regression}")
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,75 @@
+import os
+import random
+from typing import List, Dict
+
+
+def generate_tree(root_dir, depth, fanout, files_per_dir, file_size=64, seed=0):
+    """
+    Generate a synthetic directory tree: every directory down to the given depth has
+    the same amount of subdirectories and files
+    :param root_dir: full name of the root directory, created if missing
+    :param depth: amount of directory levels below the root
+    :param fanout: amount of subdirectories of every directory above the last level
+    :param files_per_dir: amount of files in every directory
+    :param file_size: size of every file in bytes
+    :param seed: seed of the random content
+    :return: dictionary with the amount of generated directories and files
+    """
+    rnd = random.Random(seed)
+    dir_count = 0
+    file_count = 0
+    level_dirs: List = [root_dir]
+    os.makedirs(root_dir, exist_ok=True)
+    for level in range(depth + 1):
+        next_level_dirs: List = []
+        for cur_dir in level_dirs:
+            for file_no in range(files_per_dir):
+                with open(os.path.join(cur_dir, f"file_{file_no}.dat"), "wb") as f:
+                    f.write(rnd.randbytes(file_size))
+                file_count += 1
+            if level == depth:
+                continue
+            for dir_no in range(fanout):
+                sub_dir = os.path.join(cur_dir, f"dir_{dir_no}")
+                os.mkdir(sub_dir)
+                next_level_dirs.append(sub_dir)
+                dir_count += 1
+        level_dirs = next_level_dirs
+    return {"dirs": dir_count, "files": file_count}
+
+
+def apply_churn(root_dir, churn_rate, seed=0):
+    """
+    Modify, delete and add the share of the files of the tree, every kind of change gets
+    a third of the churn rate
+    :param root_dir: full name of the root directory
+    :param churn_rate: share of the files to change, 0..1
+    :param seed: seed of the choice of the files
+    :return: dictionary with the amount of modified, deleted and added files
+    """
+    rnd = random.Random(seed)
+    files: List = []
+    for cur_dir, dir_names, file_names in os.walk(root_dir):
+        files.extend(os.path.join(cur_dir, file_name) for file_name in file_names)
+    files.sort()
+    rnd.shuffle(files)
+
+    change_count = int(len(files) * churn_rate / 3)
+    to_modify = files[:change_count]
+    to_delete = files[change_count:2 * change_count]
+    to_add_near = files[2 * change_count:3 * change_count]
+
+    for file_name in to_modify:
+        with open(file_name, "ab") as f:
+            f.write(b"churn")
+        stat_result = os.stat(file_name)
+        # make sure the mtime moves even on the coarse timestamp filesystems
+        os.utime(file_name, ns=(stat_result.st_atime_ns, stat_result.st_mtime_ns + 1_000_000_000))
+    for file_name in to_delete:
+        os.remove(file_name)
+    for file_name in to_add_near:
+        with open(file_name + ".new", "wb") as f:
+            f.write(rnd.randbytes(64))
+
+    changes: Dict = {"modified": len(to_modify), "deleted": len(to_delete), "added": len(to_add_near)}
+    return changes
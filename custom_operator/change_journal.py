@@ -0,0 +1,350 @@
+"""
+Change journal fed by inotify, so the monitoring runs compare only the changed parts of the tree.
+
+The watcher is a separate long running process (Linux only):
+
+    python -m custom_operator.change_journal /opt/airflow/root_folder
+
+It watches every directory of the tree, coalesces the events and appends them to DBChangeJournal.
+A consumer reads the journal from its last offset; queue overflow, lost watches and the restarts
+of the watcher are journaled as well, the consumer falls back to the full scan after them.
+"""
+import os
+import sys
+import time
+import errno
+import select
+import struct
+import ctypes
+import ctypes.util
+import pandas
+from datetime import datetime, timedelta
+from typing import List, Dict
+
+from sqlalchemy import select as sql_select, insert, delete, func
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from custom_operator.core_objects import DBChangeJournal, DBJournalState
+from custom_operator.database_initialization import get_engine
+from custom_operator.db_init import model_creation
+from custom_operator.filesystem_parser import HOME_FOLDER, is_excluded
+from custom_operator.structure_monitoring import changes_apply
+from custom_operator.sharding import subtrees_changes_discovery
+from custom_operator.instrumentation import incr
+
+# entry: the entry itself changed; subtree: a directory appeared or disappeared with its whole content;
+# overflow: events were lost by the kernel queue; gap: events were lost while the watcher was down
+JOURNAL_EVENTS = ["entry", "subtree", "overflow", "gap"]
+# events are collected for this amount of seconds before they are written as one batch
+COALESCE_INTERVAL = 1.0
+# the watcher refreshes its state row at least this often
+HEARTBEAT_INTERVAL = 10.0
+# consumers don't trust the journal if the watcher was silent longer than this
+HEARTBEAT_TIMEOUT = timedelta(seconds=60)
+WATCHER_STATE = "watcher"
+DEFAULT_CONSUMER = "structure_monitoring"
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | \
+             IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR
+# events which add or remove an entry together with its content
+STRUCTURE_EVENTS = IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO
+EVENT_HEADER = struct.Struct("iIII")
+READ_BUFFER_SIZE = 64 * 1024
+
+
+class InotifyWatcher:
+    """
+    Recursive inotify watch of a directory tree through the libc calls
+    """
+    def __init__(self):
+        if not sys.platform.startswith("linux"):
+            raise Exception("inotify is available only on Linux")
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.watches: Dict = {}
+        # set when a directory couldn't be watched, its events are lost
+        self.watch_lost = False
+
+    def add_watch(self, abs_dir):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(abs_dir), WATCH_MASK)
+        if wd < 0:
+            error = ctypes.get_errno()
+            # the directory is already gone, its removal is journaled by the parent watch
+            if error not in (errno.ENOENT, errno.ENOTDIR):
+                print(f"Failed to watch {abs_dir}: {os.strerror(error)}")
+                self.watch_lost = True
+            return
+        self.watches[wd] = abs_dir
+
+    def add_tree(self, root_dir):
+        """
+        Watch the directory and all its subdirectories (except the excluded ones)
+        """
+        dirs_stack = [os.path.abspath(root_dir)]
+        while dirs_stack:
+            abs_dir = dirs_stack.pop()
+            self.add_watch(abs_dir)
+            try:
+                with os.scandir(abs_dir) as dir_it:
+                    dirs_stack.extend(entry.path for entry in dir_it
+                                      if entry.is_dir(follow_symlinks=False) and not is_excluded(entry.path))
+            except (FileNotFoundError, NotADirectoryError):
+                continue
+
+    def read_events(self, timeout):
+        """
+        Wait for the events at most timeout seconds
+        :return: list of (full name, event mask) tuples, full name is None for the overflow
+        """
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return []
+        try:
+            buffer = os.read(self.fd, READ_BUFFER_SIZE)
+        except BlockingIOError:
+            return []
+
+        events: List = []
+        offset = 0
+        while offset < len(buffer):
+            wd, mask, cookie, name_length = EVENT_HEADER.unpack_from(buffer, offset)
+            name = buffer[offset + EVENT_HEADER.size:offset + EVENT_HEADER.size + name_length].rstrip(b"\0")
+            offset += EVENT_HEADER.size + name_length
+            if mask & IN_Q_OVERFLOW:
+                events.append((None, mask))
+                continue
+            if mask & IN_IGNORED:
+                self.watches.pop(wd, None)
+                continue
+            abs_dir = self.watches.get(wd)
+            if abs_dir is None:
+                continue
+            events.append((os.path.join(abs_dir, os.fsdecode(name)) if name else abs_dir, mask))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+def journal_append(events, cur_date):
+    """
+    Append the coalesced events to the journal and refresh the heartbeat of the watcher
+    :param events: dictionary of the full name (None for overflow and gap) to the event type
+    :param cur_date: date of the events
+    :return: None
+    """
+    with get_engine().begin() as conn:
+        if events:
+            conn.execute(insert(DBChangeJournal), [{"path": path, "event_type": event_type, "event_date": cur_date}
+                                                   for path, event_type in events.items()])
+        last_offset = conn.execute(sql_select(func.max(DBChangeJournal.id))).scalar() or 0
+        state_upsert = sqlite_insert(DBJournalState).values(name=WATCHER_STATE, journal_offset=last_offset,
+                                                            update_date=cur_date)
+        conn.execute(state_upsert.on_conflict_do_update(
+            index_elements=[DBJournalState.name],
+            set_={"journal_offset": state_upsert.excluded.journal_offset,
+                  "update_date": state_upsert.excluded.update_date}))
+
+
+def coalesce_event(pending, path, mask):
+    """
+    Merge the event into the pending events, the subtree event of a path wins over the entry event
+    """
+    if path is None:
+        pending[None] = "overflow"
+        return
+    if mask & IN_ISDIR and mask & STRUCTURE_EVENTS or mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+        pending[path] = "subtree"
+    elif pending.get(path) != "subtree":
+        pending[path] = "entry"
+    # the directory of an added or removed entry gets the new mtime and child count
+    if mask & STRUCTURE_EVENTS and pending.get(os.path.dirname(path)) != "subtree":
+        pending[os.path.dirname(path)] = "entry"
+
+
+def watch(root_folder=HOME_FOLDER, coalesce_interval=COALESCE_INTERVAL, heartbeat_interval=HEARTBEAT_INTERVAL):
+    """
+    Journal the changes of the tree until the process is stopped
+    :param root_folder: full name of the watched root folder
+    :param coalesce_interval: seconds to collect the events before they are written
+    :param heartbeat_interval: max seconds between the writes of the watcher state
+    :return: None
+    """
+    model_creation()
+
+    watcher = InotifyWatcher()
+    pending: Dict = {}
+    try:
+        watcher.add_tree(root_folder)
+        # anything could happen while the watcher was down
+        pending[None] = "gap"
+        last_flush = 0.0
+        while True:
+            for path, mask in watcher.read_events(coalesce_interval):
+                if path is not None and is_excluded(path, bool(mask & IN_ISDIR)):
+                    continue
+                coalesce_event(pending, path, mask)
+                # new directories are watched right away, the subtree event covers the content created before
+                if path is not None and mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                    watcher.add_tree(path)
+            if watcher.watch_lost:
+                pending[None] = "gap"
+                watcher.watch_lost = False
+
+            now = time.monotonic()
+            if pending and now - last_flush >= coalesce_interval or now - last_flush >= heartbeat_interval:
+                journal_append(pending, datetime.now())
+                print(f"Journaled {len(pending)} changes")
+                pending = {}
+                last_flush = now
+    finally:
+        watcher.close()
+
+
+def journal_changes(consumer=DEFAULT_CONSUMER, cur_date=None):
+    """
+    Read the journal from the last offset of the consumer
+    :param consumer: name of the consumer
+    :param cur_date: current date to check the heartbeat of the watcher against
+    :return: tuple of the dictionary of the journaled paths to their event type (None if the journal can't be
+             trusted and the full scan is needed) and the offset to commit after the changes are applied
+    """
+    cur_date = cur_date or datetime.now()
+    with get_engine().connect() as conn:
+        states = dict((row.name, row) for row in conn.execute(sql_select(DBJournalState)))
+        last_offset = conn.execute(sql_select(func.max(DBChangeJournal.id))).scalar() or 0
+        consumer_state = states.get(consumer)
+        watcher_state = states.get(WATCHER_STATE)
+        if consumer_state is None:
+            print("Journal consumer has no offset yet, full scan")
+            return None, last_offset
+        # the consumed rows are removed, the offset of an empty journal is the one already committed
+        last_offset = max(last_offset, consumer_state.journal_offset)
+        if watcher_state is None or cur_date - watcher_state.update_date > HEARTBEAT_TIMEOUT:
+            print("Journal watcher is not running, full scan")
+            return None, last_offset
+
+        journal_rows = conn.execute(
+            sql_select(DBChangeJournal.path, DBChangeJournal.event_type)
+            .where(DBChangeJournal.id > consumer_state.journal_offset, DBChangeJournal.id <= last_offset)).all()
+
+    incr("journal_events_read", len(journal_rows))
+    changes: Dict = {}
+    for path, event_type in journal_rows:
+        if event_type in ("overflow", "gap"):
+            print(f"Journal reports {event_type}, full scan")
+            return None, last_offset
+        if changes.get(path) != "subtree":
+            changes[path] = event_type
+    return changes, last_offset
+
+
+def journal_commit(journal_offset, consumer=DEFAULT_CONSUMER, cur_date=None):
+    """
+    Save the offset of the consumer and remove the journal rows consumed by every consumer
+    :param journal_offset: last applied offset
+    :param consumer: name of the consumer
+    :param cur_date: date of the commit
+    :return: None
+    """
+    with get_engine().begin() as conn:
+        state_upsert = sqlite_insert(DBJournalState).values(name=consumer, journal_offset=journal_offset,
+                                                            update_date=cur_date or datetime.now())
+        conn.execute(state_upsert.on_conflict_do_update(
+            index_elements=[DBJournalState.name],
+            set_={"journal_offset": state_upsert.excluded.journal_offset,
+                  "update_date": state_upsert.excluded.update_date}))
+        consumed_offset = conn.execute(sql_select(func.min(DBJournalState.journal_offset))
+                                       .where(DBJournalState.name != WATCHER_STATE)).scalar()
+        conn.execute(delete(DBChangeJournal).where(DBChangeJournal.id <= consumed_offset))
+
+
+def journal_scopes(changes, root_folder=HOME_FOLDER):
+    """
+    Translate the journaled paths into the parts of the tree to compare
+    :param changes: dictionary of the journaled paths to their event type
+    :param root_folder: full name of the monitored root folder
+    :return: tuple of the directories to compare one level deep and the subtrees to compare entirely,
+             the subtrees are not nested and the directories are not inside of the subtrees
+    """
+    abs_root = os.path.abspath(root_folder)
+    subtree_roots = sorted(path for path, event_type in changes.items()
+                           if event_type == "subtree" and path.startswith(abs_root + os.sep))
+    # drop the subtrees nested into the other ones, sorted order puts a parent right before its content
+    top_subtrees: List = []
+    for subtree_root in subtree_roots:
+        if not top_subtrees or not subtree_root.startswith(top_subtrees[-1] + os.sep):
+            top_subtrees.append(subtree_root)
+
+    subtree_set = set(top_subtrees)
+
+    def in_subtrees(abs_item):
+        # walk up to the root, the subtrees are checked by the ancestors of the item
+        while len(abs_item) > len(abs_root):
+            if abs_item in subtree_set:
+                return True
+            abs_item = os.path.dirname(abs_item)
+        return False
+
+    # an entry is compared as a child of its directory, this catches its addition, change and removal
+    parent_dirs = sorted({os.path.dirname(path) for path in changes
+                          if path is not None and path.startswith(abs_root + os.sep)})
+    parent_dirs = [parent_dir for parent_dir in parent_dirs if not in_subtrees(parent_dir)]
+    return parent_dirs, top_subtrees
+
+
+def journal_catch_up(changes, scan_mode="full", content_hash=False, cur_date=None, root_folder=HOME_FOLDER,
+                     checkpoint=None):
+    """
+    Compare and apply only the journaled parts of the tree. The changes of all scopes are applied
+    as one change set in a single transaction, like the changes of a full scan: the new folders
+    of the directory scope and the content of the new subtrees are stored together
+    :param changes: dictionary of the journaled paths to their event type (see journal_changes)
+    :param scan_mode: one of SCAN_MODES
+    :param content_hash: detect modifications of the files by the content hash
+    :param cur_date: current date to set in versions
+    :param root_folder: full name of the monitored root folder
+    :param checkpoint: dictionary of the run ledger columns (see run_save) committed in the same transaction,
+    None if the run isn't checkpointed
+    :return: dictionary of the write amounts (see changes_write)
+    """
+    parent_dirs, subtree_roots = journal_scopes(changes, root_folder)
+    print(f"Journal catch up: {len(parent_dirs)} directories, {len(subtree_roots)} subtrees")
+    cur_date = cur_date or datetime.now()
+    # both scopes are compared before any write, the hierarchy of a removed subtree is read
+    # through its folder which is deleted by the directory scope
+    scope_changes = [subtrees_changes_discovery(scope_roots, scan_mode, content_hash, max_depth)
+                     for max_depth, scope_roots in [(1, parent_dirs), (None, subtree_roots)] if scope_roots]
+    if not scope_changes:
+        # nothing to compare, the empty change set still commits the checkpoint
+        scope_changes = [subtrees_changes_discovery([])]
+    # the directory scope goes first, the new folders precede their content in the change set
+    added_frame, modified_frame, deleted_frame = [pandas.concat(change_frames, ignore_index=True)
+                                                  for change_frames in zip(*scope_changes)]
+    # every scope scan gives its own id to a new folder: the content of a new subtree is attached
+    # to the id of its root added by the directory scope
+    new_folder_ids = added_frame.loc[added_frame["is_dir_c"] == 1].set_index("name_c")["id_c"]
+    added_frame["parent_folder_id_c"] = added_frame["name_p"].map(new_folder_ids) \
+        .fillna(added_frame["parent_folder_id_c"])
+    return changes_apply(added_frame, modified_frame, deleted_frame, cur_date, checkpoint)
+
+
+if __name__ == "__main__":
+    watch(sys.argv[1] if len(sys.argv) > 1 else HOME_FOLDER)
@@ -0,0 +1,116 @@
+import os
+import mmap
+import hashlib
+from collections import namedtuple
+from typing import List, Dict
+from concurrent.futures import ProcessPoolExecutor
+
+from sqlalchemy import select, delete
+from sqlalchemy.dialects.sqlite import insert
+
+from custom_operator.core_objects import DBFileHash
+from custom_operator.database_initialization import get_engine, stage_keys
+from custom_operator.instrumentation import incr
+
+HASH_ALGORITHM = "sha256"
+# default size of the process pool, 1 or less hashes in the current process
+HASH_WORKERS = os.cpu_count() or 1
+# files of this size and bigger are hashed through mmap instead of the buffered reads
+MMAP_THRESHOLD = 16 * 1024 * 1024
+READ_CHUNK_SIZE = 1024 * 1024
+# stat attributes of a scanned file needed for its hash signature
+FileStat = namedtuple("FileStat", ["filename", "inode", "size", "modify_date", "create_date"])
+
+
+def file_hash(file_name):
+    """
+    Calculate the content hash of a file
+    :param file_name: full name of the file
+    :return: hex digest of the content, None if the file can't be read
+    """
+    digest = hashlib.new(HASH_ALGORITHM)
+    try:
+        with open(file_name, "rb") as f:
+            if os.fstat(f.fileno()).st_size >= MMAP_THRESHOLD:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped_file:
+                    digest.update(mapped_file)
+            else:
+                for chunk in iter(lambda: f.read(READ_CHUNK_SIZE), b""):
+                    digest.update(chunk)
+    except (FileNotFoundError, PermissionError, IsADirectoryError) as e:
+        print(f"Failed to hash file {file_name}: {e}")
+        return None
+    return digest.hexdigest()
+
+
+def files_hashes(file_names, max_workers=HASH_WORKERS):
+    """
+    Calculate the content hashes of the files with the process pool
+    :param file_names: list of full names of the files
+    :param max_workers: size of the process pool
+    :return: dictionary of file name to its hash (None if the file can't be read)
+    """
+    if max_workers <= 1 or len(file_names) < 2:
+        return {file_name: file_hash(file_name) for file_name in file_names}
+    with ProcessPoolExecutor(max_workers=max_workers) as pool:
+        chunk_size = max(1, len(file_names) // (max_workers * 4))
+        return dict(zip(file_names, pool.map(file_hash, file_names, chunksize=chunk_size)))
+
+
+def hash_signature(db_file):
+    """
+    Stat signature of a file, the cached hash is valid as long as the signature is the same.
+    Change time is included, so a rewrite that restores mtime still changes the signature
+    :param db_file: DBFile or FileStat object
+    :return: signature string, None if the stat attributes are unknown
+    """
+    if db_file.inode is None or db_file.size is None:
+        return None
+    return f"{db_file.inode}:{db_file.size}:{db_file.modify_date.isoformat()}:{db_file.create_date.isoformat()}"
+
+
+def content_hashes(files, max_workers=HASH_WORKERS, prune_cache=True):
+    """
+    Content hashes of the scanned files: cached hashes are reused, only the files
+    with a new stat signature are read and hashed
+    :param files: list of FileStat objects of the scan
+    :param max_workers: size of the hashing process pool
+    :param prune_cache: remove cached signatures which are not part of the scan (set only for the full scan)
+    :return: list of the hashes aligned with the files, None if the file can't be read
+    """
+    signatures: Dict = {}
+    for file_stat in files:
+        signature = hash_signature(file_stat)
+        if signature is not None:
+            signatures.setdefault(signature, []).append(file_stat)
+
+    with get_engine().begin() as conn:
+        stage_table = stage_keys(conn, "stage_hash_signatures", signatures.keys())
+        cached_hashes = dict(conn.execute(
+            select(DBFileHash.signature, DBFileHash.content_hash)
+            .join(stage_table, DBFileHash.signature == stage_table.c.key)).all())
+        if prune_cache:
+            conn.execute(delete(DBFileHash).where(DBFileHash.signature.not_in(select(stage_table.c.key))))
+        stage_table.drop(conn)
+
+    # any of the files with the same signature (hard links) represents the content
+    missed_files: List = [signature_files[0] for signature, signature_files in signatures.items()
+                          if signature not in cached_hashes]
+    new_hashes = files_hashes([file_stat.filename for file_stat in missed_files], max_workers)
+
+    cache_rows: List = []
+    for file_stat in missed_files:
+        if new_hashes[file_stat.filename] is None:
+            continue
+        cached_hashes[hash_signature(file_stat)] = new_hashes[file_stat.filename]
+        cache_rows.append({"signature": hash_signature(file_stat), "inode": file_stat.inode, "size": file_stat.size,
+                           "modify_date": file_stat.modify_date, "create_date": file_stat.create_date,
+                           "content_hash": new_hashes[file_stat.filename]})
+    if cache_rows:
+        with get_engine().begin() as conn:
+            conn.execute(insert(DBFileHash).on_conflict_do_nothing(), cache_rows)
+
+    incr("hashes_cached", len(signatures) - len(missed_files))
+    incr("files_hashed", len(missed_files))
+    print(f"Content hashes: {len(signatures) - len(missed_files)} cached, {len(missed_files)} hashed")
+    return [cached_hashes.get(hash_signature(file_stat)) for file_stat in files]
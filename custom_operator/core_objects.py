@@ -1,59 +1,96 @@
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy import MetaData, Column, String, TIMESTAMP, BOOLEAN, INTEGER, ForeignKey, CHAR
+from sqlalchemy import MetaData, Column, String, TIMESTAMP, BOOLEAN, INTEGER, ForeignKey, CHAR, Index, text
 
 Base = declarative_base()
 metadata = MetaData()
 
 
+class DBPath(Base):
+    __tablename__ = "DBPath"
+    __table_args__ = (
+        Index("ux_DBPath_path", "path", unique=True),
+        {"sqlite_autoincrement": True},
+    )
+    # integer key of a full name, shared by the entries and all their versions
+    id = Column(INTEGER, primary_key=True, autoincrement=True, nullable=False)
+    path = Column(String, nullable=False)
+
+
 class DBFile(Base):
     __tablename__ = "DBFile"
+    __table_args__ = (
+        Index("ux_DBFile_path_id", "path_id", unique=True),
+        Index("ix_DBFile_folder_id", "folder_id"),
+        Index("ix_DBFile_depth", "depth"),
+    )
     # uid = Column(INTEGER, nullable=False, primary_key=True, autoincrement=True)
     id = Column(String, primary_key=True, nullable=False)
-    filename = Column(String, nullable=False)
+    # full name of the file is kept only in DBPath
+    path_id = Column(INTEGER, ForeignKey("DBPath.id"), nullable=False)
     description = Column(String, nullable=True)
     folder_id = Column(String, ForeignKey("DBFolder.id"), nullable=False)
     create_date = Column(TIMESTAMP, nullable=False)
     modify_date = Column(TIMESTAMP, nullable=True)
-
-    # adjust naming to specify that it's used for a custom dataframe processing
-    def as_dict(self):
-        return {"id": self.id,
-                "name": self.filename,
-                "description": self.description,
-                "is_dir": False,
-                "parent_folder_id": self.folder_id,
-                "create_date": self.create_date,
-                "modify_date": self.modify_date
-                }
+    size = Column(INTEGER, nullable=True)
+    inode = Column(INTEGER, nullable=True)
+    # device and inode identify the file across renames and moves
+    device = Column(INTEGER, nullable=True)
+    content_hash = Column(String, nullable=True)
+    # the full name is the materialized path of the file, depth is the amount of its components
+    depth = Column(INTEGER, nullable=True)
 
 
 class DBFolder(Base):
     __tablename__ = "DBFolder"
+    __table_args__ = (
+        Index("ux_DBFolder_path_id", "path_id", unique=True),
+        Index("ix_DBFolder_parent_id", "parent_id"),
+        Index("ix_DBFolder_depth", "depth"),
+    )
     # uid = Column(INTEGER, nullable=False, primary_key=True, autoincrement=True)
     id = Column(String, primary_key=True, nullable=False)
-    foldername = Column(String, nullable=False)
+    # full name of the folder is kept only in DBPath
+    path_id = Column(INTEGER, ForeignKey("DBPath.id"), nullable=False)
     description = Column(String, nullable=True)
     parent_id = Column(String, ForeignKey("DBFolder.id"), nullable=True)
     create_date = Column(TIMESTAMP, nullable=False)
     modify_date = Column(TIMESTAMP, nullable=True)
+    # amount of direct children at the moment of modify_date, used to trust the folder mtime on rescan
+    child_count = Column(INTEGER, nullable=True)
+    # device and inode identify the folder across renames and moves
+    inode = Column(INTEGER, nullable=True)
+    device = Column(INTEGER, nullable=True)
+    # the full name is the materialized path of the folder, depth is the amount of its components
+    depth = Column(INTEGER, nullable=True)
+
 
-    # adjust naming to specify that it's used for a custom dataframe processing
-    def as_dict(self):
-        return {"id": self.id,
-                "name": self.foldername,
-                "description": self.description,
-                "is_dir": True,
-                "parent_folder_id": self.parent_id,
-                "create_date": self.create_date,
-                "modify_date": self.modify_date
-                }
+class DBFolderStats(Base):
+    """
+    Rollup of the subtree of a folder, kept up to date by the change handlers (see folder_stats)
+    """
+    __tablename__ = "DBFolderStats"
+    folder_id = Column(String, ForeignKey("DBFolder.id"), primary_key=True, nullable=False)
+    # files of the whole subtree
+    file_count = Column(INTEGER, nullable=False)
+    total_size = Column(INTEGER, nullable=False)
+    # latest modification date of the folder and of the entries below it
+    latest_modify_date = Column(TIMESTAMP, nullable=True)
 
 
 class DBFileVersion(Base):
     __tablename__ = "DBFileVersion"
+    __table_args__ = (
+        Index("ix_DBFileVersion_path_id_is_active", "path_id", "is_active"),
+        Index("ix_DBFileVersion_file_id", "file_id"),
+        # only one active version per file
+        Index("ux_DBFileVersion_active_path_id", "path_id", unique=True, sqlite_where=text("is_active = 1")),
+        # version intervals for the point in time queries (see version_queries)
+        Index("ix_DBFileVersion_version_end_start", "version_end", "version_start"),
+        Index("ix_DBFileVersion_version_start", "version_start"),
+    )
     id = Column(INTEGER, primary_key=True, autoincrement=True, nullable=False)
     file_id = Column(String, nullable=False)
-    filename = Column(String, nullable=False)
+    path_id = Column(INTEGER, ForeignKey("DBPath.id"), nullable=False)
     description = Column(String, nullable=True)
     folder_id = Column(String, nullable=True)
     create_date = Column(TIMESTAMP, nullable=False)
@@ -63,3 +100,80 @@ class DBFileVersion(Base):
     version = Column(INTEGER, nullable=False)
     version_start = Column(TIMESTAMP, nullable=False)
     version_end = Column(TIMESTAMP, nullable=False)
+
+
+class DBFileHash(Base):
+    """
+    Cache of the content hashes by the stat signature of a file, a file is hashed again
+    only when its signature changes
+    """
+    __tablename__ = "DBFileHash"
+    # inode:size:modify_date:create_date
+    signature = Column(String, primary_key=True, nullable=False)
+    inode = Column(INTEGER, nullable=False)
+    size = Column(INTEGER, nullable=False)
+    modify_date = Column(TIMESTAMP, nullable=False)
+    create_date = Column(TIMESTAMP, nullable=False)
+    content_hash = Column(String, nullable=False)
+
+
+class DBChangeJournal(Base):
+    """
+    Coalesced filesystem events appended by the watcher, id is the journal offset
+    """
+    __tablename__ = "DBChangeJournal"
+    # offsets are never reused after the consumed rows are removed
+    __table_args__ = {"sqlite_autoincrement": True}
+    id = Column(INTEGER, primary_key=True, autoincrement=True, nullable=False)
+    # full name of the changed entry, None for the overflow and gap events
+    path = Column(String, nullable=True)
+    # entry, subtree, overflow or gap (see change_journal.JOURNAL_EVENTS)
+    event_type = Column(String, nullable=False)
+    event_date = Column(TIMESTAMP, nullable=False)
+
+
+class DBJournalState(Base):
+    """
+    Offsets of the journal consumers and the heartbeat of the watcher
+    """
+    __tablename__ = "DBJournalState"
+    name = Column(String, primary_key=True, nullable=False)
+    journal_offset = Column(INTEGER, nullable=False)
+    update_date = Column(TIMESTAMP, nullable=False)
+
+
+class DBLoadCheckpoint(Base):
+    """
+    Progress of the bulk initial load of a tree, an interrupted load resumes after the last committed entry
+    """
+    __tablename__ = "DBLoadCheckpoint"
+    root_folder = Column(String, primary_key=True, nullable=False)
+    # the entries are loaded in the order of the full name, every entry up to this one is committed
+    last_name = Column(String, nullable=True)
+    chunk_count = Column(INTEGER, nullable=False)
+    entry_count = Column(INTEGER, nullable=False)
+    load_start = Column(TIMESTAMP, nullable=False)
+    update_date = Column(TIMESTAMP, nullable=False)
+    finished = Column(BOOLEAN, nullable=False)
+
+
+class DBMonitoringRun(Base):
+    """
+    Ledger of the monitoring runs, a retried task resumes from the checkpoint of its run (see run_ledger)
+    """
+    __tablename__ = "DBMonitoringRun"
+    # dag, task and run ids, the same for all tries of the task
+    run_key = Column(String, primary_key=True, nullable=False)
+    # discovered, applying or finished (see run_ledger.RUN_STATUSES)
+    status = Column(String, nullable=False)
+    # file of the discovered change set, it's applied again instead of the scan
+    staging_file = Column(String, nullable=True)
+    # subtree root of the streamed run and the name up to which its changes are committed
+    root_folder = Column(String, nullable=True)
+    last_name = Column(String, nullable=True)
+    # amount of the committed batches (stream batches or shards)
+    batch_count = Column(INTEGER, nullable=False)
+    # version date of the run, kept by the resumed tries
+    cur_date = Column(TIMESTAMP, nullable=False)
+    start_date = Column(TIMESTAMP, nullable=False)
+    update_date = Column(TIMESTAMP, nullable=False)
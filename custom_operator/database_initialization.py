@@ -0,0 +1,142 @@
+from threading import Lock
+from contextlib import contextmanager
+from typing import Dict
+
+from sqlalchemy import create_engine, event, Table, MetaData, Column, String
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import QueuePool
+
+from custom_operator.instrumentation import install_sql_hooks
+
+LOCAL_SQLITE_URL = "sqlite:////opt/airflow/dags/local_database.db"
+
+# applied to every new SQLite connection of the pool
+SQLITE_PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    # negative value is the size in KiB
+    "cache_size": -65536,
+    "mmap_size": 268435456,
+    "temp_store": "MEMORY",
+    # wait for the lock of a concurrent writer instead of failing at once
+    "busy_timeout": 30000,
+}
+
+# connection pool settings passed to create_engine
+POOL_SETTINGS = {
+    "pool_size": 5,
+    "max_overflow": 10,
+    "pool_timeout": 30,
+    "pool_pre_ping": True,
+}
+
+database_settings: Dict = {"url": LOCAL_SQLITE_URL, "pragmas": SQLITE_PRAGMAS, "pool": POOL_SETTINGS}
+engine_lock = Lock()
+project_engine = None
+project_session_factory = None
+
+
+def configure_database(url=None, pragmas=None, pool=None):
+    """
+    Override the database settings, the engine is created again on the next use
+    :param url: sqlalchemy url of the database
+    :param pragmas: dictionary of the SQLite pragmas to apply on connect
+    :param pool: dictionary of the connection pool settings
+    :return: None
+    """
+    with engine_lock:
+        if url is not None:
+            database_settings["url"] = url
+        if pragmas is not None:
+            database_settings["pragmas"] = pragmas
+        if pool is not None:
+            database_settings["pool"] = pool
+    dispose_engine()
+
+
+def apply_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    try:
+        for pragma, value in database_settings["pragmas"].items():
+            cursor.execute(f"PRAGMA {pragma}={value}")
+    finally:
+        cursor.close()
+
+
+def get_engine():
+    """
+    Create the engine on the first use, so importing the operators doesn't touch the database
+    :return: sqlalchemy Engine shared by the whole process
+    """
+    global project_engine
+    if project_engine is None:
+        with engine_lock:
+            if project_engine is None:
+                engine = create_engine(database_settings["url"], poolclass=QueuePool,
+                                       # pooled connections are handed over between the worker threads
+                                       connect_args={"check_same_thread": False},
+                                       **database_settings["pool"])
+                event.listen(engine, "connect", apply_sqlite_pragmas)
+                install_sql_hooks(engine)
+                project_engine = engine
+    return project_engine
+
+
+def get_session_factory():
+    """
+    :return: sessionmaker bound to the shared engine
+    """
+    global project_session_factory
+    if project_session_factory is None:
+        with engine_lock:
+            if project_session_factory is None:
+                project_session_factory = sessionmaker(bind=get_engine())
+    return project_session_factory
+
+
+@contextmanager
+def session_scope():
+    """
+    Session with a clear lifecycle: committed on success, rolled back on error and always closed
+    :return: generator of the session
+    """
+    s = get_session_factory()()
+    try:
+        yield s
+        s.commit()
+    except Exception:
+        s.rollback()
+        raise
+    finally:
+        s.close()
+
+
+def dispose_engine():
+    """
+    Close all pooled connections and drop the engine, e.g. after the process fork
+    :return: None
+    """
+    global project_engine, project_session_factory
+    with engine_lock:
+        if project_engine is not None:
+            project_engine.dispose()
+        project_engine = None
+        project_session_factory = None
+
+
+def stage_keys(conn, table_name, keys, key_type=String):
+    """
+    Stage the list of keys into a temporary table of the connection to join against it
+    :param conn: connection with an open transaction, the table lives as long as the connection
+    :param table_name: name of the temporary table
+    :param keys: iterable of unique keys
+    :param key_type: sqlalchemy type of the keys, string by default
+    :return: sqlalchemy Table of the staged keys with the single "key" column
+    """
+    stage_table = Table(table_name, MetaData(), Column("key", key_type, primary_key=True), prefixes=["TEMPORARY"])
+    stage_table.drop(conn, checkfirst=True)
+    stage_table.create(conn)
+    key_rows = [{"key": key} for key in keys]
+    if key_rows:
+        conn.execute(stage_table.insert(), key_rows)
+    return stage_table
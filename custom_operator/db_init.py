@@ -0,0 +1,303 @@
+import os
+import pandas
+from datetime import datetime
+from custom_operator.filesystem_parser import HOME_FOLDER, scan_struct_sorted, path_depth
+from custom_operator.core_objects import Base, DBFile, DBFileVersion, DBFolder, DBLoadCheckpoint, DBFolderStats, \
+    DBPath
+from custom_operator.path_dictionary import paths_intern
+from custom_operator.folder_stats import folder_stats_rebuild
+from custom_operator.database_initialization import get_engine
+from custom_operator.instrumentation import incr
+
+from sqlalchemy import inspect, text, select, insert, update, bindparam
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.exc import IntegrityError
+from typing import Dict, List
+
+
+# statements filling a column right after it was added to the table of an existing database
+COLUMN_BACKFILL = {
+    ("DBFolder", "child_count"): "UPDATE DBFolder SET child_count = "
+                                 "(SELECT COUNT(*) FROM DBFolder sub WHERE sub.parent_id = DBFolder.id) + "
+                                 "(SELECT COUNT(*) FROM DBFile sub WHERE sub.folder_id = DBFolder.id)",
+    ("DBFolder", "depth"): "UPDATE DBFolder SET depth = length(foldername) - length(replace(foldername, '/', ''))",
+    ("DBFile", "depth"): "UPDATE DBFile SET depth = length(filename) - length(replace(filename, '/', ''))",
+    # full names are interned into DBPath before their keys are set
+    ("DBFolder", "path_id"): ["INSERT OR IGNORE INTO DBPath (path) SELECT foldername FROM DBFolder",
+                              "UPDATE DBFolder SET path_id = (SELECT id FROM DBPath WHERE path = DBFolder.foldername)"],
+    ("DBFile", "path_id"): ["INSERT OR IGNORE INTO DBPath (path) SELECT filename FROM DBFile",
+                            "UPDATE DBFile SET path_id = (SELECT id FROM DBPath WHERE path = DBFile.filename)"],
+    ("DBFileVersion", "path_id"): ["INSERT OR IGNORE INTO DBPath (path) SELECT filename FROM DBFileVersion",
+                                   "UPDATE DBFileVersion SET path_id = "
+                                   "(SELECT id FROM DBPath WHERE path = DBFileVersion.filename)"]
+}
+# columns removed from the model, dropped together with their indexes once the backfill is done
+OBSOLETE_COLUMNS = [("DBFileVersion", "filename"), ("DBFile", "filename"), ("DBFolder", "foldername")]
+# indexes replaced by the model ones, dropped before the missing indexes are created
+OBSOLETE_INDEXES = ["ix_DBFile_path_id", "ix_DBFolder_path_id"]
+# amount of entries inserted and checkpointed by one transaction of the bulk load
+LOAD_CHUNK_SIZE = 50000
+# path_id columns hold the full names until the chunk is committed (see load_chunk_commit)
+FOLDER_LOAD_COLUMNS = ["id", "path_id", "description", "parent_id", "create_date", "modify_date",
+                       "child_count", "inode", "device", "depth"]
+FILE_LOAD_COLUMNS = ["id", "path_id", "description", "folder_id", "create_date", "modify_date", "size",
+                     "inode", "device", "depth"]
+VERSION_LOAD_COLUMNS = ["file_id", "path_id", "description", "folder_id", "create_date", "modify_date",
+                        "is_active", "op_type", "version", "version_start", "version_end"]
+
+
+def model_upgrade():
+    """
+    Upgrade the tables of an existing database in place: add the columns missing from the model
+    and fill them with the backfill statements if there are any, drop the obsolete columns and indexes,
+    then create the missing indexes and the folder rollups of the loaded tree. The added columns get only
+    their types, the NOT NULL constraints of the model apply to the newly created databases.
+    Safe to run on every start, nothing is done for an up-to-date database
+    :return: None
+    """
+    engine = get_engine()
+    inspector = inspect(engine)
+    dropped_columns = 0
+    with engine.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            existing_columns = {column["name"] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing_columns:
+                    continue
+                column_type = column.type.compile(dialect=engine.dialect)
+                conn.execute(text(f'ALTER TABLE "{table.name}" ADD COLUMN "{column.name}" {column_type}'))
+                backfill = COLUMN_BACKFILL.get((table.name, column.name), [])
+                for statement in [backfill] if isinstance(backfill, str) else backfill:
+                    conn.execute(text(statement))
+
+        for table_name, column_name in OBSOLETE_COLUMNS:
+            if column_name not in {column["name"] for column in inspector.get_columns(table_name)}:
+                continue
+            # SQLite refuses to drop a column which is still indexed
+            for index in inspector.get_indexes(table_name):
+                if column_name in index["column_names"]:
+                    conn.execute(text(f'DROP INDEX "{index["name"]}"'))
+            conn.execute(text(f'ALTER TABLE "{table_name}" DROP COLUMN "{column_name}"'))
+            dropped_columns += 1
+
+    with engine.begin() as conn:
+        for index_name in OBSOLETE_INDEXES:
+            conn.execute(text(f'DROP INDEX IF EXISTS "{index_name}"'))
+
+    created_indexes = 0
+    for table in Base.metadata.sorted_tables:
+        existing_indexes = {index["name"] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name in existing_indexes:
+                continue
+            try:
+                with engine.begin() as conn:
+                    index.create(conn)
+                created_indexes += 1
+            except IntegrityError as e:
+                # stored data breaks the unique constraint, the index will be created once it's fixed
+                print(f"Failed to create index {index.name}: {e}")
+
+    if dropped_columns > 0:
+        # return the pages of the dropped columns to the filesystem
+        with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+            conn.execute(text("VACUUM"))
+    if created_indexes > 0 or dropped_columns > 0:
+        # refresh planner statistics for the new indexes
+        with engine.begin() as conn:
+            conn.execute(text("ANALYZE"))
+
+    # folders stored without the rollups: loaded before them or by the finished bulk load
+    with engine.connect() as conn:
+        stats_missing = conn.execute(select(DBFolder.id).limit(1)).first() is not None and \
+            conn.execute(select(DBFolderStats.folder_id).limit(1)).first() is None and \
+            conn.execute(select(DBLoadCheckpoint.root_folder).where(DBLoadCheckpoint.finished.is_(False))
+                         .limit(1)).first() is None
+    if stats_missing:
+        # files stored before the size column have no size yet
+        file_sizes_backfill()
+        folder_stats_rebuild()
+
+
+def file_sizes_backfill(chunk_size=LOAD_CHUNK_SIZE):
+    """
+    Fill the missing sizes of the stored files with one stat per file, files which can't be read
+    keep the empty size until the next monitoring run compares them
+    :param chunk_size: amount of the sizes updated by one statement
+    :return: amount of the filled sizes
+    """
+    engine = get_engine()
+    with engine.connect() as conn:
+        unsized_files = conn.execute(select(DBFile.id, DBPath.path)
+                                     .join(DBPath, DBFile.path_id == DBPath.id)
+                                     .where(DBFile.size.is_(None))).all()
+    if not unsized_files:
+        return 0
+
+    size_rows: List = []
+    for file_id, file_name in unsized_files:
+        try:
+            size_rows.append({"b_id": file_id, "size": os.stat(file_name).st_size})
+        except OSError:
+            continue
+    with engine.begin() as conn:
+        for chunk_start in range(0, len(size_rows), chunk_size):
+            conn.execute(update(DBFile).where(DBFile.id == bindparam("b_id")).values(size=bindparam("size")),
+                         size_rows[chunk_start:chunk_start + chunk_size])
+    print(f"Sizes filled for {len(size_rows)} of {len(unsized_files)} files")
+    return len(size_rows)
+
+
+def model_creation():
+    Base.metadata.create_all(get_engine())
+    model_upgrade()
+
+
+def load_indexes():
+    """
+    :return: list of the indexes of the loaded tables, the bulk load builds them once after the data is inserted
+    """
+    return [index for table in [DBFolder.__table__, DBFile.__table__, DBFileVersion.__table__]
+            for index in table.indexes]
+
+
+def load_chunk():
+    """
+    :return: dictionary of the loaded table to its empty column arrays
+    """
+    return {table: {column_name: [] for column_name in column_names}
+            for table, column_names in [(DBFolder.__table__, FOLDER_LOAD_COLUMNS),
+                                        (DBFile.__table__, FILE_LOAD_COLUMNS),
+                                        (DBFileVersion.__table__, VERSION_LOAD_COLUMNS)]}
+
+
+def columns_insert(conn, table, columns):
+    """
+    Insert the column arrays into the table with one executemany
+    :param conn: sqlalchemy Connection
+    :param table: sqlalchemy Table
+    :param columns: dictionary of the column name to the list of its values
+    :return: amount of the inserted rows
+    """
+    column_names = list(columns)
+    rows = [dict(zip(column_names, values)) for values in zip(*columns.values())]
+    if rows:
+        conn.execute(insert(table), rows)
+    return len(rows)
+
+
+def checkpoint_save(conn, root_folder, last_name, chunk_count, entry_count, load_start, finished=False):
+    checkpoint_upsert = sqlite_insert(DBLoadCheckpoint).values(
+        root_folder=root_folder, last_name=last_name, chunk_count=chunk_count, entry_count=entry_count,
+        load_start=load_start, update_date=datetime.now(), finished=finished)
+    conn.execute(checkpoint_upsert.on_conflict_do_update(
+        index_elements=[DBLoadCheckpoint.root_folder],
+        set_={column: checkpoint_upsert.excluded[column]
+              for column in ["last_name", "chunk_count", "entry_count", "update_date", "finished"]}))
+
+
+def load_chunk_commit(chunk, root_folder, last_name, chunk_count, entry_count, load_start, finished=False):
+    """
+    Insert the chunk and save the checkpoint in one transaction, the full names of the path_id columns
+    are interned and replaced with their keys first
+    """
+    with get_engine().begin() as conn:
+        path_ids = paths_intern(conn, [name for columns in chunk.values() for name in columns["path_id"]])
+        for columns in chunk.values():
+            columns["path_id"] = [path_ids[name] for name in columns["path_id"]]
+        for table, columns in chunk.items():
+            incr("rows_inserted", columns_insert(conn, table, columns))
+        checkpoint_save(conn, root_folder, last_name, chunk_count, entry_count, load_start, finished)
+    incr("load_chunks")
+
+
+def initial_load_pending(root_folder=HOME_FOLDER):
+    """
+    :return: True if the bulk load of the tree was started and not finished
+    """
+    engine = get_engine()
+    if not inspect(engine).has_table(DBLoadCheckpoint.__tablename__):
+        return False
+    with engine.connect() as conn:
+        finished = conn.execute(select(DBLoadCheckpoint.finished)
+                                .where(DBLoadCheckpoint.root_folder == os.path.abspath(root_folder))).scalar()
+    return finished is not None and not finished
+
+
+def bulk_initial_load(root_folder=HOME_FOLDER, chunk_size=LOAD_CHUNK_SIZE):
+    """
+    Initial load of the tree without the ORM objects: the sorted walk is collected into the column arrays,
+    every chunk of them is inserted with Core executemany and checkpointed in the same transaction.
+    The indexes are dropped for a fresh load and built once at the end. An interrupted load resumes
+    after the last committed entry
+    :param root_folder: full name of the root folder
+    :param chunk_size: amount of entries in one transaction
+    :return: amount of the loaded entries
+    """
+    abs_root = os.path.abspath(root_folder)
+    engine = get_engine()
+    with engine.connect() as conn:
+        checkpoint = conn.execute(select(DBLoadCheckpoint).where(DBLoadCheckpoint.root_folder == abs_root)).first()
+    if checkpoint is not None and checkpoint.finished:
+        print(f"Initial load of {abs_root} is already finished")
+        return 0
+
+    # full names of the folders to their ids, parents are always loaded before their content
+    folder_ids: Dict = {}
+    if checkpoint is None:
+        resume_after, chunk_count, entry_count, load_start = None, 0, 0, datetime.now()
+        with engine.begin() as conn:
+            for index in load_indexes():
+                index.drop(conn, checkfirst=True)
+    else:
+        resume_after, chunk_count, entry_count, load_start = \
+            checkpoint.last_name, checkpoint.chunk_count, checkpoint.entry_count, checkpoint.load_start
+        print(f"Resuming initial load of {abs_root} after {resume_after}, {entry_count} entries loaded")
+        with engine.connect() as conn:
+            folder_ids.update(conn.execute(select(DBPath.path, DBFolder.id)
+                                           .join(DBPath, DBFolder.path_id == DBPath.id)).all())
+
+    chunk = load_chunk()
+    chunk_entries = 0
+    last_name = resume_after
+    for record in scan_struct_sorted(abs_root, resume_after):
+        name = record["FileName"]
+
+        parent_id = folder_ids.get(os.path.dirname(name)) if name != abs_root else None
+        create_date = datetime.fromtimestamp(record["CreateDate"])
+        modify_date = datetime.fromtimestamp(record["ModifyDate"])
+        if record["IsDirectory"]:
+            folder_ids[name] = record["ID"]
+            for column_name, value in zip(FOLDER_LOAD_COLUMNS,
+                                          [record["ID"], name, None, parent_id, create_date, modify_date,
+                                           record["ChildCount"], record["Inode"], record["Device"],
+                                           path_depth(name)]):
+                chunk[DBFolder.__table__][column_name].append(value)
+        else:
+            for column_name, value in zip(FILE_LOAD_COLUMNS,
+                                          [record["ID"], name, None, parent_id, create_date, modify_date,
+                                           record["Size"], record["Inode"], record["Device"], path_depth(name)]):
+                chunk[DBFile.__table__][column_name].append(value)
+        for column_name, value in zip(VERSION_LOAD_COLUMNS,
+                                      [record["ID"], name, None, parent_id, create_date, modify_date,
+                                       True, 'i', 1, load_start, pandas.Timestamp.max]):
+            chunk[DBFileVersion.__table__][column_name].append(value)
+        chunk_entries += 1
+        last_name = name
+
+        if chunk_entries >= chunk_size:
+            chunk_count += 1
+            entry_count += chunk_entries
+            load_chunk_commit(chunk, abs_root, last_name, chunk_count, entry_count, load_start)
+            print(f"Loaded chunk {chunk_count}, {entry_count} entries")
+            chunk = load_chunk()
+            chunk_entries = 0
+
+    chunk_count += 1 if chunk_entries else 0
+    entry_count += chunk_entries
+    load_chunk_commit(chunk, abs_root, last_name, chunk_count, entry_count, load_start, finished=True)
+    print(f"Initial load finished, {entry_count} entries in {chunk_count} chunks")
+
+    # build the dropped indexes and refresh the planner statistics
+    model_upgrade()
+    return entry_count
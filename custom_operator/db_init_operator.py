@@ -1,94 +1,37 @@
-import pandas
-from datetime import datetime
-from custom_operator.filesystem_parser import HOME_FOLDER, populate_struct, populate_db_list
-from custom_operator.core_objects import Base, DBFile, DBFileVersion, DBFolder
+from typing import Optional, List
 
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
-from typing import List, Dict
+from custom_operator.db_init import model_creation, bulk_initial_load, LOAD_CHUNK_SIZE
+from custom_operator.filesystem_parser import configure_exclusions
+from custom_operator.instrumentation import RunMetrics, collecting, span, publish_metrics, METRICS_FOLDER
 
 from airflow.models.baseoperator import BaseOperator
 
 
-LOCAL_SQLITE_URL = "sqlite:////opt/airflow/dags/local_database.db"
-project_engine = create_engine(LOCAL_SQLITE_URL)
-
-
-def struct_list_initialization():
-    root_struct: Dict = {}
-    populate_struct(HOME_FOLDER, root_struct)
-
-    struct_frame = pandas.DataFrame.from_dict(root_struct, orient="index",
-                                              columns=["ID", "FileName", "IsDirectory", "CreateDate", "ModifyDate"])
-
-    slash_list: List = []
-    for index, row in struct_frame.iterrows():
-        slash_list.append(row["FileName"].count("/"))
-    struct_frame["SlashCount"] = slash_list
-
-    root_dir_frame = struct_frame[struct_frame["SlashCount"] == struct_frame["SlashCount"].min()]
-    if root_dir_frame.shape[0] > 1:
-        raise Exception("Multiple root entries")
-    root_dir_row = root_dir_frame.iloc[0]
-
-    db_list: List = []
-    populate_db_list(struct_frame, root_dir_row, None, int(root_dir_row["SlashCount"]),
-                     int(root_dir_row["SlashCount"]), db_list)
-
-    return db_list
-
-
-def file_version_data(local_struct_list):
-    data_list: List = []
-    
-    ver_start = datetime.now()
-    for item in local_struct_list:
-        if isinstance(item, DBFile):
-            ver_entry = DBFileVersion(file_id=item.id, filename=item.filename,
-                                      description=item.description, folder_id=item.folder_id,
-                                      create_date=item.create_date, modify_date=item.modify_date,
-                                      is_active=True, version=1, op_type='i',
-                                      version_start=ver_start, version_end=pandas.Timestamp.max)
-        else:
-            ver_entry = DBFileVersion(file_id=item.id, filename=item.foldername,
-                                      description=item.description, folder_id=item.parent_id,
-                                      create_date=item.create_date, modify_date=item.modify_date,
-                                      is_active=True, version=1, op_type='i',
-                                      version_start=ver_start, version_end=pandas.Timestamp.max)
-        data_list.append(ver_entry)
-
-    return data_list
-
-
-def model_creation():
-    Base.metadata.create_all(project_engine)
-
-
-def db_data_load(data_objects):
-    s = sessionmaker(bind=project_engine)()
-    try:
-        s.bulk_save_objects(data_objects)
-        s.commit()
-    except Exception as e:
-        print(f"Error inserting data: {e}")
-        s.rollback()
-    finally:
-        s.close()
-
-
 class DBInitOperator(BaseOperator):
-    def __init__(self, name: str, **kwargs) -> None:
+    def __init__(self, name: str, metrics_folder: Optional[str] = METRICS_FOLDER,
+                 chunk_size: int = LOAD_CHUNK_SIZE, exclude_patterns: Optional[List[str]] = None,
+                 max_file_size: Optional[int] = None, max_file_age: Optional[float] = None, **kwargs) -> None:
         super().__init__(**kwargs)
         self.name = name
+        # folder of the run metrics file, None to push the metrics to XCom only
+        self.metrics_folder = metrics_folder
+        # amount of entries inserted and checkpointed by one transaction
+        self.chunk_size = chunk_size
+        # exclusion rules of the loaded tree, the same as of the monitoring (see StructureMonitoringOperator)
+        self.exclude_patterns = exclude_patterns
+        self.max_file_size = max_file_size
+        self.max_file_age = max_file_age
 
     def execute(self, context):
-        model_creation()
-        print("Model creation finished")
-        local_file_list = struct_list_initialization()
-        print("struct_list_initialization finished")
-        version_list = file_version_data(local_file_list)
-        print("file_version_data finished")
-        db_data_load(local_file_list)
-        print("db_data_load finished")
-        db_data_load(version_list)
-        print("db_data_load finished")
+        configure_exclusions(self.exclude_patterns, self.max_file_size, self.max_file_age)
+        metrics = RunMetrics(self.task_id)
+        with collecting(metrics):
+            with span("model_creation"):
+                model_creation()
+            self.log.info("Model creation finished")
+            with span("bulk_initial_load"):
+                entry_count = bulk_initial_load(chunk_size=self.chunk_size)
+            self.log.info("bulk_initial_load finished, %d entries", entry_count)
+
+        metrics_file = publish_metrics(metrics, context, self.task_id, self.metrics_folder)
+        self.log.info("Run metrics: %s, written to %s", metrics.counters, metrics_file)
@@ -1,6 +1,9 @@
-from datetime import datetime
-from sqlalchemy.orm import sessionmaker
-from custom_operator.database_initialization import project_engine
+import time
+import logging
+from custom_operator.database_initialization import session_scope
+from custom_operator.instrumentation import span
+
+logger = logging.getLogger(__name__)
 
 
 def sql_decorator_factory(*args, **kwargs):
@@ -12,10 +15,11 @@ def sql_decorator_factory(*args, **kwargs):
 
         def wrapper(*args, **kwargs):
             print(f"""SQL decor: args {args}, kwargs {kwargs}""")
-            s = sessionmaker(bind=project_engine)()
-            print(f"""Begin to run SQL {operation}""")
-            result = func(*args, session=s, **kwargs)
-            print(f"""End to run SQL {operation}""")
+            with session_scope() as s:
+                print(f"""Begin to run SQL {operation}""")
+                result = func(*args, session=s, **kwargs)
+                print(f"""End to run SQL {operation}""")
+            return result
 
         return wrapper
 
@@ -28,6 +32,7 @@ def input_arguments_decorator(func):
     def wrapper(*args, **kwargs):
         print(f"""Input decor: args {args}, kwargs {kwargs}""")
         result = func(*args, **kwargs)
+        return result
 
     return wrapper
 
@@ -36,11 +41,13 @@ def runtime_decorator(func):
     # print("===runtime_decorator begin")
 
     def wrapper(*args, **dwargs):
-        print(f"""Runtime Input decor: args {args}, kwargs {dwargs}""")
-        start = datetime.now()
-        result = func(*args, **dwargs)
-        time = datetime.now() - start
-        print(f"""Func runtime: {time.microseconds / 1000}""")
+        # the span of the active metrics records the runtime, the debug log is there for the runs without metrics
+        with span(func.__name__):
+            start = time.perf_counter()
+            result = func(*args, **dwargs)
+            runtime = time.perf_counter() - start
+        logger.debug("%s runtime: %.3f ms", func.__name__, runtime * 1000)
+        return result
 
     return wrapper
 
@@ -0,0 +1,123 @@
+import os
+import re
+import time
+from typing import List, Optional
+
+
+def glob_regex(pattern):
+    """
+    Translate the gitignore-style glob into a regular expression: "*" and "?" don't cross the path separator,
+    "**" does, "[...]" is a character class ("[!...]" negated)
+    :param pattern: glob without the leading "!" and the trailing "/"
+    :return: compiled regular expression matching the whole string
+    """
+    parts: List = []
+    index = 0
+    while index < len(pattern):
+        if pattern.startswith("**/", index):
+            parts.append("(?:.*/)?")
+            index += 3
+        elif pattern.startswith("**", index):
+            parts.append(".*")
+            index += 2
+        elif pattern[index] == "*":
+            parts.append("[^/]*")
+            index += 1
+        elif pattern[index] == "?":
+            parts.append("[^/]")
+            index += 1
+        elif pattern[index] == "[" and "]" in pattern[index + 2:]:
+            class_end = pattern.index("]", index + 2)
+            char_class = pattern[index + 1:class_end]
+            if char_class.startswith("!"):
+                char_class = "^" + char_class[1:]
+            parts.append("[" + char_class.replace("\\", "\\\\") + "]")
+            index = class_end + 1
+        else:
+            parts.append(re.escape(pattern[index]))
+            index += 1
+    return re.compile("".join(parts) + r"\Z")
+
+
+class ExclusionRule:
+    def __init__(self, pattern):
+        # "!" includes back what the previous rules excluded
+        self.negate = pattern.startswith("!")
+        pattern = pattern[1:] if self.negate else pattern
+        # trailing "/" matches only directories
+        self.dir_only = pattern.endswith("/")
+        pattern = pattern.rstrip("/")
+        if pattern.startswith("**/") and "/" not in pattern[3:]:
+            pattern = pattern[3:]
+        # pattern with a separator is matched against the path relative to the root, otherwise against the name
+        self.anchored = "/" in pattern
+        self.pattern = pattern.lstrip("/")
+        self.regex = glob_regex(self.pattern)
+        self.literal = not self.anchored and not any(char in self.pattern for char in "*?[")
+
+
+class ExclusionRules:
+    """
+    Exclusion rules compiled once for the whole walk. The name rules are gitignore-style globs, the last
+    matching rule wins; excluded directories are never listed, so nothing below them can be included back.
+    The size and age filters are checked only for the files which passed the name rules, after their stat
+    """
+    def __init__(self, patterns, max_size: Optional[int] = None, max_age: Optional[float] = None, root="/"):
+        """
+        :param patterns: list of the gitignore-style globs, empty lines and "#" comments are skipped
+        :param max_size: files bigger than this amount of bytes are excluded
+        :param max_age: files not modified for more than this amount of seconds are excluded
+        :param root: full name of the folder the anchored patterns are relative to
+        """
+        self.rules = [ExclusionRule(pattern.strip()) for pattern in patterns
+                      if pattern.strip() and not pattern.strip().startswith("#")]
+        self.max_size = max_size
+        self.max_age = max_age
+        self.root = os.path.abspath(root)
+        # without negations a plain name is answered by the set lookup alone
+        self.has_negations = any(rule.negate for rule in self.rules)
+        self.literal_names = {rule.pattern for rule in self.rules if rule.literal and not rule.dir_only}
+        self.literal_dir_names = {rule.pattern for rule in self.rules if rule.literal and rule.dir_only}
+        self.pattern_rules = self.rules if self.has_negations else [rule for rule in self.rules if not rule.literal]
+
+    def relative_path(self, abs_item):
+        rel_path = os.path.relpath(abs_item, self.root)
+        return None if rel_path.startswith("..") else rel_path.replace(os.sep, "/")
+
+    def name_excluded(self, abs_item, name, is_dir):
+        """
+        :param abs_item: full name of the entry
+        :param name: last component of the full name
+        :param is_dir: flag of the directory entry
+        :return: True if the name rules exclude the entry
+        """
+        if not self.has_negations and (name in self.literal_names or (is_dir and name in self.literal_dir_names)):
+            return True
+        excluded = False
+        rel_path = None
+        for rule in self.pattern_rules:
+            # only the rules of the opposite kind can change the result
+            if rule.negate != excluded or (rule.dir_only and not is_dir):
+                continue
+            if rule.anchored:
+                if rel_path is None:
+                    rel_path = self.relative_path(abs_item) or ""
+                target = rel_path
+            else:
+                target = name
+            if rule.regex.match(target):
+                excluded = not rule.negate
+        return excluded
+
+    def file_excluded(self, size, modify_timestamp):
+        """
+        :param size: size of the file in bytes, None if unknown
+        :param modify_timestamp: modification time of the file in seconds since the epoch
+        :return: True if the size or the age filter excludes the file
+        """
+        if self.max_size is not None and size is not None and size > self.max_size:
+            return True
+        return self.max_age is not None and time.time() - modify_timestamp > self.max_age
+
+    def stat_excluded(self, item_stat):
+        return self.file_excluded(item_stat.st_size, item_stat.st_mtime)
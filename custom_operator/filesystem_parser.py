@@ -1,80 +1,291 @@
 import os
+import stat
+import heapq
 from uuid import uuid4
 from datetime import datetime
-from custom_operator.core_objects import DBFile, DBFolder
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from custom_operator.instrumentation import incr
+from custom_operator.exclusion_rules import ExclusionRules
 
 HOME_FOLDER = os.path.abspath("/opt/airflow/root_folder")
+# default size of the thread pool used to list directories in parallel
+SCAN_WORKERS = min(32, (os.cpu_count() or 1) + 4)
+# gitignore-style globs of the entries which are not monitored (see ExclusionRules)
+EXCLUDED_PATTERNS = ["venv/", ".idea/", "__pycache__/"]
+# rules of the current walks, see configure_exclusions
+exclusion_rules = ExclusionRules(EXCLUDED_PATTERNS, root=HOME_FOLDER)
 
 
-def populate_struct(cur_dir, out_struct):
+def entry_record(abs_item, is_dir, item_stat):
     """
-    Retrieve the structure of the directory and save it as dictionary
-    :param cur_dir: full name of the current directory
-    :param out_struct: output dictionary
+    Build the record of a filesystem entry from its already retrieved stat
+    :param abs_item: full name of the entry
+    :param is_dir: flag of the directory entry
+    :param item_stat: os.stat_result of the entry
+    :return: dictionary with the entry attributes
+    """
+    return {
+        "ID": str(uuid4()),
+        "FileName": abs_item,
+        "IsDirectory": is_dir,
+        "CreateDate": item_stat.st_ctime,
+        "ModifyDate": item_stat.st_mtime,
+        "Size": item_stat.st_size,
+        "Inode": item_stat.st_ino,
+        "Device": item_stat.st_dev
+    }
+
+
+def path_depth(abs_item):
+    """
+    :param abs_item: full name of the entry
+    :return: amount of the path components, stored as the depth of the entry
+    """
+    return abs_item.count(os.sep)
+
+
+def subtree_bounds(abs_dir):
+    """
+    Range of the full names of all entries below the directory, used to query the name indexes
+    :param abs_dir: full name of the subtree root
+    :return: tuple of the inclusive start and exclusive end of the range
+    """
+    # the character following the separator closes the range of "abs_dir/..." names
+    return abs_dir + os.sep, abs_dir + chr(ord(os.sep) + 1)
+
+
+def configure_exclusions(patterns=None, max_size=None, max_age=None, root=HOME_FOLDER):
+    """
+    Compile the exclusion rules used by the following walks
+    :param patterns: list of the gitignore-style globs, None for EXCLUDED_PATTERNS
+    :param max_size: files bigger than this amount of bytes are excluded
+    :param max_age: files not modified for more than this amount of seconds are excluded
+    :param root: full name of the folder the anchored patterns are relative to
     :return: None
     """
-    abs_dir = os.path.abspath(cur_dir)
+    global exclusion_rules
+    exclusion_rules = ExclusionRules(EXCLUDED_PATTERNS if patterns is None else patterns, max_size, max_age, root)
+
+
+def is_excluded(abs_item, is_dir=True):
+    """
+    :return: True if the name rules exclude the entry
+    """
+    return exclusion_rules.name_excluded(abs_item, os.path.basename(abs_item), is_dir)
+
+
+def scan_dir(abs_dir):
+    """
+    List a single directory, issuing at most one (cached) stat call per entry
+    :param abs_dir: full name of the directory
+    :return: tuple of the entry records, the list of (full name, stat) of subdirectories to descend into
+             and the amount of stat calls issued, all empty if the directory is gone
+    """
+    rules = exclusion_rules
+    records = []
+    sub_dirs = []
+    stat_calls = 0
+    try:
+        dir_it = os.scandir(abs_dir)
+    except (FileNotFoundError, NotADirectoryError):
+        # directory removed or replaced between the listing of its parent and its own
+        return records, sub_dirs, stat_calls
+    with dir_it:
+        for entry in dir_it:
+            try:
+                # is_dir() is answered from the directory listing itself, stat() result is cached by the entry
+                is_dir = entry.is_dir()
+                # excluded entries are dropped by their name before any stat call
+                if rules.name_excluded(entry.path, entry.name, is_dir):
+                    continue
+                entry_stat = entry.stat()
+                stat_calls += 1
+            except FileNotFoundError:
+                # entry vanished between the listing and the stat call (or a dangling symlink)
+                continue
+            if not is_dir and rules.stat_excluded(entry_stat):
+                continue
+            records.append(entry_record(entry.path, is_dir, entry_stat))
+            if is_dir:
+                sub_dirs.append((entry.path, entry_stat))
+    return records, sub_dirs, stat_calls
+
+
+def replay_dir(known_children, trust_dir_mtime):
+    """
+    Rebuild the listing of a directory with unchanged mtime from its known children instead of listing it.
+    Subdirectories are always stat'ed to check their own mtime, files are stat'ed only if the mtime of
+    the directory is not trusted
+    :param known_children: list of the stored children dictionaries (name, is_dir, create_date, modify_date,
+                           size, inode, device)
+    :param trust_dir_mtime: reuse stored dates of the files without any stat call
+    :return: tuple of the entry records, the list of (full name, stat) of subdirectories to descend into
+             and the amount of stat calls issued
+    """
+    rules = exclusion_rules
+    records = []
+    sub_dirs = []
+    stat_calls = 0
+    for child in known_children:
+        # the rules may have changed since the children were stored
+        if rules.name_excluded(child["name"], os.path.basename(child["name"]), child["is_dir"]):
+            continue
+        if trust_dir_mtime and not child["is_dir"]:
+            if rules.file_excluded(child["size"], child["modify_date"].timestamp()):
+                continue
+            records.append({
+                "ID": str(uuid4()),
+                "FileName": child["name"],
+                "IsDirectory": False,
+                "CreateDate": child["create_date"].timestamp(),
+                "ModifyDate": child["modify_date"].timestamp(),
+                "Size": child["size"],
+                "Inode": child["inode"],
+                "Device": child["device"]
+            })
+            continue
+        stat_calls += 1
+        try:
+            child_stat = os.stat(child["name"])
+        except FileNotFoundError:
+            continue
+        if not child["is_dir"] and rules.stat_excluded(child_stat):
+            continue
+        records.append(entry_record(child["name"], child["is_dir"], child_stat))
+        if child["is_dir"]:
+            sub_dirs.append((child["name"], child_stat))
+    return records, sub_dirs, stat_calls
+
 
+def list_dir(abs_dir, dir_stat, known_struct, trust_dir_mtime):
+    """
+    List a directory or replay its known content if neither its mtime nor its child count changed
+    :param abs_dir: full name of the directory
+    :param dir_stat: os.stat_result of the directory
+    :param known_struct: dictionary of the stored folders by name (modify_date, child_count, children), or None
+    :param trust_dir_mtime: see replay_dir
+    :return: tuple of the entry records, the list of (full name, stat) of subdirectories to descend into,
+             the amount of stat calls issued and the flag of the replayed directory
+    """
+    known_dir = known_struct.get(abs_dir) if known_struct is not None else None
+    if known_dir is not None \
+            and known_dir["modify_date"] == datetime.fromtimestamp(dir_stat.st_mtime) \
+            and known_dir["child_count"] == len(known_dir["children"]):
+        return replay_dir(known_dir["children"], trust_dir_mtime) + (True,)
+    return scan_dir(abs_dir) + (False,)
+
+
+def entries_count(abs_dir):
+    """
+    :return: amount of the entries in the directory which pass the name rules, without any stat call,
+             0 if it vanished
+    """
+    rules = exclusion_rules
+    try:
+        with os.scandir(abs_dir) as dir_it:
+            return sum(1 for entry in dir_it if not rules.name_excluded(entry.path, entry.name, entry.is_dir()))
+    except FileNotFoundError:
+        return 0
+
+
+def scan_struct(root_dir, max_workers=SCAN_WORKERS, known_struct=None, trust_dir_mtime=False, max_depth=None):
+    """
+    Walk the directory tree and yield the record of every entry as soon as its directory is listed.
+    Subtrees are listed in parallel by the thread pool, so the order of the records is not defined.
+    If the stored structure is given, directories with unchanged mtime are not listed again (see list_dir)
+    :param root_dir: full name of the root directory
+    :param max_workers: size of the thread pool
+    :param known_struct: dictionary of the stored folders by name for the incremental scan, or None for full scan
+    :param trust_dir_mtime: skip files of unchanged directories entirely (see replay_dir)
+    :param max_depth: amount of the directory levels below the root to list, None for the whole tree.
+                      Records of the directories on the last level get the "ChildCount" key
+    :return: generator of entry records (see entry_record)
+    """
+    abs_dir = os.path.abspath(root_dir)
+    try:
+        root_stat = os.stat(abs_dir)
+    except FileNotFoundError:
+        return
     # something wrong, not a directory
-    if not os.path.isdir(abs_dir):
+    if not stat.S_ISDIR(root_stat.st_mode):
         return
-    out_struct[abs_dir] = {
-        "ID": str(uuid4()),
-        "FileName": abs_dir,
-        "IsDirectory": os.path.isdir(abs_dir),
-        "CreateDate": os.path.getctime(abs_dir),
-        "ModifyDate": os.path.getmtime(abs_dir)
-    }
-    for item in os.listdir(abs_dir):
-        abs_item = os.path.join(abs_dir, item)
-        if os.path.isdir(abs_item) and all(exc_name not in abs_item for exc_name in ["venv", ".idea", "__pycache__"]):
-            populate_struct(abs_item, out_struct)
-        else:
-            out_struct[abs_item] = {
-                "ID": str(uuid4()),
-                "FileName": abs_item,
-                "IsDirectory": os.path.isdir(abs_item),
-                "CreateDate": os.path.getctime(abs_item),
-                "ModifyDate": os.path.getmtime(abs_item)
-            }
-
-
-def populate_db_list(input_frame, cur_row, parent_id, cur_slash_count, root_slash_count, out_list):
-    """
-    Convert frame of directory structure into list of sqlalchemy Base objects
-    :param input_frame: DataFrame of generated file tree
-    :param cur_row: row of current directory
-    :param parent_id: ID of the parent directory (None if root)
-    :param cur_slash_count: amount of slash symbols contained in filename on the current level
-    :param root_slash_count: amount of slash symbols contained in filename on the root level
-    :param out_list: list of Base objects
-    :return: None
+    incr("stat_calls")
+    incr("entries_scanned")
+    yield entry_record(abs_dir, True, root_stat)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        pending = {pool.submit(list_dir, abs_dir, root_stat, known_struct, trust_dir_mtime)}
+        try:
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    records, sub_dirs, stat_calls, replayed = future.result()
+                    # counted by the consuming thread, the metrics are not shared with the pool threads
+                    incr("directories_replayed" if replayed else "directories_listed")
+                    incr("stat_calls", stat_calls)
+                    incr("entries_scanned", len(records))
+                    if max_depth is not None and sub_dirs and \
+                            path_depth(sub_dirs[0][0]) - path_depth(abs_dir) >= max_depth:
+                        # last level, the content is only counted for the child count of the directory
+                        sub_dir_names = {sub_dir for sub_dir, sub_stat in sub_dirs}
+                        for record in records:
+                            if record["FileName"] in sub_dir_names:
+                                record["ChildCount"] = entries_count(record["FileName"])
+                        sub_dirs = []
+                    pending.update(pool.submit(list_dir, sub_dir, sub_stat, known_struct, trust_dir_mtime)
+                                   for sub_dir, sub_stat in sub_dirs)
+                    yield from records
+        finally:
+            # consumer stopped early, don't list the rest of the tree
+            for future in pending:
+                future.cancel()
+
+
+def scan_struct_sorted(root_dir, resume_after=None):
     """
-    out_list.append(
-        DBFolder(id=cur_row["ID"],
-                 foldername=cur_row["FileName"],
-                 description=None,
-                 parent_id=parent_id,
-                 create_date=datetime.fromtimestamp(cur_row["CreateDate"]),
-                 modify_date=datetime.fromtimestamp(cur_row["ModifyDate"]))
-    )
-
-    # select entries with slash count of the lower level
-    next_level = input_frame.loc[input_frame["SlashCount"] == cur_slash_count + 1]
-
-    # select entries that contain the name of the current folder
-    # disable regex to use plain string compare
-    next_level = next_level.loc[next_level["FileName"].str.contains(cur_row["FileName"], regex=False)]
-
-    for index, row in next_level.iterrows():
-        if row["IsDirectory"] == 1:
-            populate_db_list(input_frame, row, cur_row["ID"], cur_slash_count + 1, root_slash_count, out_list)
-        else:
-            out_list.append(
-                DBFile(id=row["ID"],
-                       filename=row["FileName"],
-                       description=None,
-                       folder_id=cur_row["ID"],
-                       create_date=datetime.fromtimestamp(row["CreateDate"]),
-                       modify_date=datetime.fromtimestamp(row["ModifyDate"]))
-            )
+    Walk the directory tree sequentially and yield the records ordered by the full name
+    (plain string order, the same as ORDER BY of SQLite text). Only the not yet visited entries
+    of the directories on the current path are kept in memory.
+    Every record is extended with the ID of the parent record and the child count of the directory
+    :param root_dir: full name of the root directory
+    :param resume_after: yield only the entries after this full name, the directories whose whole subtree
+    precedes it are not listed
+    :return: generator of entry records (see entry_record) with "ParentID" and "ChildCount" keys
+    """
+    abs_dir = os.path.abspath(root_dir)
+    try:
+        root_stat = os.stat(abs_dir)
+    except FileNotFoundError:
+        return
+    # something wrong, not a directory
+    if not stat.S_ISDIR(root_stat.st_mode):
+        return
+
+    # heap of (full name, descend flag, record); children of the popped entry are always greater than it,
+    # so the entries are popped in the sorted order
+    pending = [(abs_dir, True, entry_record(abs_dir, True, root_stat))]
+    pending[0][2]["ParentID"] = None
+    incr("stat_calls")
+    incr("entries_scanned")
+    while pending:
+        abs_item, descend, record = heapq.heappop(pending)
+        # the entries up to the resume point are skipped, their subtree is listed only if the point is inside of it
+        skipped = resume_after is not None and abs_item <= resume_after
+        if skipped and subtree_bounds(abs_item)[1] <= resume_after:
+            descend = False
+        record["ChildCount"] = 0 if record["IsDirectory"] else None
+        if descend:
+            # a directory removed since its parent was listed is yielded without children
+            records, sub_dirs, stat_calls = scan_dir(abs_item)
+            incr("directories_listed")
+            incr("stat_calls", stat_calls)
+            incr("entries_scanned", len(records))
+            record["ChildCount"] = len(records)
+            sub_dir_names = {sub_dir for sub_dir, sub_stat in sub_dirs}
+            for child_record in records:
+                child_record["ParentID"] = record["ID"]
+                heapq.heappush(pending,
+                               (child_record["FileName"], child_record["FileName"] in sub_dir_names, child_record))
+        if not skipped:
+            yield record
+
@@ -0,0 +1,243 @@
+import os
+import pandas
+from typing import Dict, List
+
+from sqlalchemy import select, update, insert, delete, bindparam, case, or_, TIMESTAMP
+
+from custom_operator.core_objects import DBFile, DBFolder, DBFolderStats, DBPath
+from custom_operator.database_initialization import get_engine, stage_keys
+from custom_operator.filesystem_parser import path_depth
+from custom_operator.instrumentation import incr
+
+# amount of the rollup rows inserted at once by the rebuild
+STATS_CHUNK_SIZE = 50000
+
+
+def ancestor_names(name):
+    """
+    :param name: full name of the entry
+    :return: generator of the full names of the folders above the entry, up to the filesystem root
+    """
+    parent = os.path.dirname(name)
+    while parent != name:
+        yield parent
+        name, parent = parent, os.path.dirname(parent)
+
+
+def stats_delta_add(deltas, folder_id, file_count, total_size, modify_date=None):
+    """
+    Accumulate a change of the rollups of the folder and of all folders above it
+    :param deltas: dictionary of the folder id to the list of the file count, size and latest date changes
+    :param folder_id: id of the folder, the changes of an unknown folder (None) are skipped
+    :return: None
+    """
+    if folder_id is None or pandas.isna(folder_id):
+        return
+    modify_date = None if modify_date is None or pandas.isna(modify_date) \
+        else pandas.Timestamp(modify_date).to_pydatetime()
+    delta = deltas.setdefault(folder_id, [0, 0, None])
+    delta[0] += file_count
+    delta[1] += 0 if total_size is None or pandas.isna(total_size) else int(total_size)
+    if modify_date is not None and (delta[2] is None or modify_date > delta[2]):
+        delta[2] = modify_date
+
+
+def stats_changes(added_rows, modified_frame, moved_frame, moved_rows, deleted_frame):
+    """
+    Collect the rollup changes of a change set by the parent ids of the entries. A moved or deleted folder
+    takes its whole rollup along, so the entries which move or are deleted together with their parent
+    folder are skipped. The entries of a folder removed by an earlier change set are skipped as well:
+    their parent is no longer stored
+    :param added_rows: (full name, row) tuples of the added entries (see added_entries_handling)
+    :param modified_frame: DataFrame of the modified entries
+    :param moved_frame: DataFrame of the moved entries
+    :param moved_rows: rows to update of the moved entries, in the order of moved_frame
+    :param deleted_frame: DataFrame of the deleted entries
+    :return: dictionary of the "removed" changes (applied before the write, to the old parents),
+             the "carried" folders (id, old parent id and new parent id, None for a deleted folder),
+             deepest first, and the "added" changes (applied after the write, to the new parents)
+    """
+    removed: Dict = {}
+    added: Dict = {}
+    carried: List = []
+    for name, row in added_rows:
+        if isinstance(row, DBFolder):
+            stats_delta_add(added, row.id, 0, 0, row.modify_date)
+        elif isinstance(row, DBFile):
+            stats_delta_add(added, row.folder_id, 1, row.size, row.modify_date)
+
+    for index, entry in modified_frame.iterrows():
+        if entry["is_dir_c"] == 1:
+            stats_delta_add(added, entry["id"], 0, 0, entry["modify_date_c"])
+        else:
+            size_delta = (0 if pandas.isna(entry["size_c"]) else int(entry["size_c"])) \
+                - (0 if pandas.isna(entry["size"]) else int(entry["size"]))
+            stats_delta_add(added, entry["parent_id"], 0, size_delta, entry["modify_date_c"])
+
+    moved_ids = set(moved_frame["id"])
+    for (index, entry), row in zip(moved_frame.iterrows(), moved_rows):
+        new_parent_id = row["columns"]["parent_id" if entry["is_dir_c"] == 1 else "folder_id"]
+        if entry["parent_id"] in moved_ids and new_parent_id == entry["parent_id"]:
+            continue
+        if entry["is_dir_c"] == 1:
+            carried.append((path_depth(entry["name"]), entry["id"], entry["parent_id"], new_parent_id))
+            stats_delta_add(added, entry["id"], 0, 0, entry["modify_date_c"])
+        else:
+            stats_delta_add(removed, entry["parent_id"], 1, entry["size"])
+            stats_delta_add(added, new_parent_id, 1, entry["size_c"], entry["modify_date_c"])
+
+    deleted_ids = set(deleted_frame["id"])
+    for index, entry in deleted_frame.iterrows():
+        if entry["parent_id"] in deleted_ids:
+            continue
+        if entry["is_dir"] == 1:
+            carried.append((path_depth(entry["name"]), entry["id"], entry["parent_id"], None))
+        else:
+            stats_delta_add(removed, entry["parent_id"], 1, entry["size"])
+
+    # a folder moved out of a moved or deleted one leaves its parent before the parent rollup is carried
+    carried.sort(key=lambda folder: folder[0], reverse=True)
+    return {"removed": removed,
+            "carried": [folder[1:] for folder in carried],
+            "added": added}
+
+
+def folder_chains(conn, folder_ids):
+    """
+    :param conn: connection with an open transaction
+    :param folder_ids: ids of the folders
+    :return: list of the pairs of a folder id and the id of the folder itself or of a stored folder above it
+    """
+    stage_table = stage_keys(conn, "stage_stats_folders", folder_ids)
+    chain = select(stage_table.c.key.label("start_id"), stage_table.c.key.label("folder_id")) \
+        .cte("chain", recursive=True)
+    chain = chain.union_all(select(chain.c.start_id, DBFolder.parent_id)
+                            .join(DBFolder, DBFolder.id == chain.c.folder_id)
+                            .where(DBFolder.parent_id.is_not(None)))
+    chains = conn.execute(select(chain.c.start_id, chain.c.folder_id)
+                          .join(DBFolder, DBFolder.id == chain.c.folder_id)).all()
+    stage_table.drop(conn)
+    return chains
+
+
+def stats_apply(conn, deltas, sign=1):
+    """
+    Add the changes to the rollups of the folders and of all stored folders above them
+    :param conn: connection with an open transaction
+    :param deltas: dictionary of the folder id to the changes (see stats_delta_add)
+    :param sign: -1 to subtract the counts and the sizes
+    :return: amount of the updated rollups
+    """
+    if not deltas:
+        return 0
+    folder_deltas: Dict = {}
+    for start_id, folder_id in folder_chains(conn, deltas.keys()):
+        file_count, total_size, modify_date = deltas[start_id]
+        stats_delta_add(folder_deltas, folder_id, sign * file_count, sign * total_size, modify_date)
+
+    stats_rows = [{"b_folder_id": folder_id, "b_file_count": delta[0], "b_total_size": delta[1],
+                   "b_latest_modify_date": delta[2]}
+                  for folder_id, delta in folder_deltas.items()]
+    if not stats_rows:
+        return 0
+    # the new folders start with the empty rollup
+    conn.execute(insert(DBFolderStats).prefix_with("OR IGNORE"),
+                 [{"folder_id": row["b_folder_id"], "file_count": 0, "total_size": 0, "latest_modify_date": None}
+                  for row in stats_rows])
+    latest_modify_date = bindparam("b_latest_modify_date", type_=TIMESTAMP)
+    conn.execute(update(DBFolderStats)
+                 .where(DBFolderStats.folder_id == bindparam("b_folder_id"))
+                 .values(file_count=DBFolderStats.file_count + bindparam("b_file_count"),
+                         total_size=DBFolderStats.total_size + bindparam("b_total_size"),
+                         latest_modify_date=case((or_(DBFolderStats.latest_modify_date.is_(None),
+                                                      DBFolderStats.latest_modify_date < latest_modify_date),
+                                                  latest_modify_date),
+                                                 else_=DBFolderStats.latest_modify_date)),
+                 stats_rows)
+    incr("folder_stats_updated", len(stats_rows))
+    return len(stats_rows)
+
+
+def stats_before_write(conn, changes):
+    """
+    Take the leaving entries and the carried folders out of the rollups of their old parents,
+    the parents are resolved before the moves and the deletes
+    :param conn: connection with an open transaction
+    :param changes: rollup changes of the change set (see stats_changes)
+    :return: dictionary of the rollups of the moved folders by their new parent ids, to add after the write
+    """
+    stats_apply(conn, changes["removed"], sign=-1)
+    carried_deltas: Dict = {}
+    for folder_id, old_parent_id, new_parent_id in changes["carried"]:
+        rollup = conn.execute(select(DBFolderStats.file_count, DBFolderStats.total_size,
+                                     DBFolderStats.latest_modify_date)
+                              .where(DBFolderStats.folder_id == folder_id)).first()
+        if rollup is None:
+            continue
+        stats_apply(conn, {old_parent_id: [rollup.file_count, rollup.total_size, None]}, sign=-1)
+        stats_delta_add(carried_deltas, new_parent_id, rollup.file_count, rollup.total_size,
+                        rollup.latest_modify_date)
+    return carried_deltas
+
+
+def stats_after_write(conn, changes, carried_deltas):
+    """
+    Add the appearing entries and the carried folders to the rollups of their new parents
+    :param conn: connection with an open transaction
+    :param changes: rollup changes of the change set (see stats_changes)
+    :param carried_deltas: rollups of the moved folders (see stats_before_write)
+    :return: amount of the updated rollups
+    """
+    deltas = {folder_id: list(delta) for folder_id, delta in changes["added"].items()}
+    for folder_id, delta in carried_deltas.items():
+        stats_delta_add(deltas, folder_id, *delta)
+    return stats_apply(conn, deltas)
+
+
+def folder_stats_rebuild():
+    """
+    Calculate the rollups of all stored folders from scratch, e.g. for a database loaded before the rollups
+    :return: amount of the rollups
+    """
+    with get_engine().begin() as conn:
+        folders = conn.execute(select(DBFolder.id, DBPath.path, DBFolder.modify_date)
+                               .join(DBPath, DBFolder.path_id == DBPath.id)).all()
+        folder_ids: Dict = {foldername: folder_id for folder_id, foldername, modify_date in folders}
+        rollups: Dict = {foldername: [0, 0, modify_date] for folder_id, foldername, modify_date in folders}
+        entries = [(foldername, None, modify_date, True) for folder_id, foldername, modify_date in folders]
+        for name, size, modify_date, is_dir in entries + [
+                (filename, size, modify_date, False) for filename, size, modify_date in
+                conn.execute(select(DBPath.path, DBFile.size, DBFile.modify_date)
+                             .join(DBPath, DBFile.path_id == DBPath.id))]:
+            for folder_name in ancestor_names(name):
+                rollup = rollups.get(folder_name)
+                if rollup is None:
+                    continue
+                if not is_dir:
+                    rollup[0] += 1
+                    rollup[1] += size or 0
+                if modify_date is not None and (rollup[2] is None or modify_date > rollup[2]):
+                    rollup[2] = modify_date
+
+        conn.execute(delete(DBFolderStats))
+        stats_rows: List = [{"folder_id": folder_ids[name], "file_count": rollup[0], "total_size": rollup[1],
+                             "latest_modify_date": rollup[2]} for name, rollup in rollups.items()]
+        for chunk_start in range(0, len(stats_rows), STATS_CHUNK_SIZE):
+            conn.execute(insert(DBFolderStats), stats_rows[chunk_start:chunk_start + STATS_CHUNK_SIZE])
+    print(f"Folder stats rebuilt for {len(stats_rows)} folders")
+    return len(stats_rows)
+
+
+def folder_stats(path):
+    """
+    :param path: full name of the folder
+    :return: dictionary of the file count, the total size and the latest modification date of the subtree,
+    None if the folder isn't stored
+    """
+    with get_engine().connect() as conn:
+        row = conn.execute(select(DBFolderStats.file_count, DBFolderStats.total_size,
+                                  DBFolderStats.latest_modify_date)
+                           .join(DBFolder, DBFolder.id == DBFolderStats.folder_id)
+                           .join(DBPath, DBFolder.path_id == DBPath.id)
+                           .where(DBPath.path == os.path.abspath(path))).first()
+    return None if row is None else dict(row._mapping)
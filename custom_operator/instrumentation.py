@@ -0,0 +1,177 @@
+import os
+import json
+import time
+import threading
+from datetime import datetime
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import List, Dict
+
+from sqlalchemy import event
+
+# folder of the metrics files written by the operators
+METRICS_FOLDER = "/opt/airflow/logs/dwh_ex_metrics"
+
+
+def statement_verb(statement):
+    """
+    :return: first keyword of the SQL statement (SELECT, INSERT, ...) after the leading comment lines
+    """
+    for line in statement.splitlines():
+        line = line.strip()
+        if line and not line.startswith("--"):
+            return line.split(None, 1)[0].upper()
+    return "UNKNOWN"
+
+
+class RunMetrics:
+    """
+    Timing spans and counters of a single run. Spans are nested, every span also accumulates
+    the amount and the time of the SQL statements executed inside it. Spans are recorded only in the thread
+    which created the metrics, the worker threads running in its context only count
+    """
+    def __init__(self, name):
+        self.name = name
+        self.root_span: Dict = self.new_span(name)
+        self.span_stack: List = [self.root_span]
+        self.counters: Dict = {}
+        # per statement kind (SELECT, INSERT, ...) amount and time
+        self.sql_statements: Dict = {}
+        self.started = time.perf_counter()
+        self.thread_id = threading.get_ident()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def new_span(name):
+        return {"name": name, "seconds": 0.0, "sql_round_trips": 0, "sql_seconds": 0.0, "children": []}
+
+    @contextmanager
+    def span(self, name):
+        cur_span = self.new_span(name)
+        if threading.get_ident() != self.thread_id:
+            yield cur_span
+            return
+        self.span_stack[-1]["children"].append(cur_span)
+        self.span_stack.append(cur_span)
+        start = time.perf_counter()
+        try:
+            yield cur_span
+        finally:
+            cur_span["seconds"] = round(time.perf_counter() - start, 6)
+            self.span_stack.pop()
+
+    def incr(self, counter, amount=1):
+        with self.lock:
+            self.counters[counter] = self.counters.get(counter, 0) + amount
+
+    def sql_executed(self, statement, seconds):
+        statement_kind = statement_verb(statement)
+        with self.lock:
+            kind_stats = self.sql_statements.setdefault(statement_kind, {"count": 0, "seconds": 0.0})
+            kind_stats["count"] += 1
+            kind_stats["seconds"] += seconds
+            for open_span in self.span_stack:
+                open_span["sql_round_trips"] += 1
+                open_span["sql_seconds"] += seconds
+        self.incr("sql_round_trips")
+
+    def to_dict(self):
+        self.root_span["seconds"] = round(time.perf_counter() - self.started, 6)
+        return {"name": self.name,
+                "spans": self.root_span,
+                "counters": dict(self.counters),
+                "sql_statements": {kind: {"count": stats["count"], "seconds": round(stats["seconds"], 6)}
+                                   for kind, stats in self.sql_statements.items()}}
+
+    def write(self, file_name):
+        os.makedirs(os.path.dirname(os.path.abspath(file_name)), exist_ok=True)
+        with open(file_name, "w") as f:
+            json.dump(self.to_dict(), f, indent=2)
+
+
+active_metrics: ContextVar = ContextVar("active_metrics", default=None)
+
+
+@contextmanager
+def collecting(metrics):
+    """
+    Make the metrics the target of span, incr and the SQL hooks in the current context
+    :param metrics: RunMetrics object
+    :return: generator of the metrics
+    """
+    token = active_metrics.set(metrics)
+    try:
+        yield metrics
+    finally:
+        active_metrics.reset(token)
+
+
+@contextmanager
+def span(name):
+    """
+    Timing span of the active metrics, does nothing if no metrics are collected
+    """
+    metrics = active_metrics.get()
+    if metrics is None:
+        yield None
+        return
+    with metrics.span(name) as cur_span:
+        yield cur_span
+
+
+def incr(counter, amount=1):
+    metrics = active_metrics.get()
+    if metrics is not None:
+        metrics.incr(counter, amount)
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("statement_start", []).append(time.perf_counter())
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    seconds = time.perf_counter() - conn.info["statement_start"].pop()
+    metrics = active_metrics.get()
+    if metrics is not None:
+        metrics.sql_executed(statement, seconds)
+
+
+def install_sql_hooks(engine):
+    """
+    Time every statement executed by the engine into the active metrics
+    :param engine: sqlalchemy Engine
+    :return: None
+    """
+    if not event.contains(engine, "before_cursor_execute", before_cursor_execute):
+        event.listen(engine, "before_cursor_execute", before_cursor_execute)
+        event.listen(engine, "after_cursor_execute", after_cursor_execute)
+
+
+def metrics_file_name(task_id, run_id=None, metrics_folder=METRICS_FOLDER):
+    run_label = run_id or datetime.now().strftime("%Y%m%dT%H%M%S%f")
+    safe_label = "".join(char if char.isalnum() or char in "-_." else "_" for char in f"{task_id}__{run_label}")
+    return os.path.join(metrics_folder, f"{safe_label}.json")
+
+
+def publish_metrics(metrics, context, task_id, metrics_folder=METRICS_FOLDER):
+    """
+    Push the metrics of the task run to XCom (key "run_metrics") and write them to the metrics file
+    :param metrics: RunMetrics object
+    :param context: Airflow task context
+    :param task_id: id of the task, part of the metrics file name
+    :param metrics_folder: folder of the metrics file, None to skip the file
+    :return: name of the written metrics file or None
+    """
+    metrics_dict = metrics.to_dict()
+    ti = context.get("ti") if context else None
+    if ti is not None:
+        ti.xcom_push(key="run_metrics", value=metrics_dict)
+    if metrics_folder is None:
+        return None
+    file_name = metrics_file_name(task_id, context.get("run_id") if context else None, metrics_folder)
+    try:
+        metrics.write(file_name)
+    except OSError as e:
+        print(f"Failed to write metrics file {file_name}: {e}")
+        return None
+    return file_name
@@ -0,0 +1,54 @@
+from typing import Dict
+
+from sqlalchemy import select, insert
+
+from custom_operator.core_objects import DBPath
+from custom_operator.database_initialization import stage_keys
+
+
+def paths_intern(conn, paths):
+    """
+    Integer keys of the full names, the names seen for the first time are added to the dictionary
+    :param conn: connection with an open transaction
+    :param paths: iterable of the full names
+    :return: dictionary of the full name to its path id
+    """
+    paths = set(paths)
+    if not paths:
+        return {}
+    stage_table = stage_keys(conn, "stage_paths", paths)
+    conn.execute(insert(DBPath).prefix_with("OR IGNORE").from_select(["path"], select(stage_table.c.key)))
+    path_ids = dict(conn.execute(
+        select(DBPath.path, DBPath.id).join(stage_table, DBPath.path == stage_table.c.key)).all())
+    stage_table.drop(conn)
+    return path_ids
+
+
+def paths_lookup(conn, paths):
+    """
+    Integer keys of the known full names, the dictionary is left as is
+    :param conn: connection
+    :param paths: iterable of the full names
+    :return: dictionary of the known full name to its path id, unknown names are missing
+    """
+    paths = set(paths)
+    if not paths:
+        return {}
+    stage_table = stage_keys(conn, "stage_paths", paths)
+    path_ids = dict(conn.execute(
+        select(DBPath.path, DBPath.id).join(stage_table, DBPath.path == stage_table.c.key)).all())
+    stage_table.drop(conn)
+    return path_ids
+
+
+def path_ids_assign(conn, named_rows):
+    """
+    Set path_id of the new DBFolder, DBFile and DBFileVersion objects from their full names
+    :param conn: connection with an open transaction
+    :param named_rows: list of (full name, object) tuples of the objects to insert
+    :return: list of the objects
+    """
+    path_ids: Dict = paths_intern(conn, {name for name, data_object in named_rows})
+    for name, data_object in named_rows:
+        data_object.path_id = path_ids[name]
+    return [data_object for name, data_object in named_rows]
@@ -0,0 +1,93 @@
+import threading
+from queue import Queue, Empty, Full
+from contextvars import copy_context
+from typing import List
+
+from custom_operator.structure_monitoring import changes_prepare, changes_write
+from custom_operator.instrumentation import span, incr
+
+# max amount of the change batches waiting for the writer
+PIPELINE_QUEUE_SIZE = 4
+# seconds between the checks of the stop flag while a thread waits for the queue
+QUEUE_POLL_INTERVAL = 0.1
+
+
+def queue_put(target_queue, item, stopped):
+    """
+    Put the item into the bounded queue unless the pipeline is stopped
+    :return: True if the item is queued
+    """
+    while not stopped.is_set():
+        try:
+            target_queue.put(item, timeout=QUEUE_POLL_INTERVAL)
+            return True
+        except Full:
+            continue
+    return False
+
+
+def queue_get(source_queue, stopped):
+    """
+    :return: next item of the queue, None if the pipeline is stopped
+    """
+    while not stopped.is_set():
+        try:
+            return source_queue.get(timeout=QUEUE_POLL_INTERVAL)
+        except Empty:
+            continue
+    return None
+
+
+def pipelined_changes_apply(change_batches, cur_date, queue_size=PIPELINE_QUEUE_SIZE, checkpoint=None):
+    """
+    Apply the change batches through the pipeline: the producer thread pulls the batches (the scan and the diff
+    run inside the iterable) into the bounded queue, the calling thread is the single writer which prepares
+    and writes one batch after another in the order of the batches. The scan and the diff of the next batches
+    run while the current one is written; every batch is prepared after the earlier ones are written,
+    so the parents moved by them are resolved from the stored state
+    :param change_batches: iterable of (added, modified, deleted, last_name) tuples, e.g. struct_changes_stream
+    :param cur_date: current date to set in versions
+    :param queue_size: max amount of the batches waiting for the writer
+    :param checkpoint: run ledger columns (see run_save), every batch commits them with its last_name
+    and the total batch count, None if the run isn't checkpointed
+    :return: amount of the written batches
+    """
+    change_queue: Queue = Queue(maxsize=queue_size)
+    stopped = threading.Event()
+    errors: List = []
+
+    def produce():
+        try:
+            for change_batch in change_batches:
+                incr("stream_batches")
+                if not queue_put(change_queue, change_batch, stopped):
+                    return
+        except Exception as e:
+            errors.append(e)
+        finally:
+            queue_put(change_queue, None, stopped)
+
+    # the producer runs in its own copy of the context, so it counts into the active metrics
+    producer = threading.Thread(target=copy_context().run, args=(produce,), name="pipeline-producer", daemon=True)
+    producer.start()
+
+    batch_count = 0
+    try:
+        while True:
+            change_batch = queue_get(change_queue, stopped)
+            if change_batch is None:
+                break
+            added_frame, modified_frame, deleted_frame, last_name = change_batch
+            with span("changes_prepare"):
+                write_batch = changes_prepare(added_frame, modified_frame, deleted_frame, cur_date)
+            batch_count += 1
+            batch_checkpoint = None if checkpoint is None else \
+                {**checkpoint, "last_name": last_name, "batch_count": checkpoint.get("batch_count", 0) + batch_count}
+            with span("changes_write"):
+                changes_write(write_batch, cur_date, batch_checkpoint)
+    finally:
+        stopped.set()
+        producer.join()
+    if errors:
+        raise errors[0]
+    return batch_count
@@ -0,0 +1,116 @@
+import os
+from datetime import datetime, timedelta
+
+from sqlalchemy import inspect, select, update, or_
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from custom_operator.core_objects import DBMonitoringRun
+from custom_operator.database_initialization import get_engine
+
+# change sets of the runs are kept here until they are applied
+RUN_STAGING_FOLDER = "/opt/airflow/staging/runs"
+# discovered: the change set is staged, applying: the stream batches are committed up to the checkpoint,
+# finished: every change of the run is committed
+RUN_STATUSES = ["discovered", "applying", "finished"]
+# unfinished runs not updated for this long are not retried anymore, their staged change sets are removed
+STALE_RUN_AGE = timedelta(days=2)
+
+
+def run_key_of(context, task_id):
+    """
+    :param context: Airflow context of the task
+    :param task_id: id of the task
+    :return: key of the run in the ledger, None outside of a DAG run (the run isn't checkpointed)
+    """
+    if "run_id" not in context:
+        return None
+    dag_id = context["dag"].dag_id if "dag" in context else ""
+    return f"{dag_id}.{task_id}.{context['run_id']}"
+
+
+def run_load(run_key):
+    """
+    :param run_key: key of the run (see run_key_of)
+    :return: ledger row of the run, None if the run wasn't started before
+    """
+    engine = get_engine()
+    if not inspect(engine).has_table(DBMonitoringRun.__tablename__):
+        return None
+    with engine.connect() as conn:
+        return conn.execute(select(DBMonitoringRun).where(DBMonitoringRun.run_key == run_key)).first()
+
+
+def run_save(conn, run_key, status, cur_date, **columns):
+    """
+    Insert or update the ledger row of the run, usually in the transaction of the changes it checkpoints
+    :param conn: connection with an open transaction
+    :param run_key: key of the run
+    :param status: status of the run (see RUN_STATUSES)
+    :param cur_date: version date of the run
+    :param columns: other columns of the checkpoint, the omitted ones keep their values
+    :return: None
+    """
+    if status not in RUN_STATUSES:
+        raise Exception(f"Unknown run status {status}")
+    update_date = datetime.now()
+    run_upsert = sqlite_insert(DBMonitoringRun).values(
+        run_key=run_key, status=status, cur_date=cur_date, start_date=update_date, update_date=update_date,
+        **{"batch_count": 0, **columns})
+    conn.execute(run_upsert.on_conflict_do_update(
+        index_elements=[DBMonitoringRun.run_key],
+        set_={column: run_upsert.excluded[column] for column in ["status", "update_date"] + list(columns)}))
+
+
+def run_checkpoint(run_key, status, cur_date, **columns):
+    """
+    Save the ledger row of the run in its own transaction (see run_save)
+    """
+    with get_engine().begin() as conn:
+        run_save(conn, run_key, status, cur_date, **columns)
+
+
+def staging_file_remove(staging_file):
+    if staging_file is not None and os.path.exists(staging_file):
+        os.remove(staging_file)
+
+
+def stale_runs_cleanup(staging_folder=RUN_STAGING_FOLDER, stale_age=STALE_RUN_AGE, cur_date=None):
+    """
+    Remove the staged change sets nothing will apply: the files of the finished runs, of the stale runs
+    (unfinished and not updated for stale_age) and the files of the staging folder older than stale_age
+    which no run refers to (the try died before the run was checkpointed). The runs forget their files,
+    a stale run retried after all scans the tree again
+    :param staging_folder: folder of the staged change sets of the runs
+    :param stale_age: timedelta after which an unfinished run is stale
+    :param cur_date: current date
+    :return: amount of the removed files
+    """
+    engine = get_engine()
+    if not inspect(engine).has_table(DBMonitoringRun.__tablename__):
+        return 0
+    stale_date = (cur_date or datetime.now()) - stale_age
+    removed_count = 0
+    with engine.begin() as conn:
+        stale_runs = conn.execute(
+            select(DBMonitoringRun.run_key, DBMonitoringRun.staging_file)
+            .where(DBMonitoringRun.staging_file.is_not(None),
+                   or_(DBMonitoringRun.status == "finished", DBMonitoringRun.update_date < stale_date))).all()
+        for run_key, staging_file in stale_runs:
+            if os.path.exists(staging_file):
+                os.remove(staging_file)
+                removed_count += 1
+            conn.execute(update(DBMonitoringRun).where(DBMonitoringRun.run_key == run_key).values(staging_file=None))
+        referenced_files = set(conn.execute(select(DBMonitoringRun.staging_file)
+                                            .where(DBMonitoringRun.staging_file.is_not(None))).scalars())
+
+    if os.path.isdir(staging_folder):
+        for entry in os.scandir(staging_folder):
+            try:
+                if entry.is_file() and entry.path not in referenced_files and \
+                        datetime.fromtimestamp(entry.stat().st_mtime) < stale_date:
+                    os.remove(entry.path)
+                    removed_count += 1
+            except FileNotFoundError:
+                # removed by the cleanup of a concurrent run
+                continue
+    return removed_count
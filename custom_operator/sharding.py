@@ -0,0 +1,156 @@
+import os
+import heapq
+import pandas
+from uuid import uuid4
+from typing import List, Dict
+
+from sqlalchemy import select, func
+
+from custom_operator.core_objects import DBFile, DBFolder, DBPath
+from custom_operator.database_initialization import get_engine
+from custom_operator.db_init import model_creation
+from custom_operator.filesystem_parser import HOME_FOLDER, path_depth, subtree_bounds, is_excluded, entries_count
+from custom_operator.structure_monitoring import struct_changes_discovery, changes_apply, DIFF_COLUMNS
+from custom_operator.run_ledger import staging_file_remove
+from custom_operator.instrumentation import span, incr
+
+# default amount of the subtree shards, the root level shard is added on top of them
+SHARD_COUNT = 4
+# folder shared by the shard tasks and the merge task
+STAGING_FOLDER = "/opt/airflow/staging"
+CHANGE_KINDS = ["added", "modified", "deleted"]
+
+
+def top_level_dirs(root_folder=HOME_FOLDER):
+    """
+    Directories right below the root, both existing and stored ones, so the subtrees of the
+    removed directories are still compared (and deleted) by their shards
+    :param root_folder: full name of the root folder
+    :return: sorted list of the full names of the directories
+    """
+    abs_root = os.path.abspath(root_folder)
+    dir_names = set()
+    try:
+        with os.scandir(abs_root) as dir_it:
+            dir_names.update(entry.path for entry in dir_it if entry.is_dir())
+    except FileNotFoundError:
+        pass
+
+    subtree_start, subtree_end = subtree_bounds(abs_root)
+    with get_engine().connect() as conn:
+        dir_names.update(conn.execute(
+            select(DBPath.path)
+            .join(DBFolder, DBFolder.path_id == DBPath.id)
+            .where(DBPath.path >= subtree_start, DBPath.path < subtree_end,
+                   DBFolder.depth == path_depth(abs_root) + 1)).scalars())
+    # content of the excluded directories is never scanned
+    return sorted(dir_name for dir_name in dir_names if not is_excluded(dir_name))
+
+
+def subtree_weights(dir_names):
+    """
+    Estimate the size of the subtrees by the stored entry count, subtrees which are not stored yet
+    are estimated by the entry count of their root directory
+    :param dir_names: list of the full names of the subtree roots
+    :return: dictionary of the subtree root to its estimated entry count
+    """
+    weights: Dict = {}
+    with get_engine().connect() as conn:
+        for dir_name in dir_names:
+            subtree_start, subtree_end = subtree_bounds(dir_name)
+            stored_count = 0
+            for entry_class in [DBFolder, DBFile]:
+                stored_count += conn.execute(
+                    select(func.count())
+                    .select_from(DBPath)
+                    .join(entry_class, entry_class.path_id == DBPath.id)
+                    .where(DBPath.path >= subtree_start, DBPath.path < subtree_end)).scalar_one()
+            weights[dir_name] = 1 + (stored_count if stored_count else entries_count(dir_name))
+    return weights
+
+
+def shards_plan(root_folder=HOME_FOLDER, shard_count=SHARD_COUNT):
+    """
+    Split the tree into the shards for the parallel monitoring. The first shard is the root level
+    (the entries right below the root), the rest are the balanced groups of the top level subtrees:
+    the heaviest subtree goes to the lightest shard
+    :param root_folder: full name of the root folder
+    :param shard_count: max amount of the subtree shards
+    :return: list of the operator keyword arguments of the shards ("subtree_roots", "max_depth")
+    """
+    # the planning task runs first, it brings the database up to the current model for the shards
+    model_creation()
+    abs_root = os.path.abspath(root_folder)
+    weights = subtree_weights(top_level_dirs(abs_root))
+
+    shard_heap = [(0, shard_index, []) for shard_index in range(max(1, shard_count))]
+    for dir_name in sorted(weights, key=lambda name: (-weights[name], name)):
+        shard_weight, shard_index, shard_roots = heapq.heappop(shard_heap)
+        shard_roots.append(dir_name)
+        heapq.heappush(shard_heap, (shard_weight + weights[dir_name], shard_index, shard_roots))
+
+    plan: List = [{"subtree_roots": [abs_root], "max_depth": 1}]
+    for shard_weight, shard_index, shard_roots in sorted(shard_heap, key=lambda shard: shard[1]):
+        if shard_roots:
+            print(f"Shard {shard_index}: {len(shard_roots)} subtrees, ~{shard_weight} entries")
+            plan.append({"subtree_roots": shard_roots, "max_depth": None})
+    return plan
+
+
+def subtrees_changes_discovery(subtree_roots, scan_mode="full", content_hash=False, max_depth=None):
+    """
+    struct_changes_discovery of several subtrees
+    :param subtree_roots: list of the full names of the subtree roots
+    :return: tuple of the added, modified and deleted entries DataFrames of all subtrees
+    """
+    changes: Dict = {change_kind: [] for change_kind in CHANGE_KINDS}
+    for subtree_root in subtree_roots:
+        with span(f"subtree {subtree_root}"):
+            subtree_changes = struct_changes_discovery(scan_mode, content_hash, subtree_root, max_depth)
+        for change_kind, change_frame in zip(CHANGE_KINDS, subtree_changes):
+            changes[change_kind].append(change_frame)
+    return tuple(pandas.concat(changes[change_kind], ignore_index=True) if changes[change_kind]
+                 else pandas.DataFrame(columns=DIFF_COLUMNS) for change_kind in CHANGE_KINDS)
+
+
+def changes_stage(added_frame, modified_frame, deleted_frame, staging_folder=STAGING_FOLDER):
+    """
+    Save the change frames of a shard for the merge task
+    :return: full name of the staging file
+    """
+    os.makedirs(staging_folder, exist_ok=True)
+    staging_file = os.path.join(staging_folder, f"changes_{uuid4()}.pkl")
+    pandas.to_pickle(dict(zip(CHANGE_KINDS, [added_frame, modified_frame, deleted_frame])), staging_file)
+    return staging_file
+
+
+def staged_changes_read(staging_file):
+    """
+    :param staging_file: full name of the staging file (see changes_stage)
+    :return: tuple of the added, modified and deleted entries DataFrames
+    """
+    changes = pandas.read_pickle(staging_file)
+    return tuple(changes[change_kind] for change_kind in CHANGE_KINDS)
+
+
+def staged_changes_apply(staging_files, cur_date, checkpoint=None):
+    """
+    Apply the staged changes of the shards one by one through the single writer.
+    Files are applied in the given order, the root level shard goes first, so the new top level
+    folders are stored before their content is attached to them
+    :param staging_files: list of the staging files (see changes_stage)
+    :param cur_date: current date to set in versions
+    :param checkpoint: run ledger columns (see run_save), every shard commits them with the amount of the applied
+    shards; the shards committed by the interrupted try are skipped. None if the run isn't checkpointed
+    :return: None
+    """
+    applied_count = 0 if checkpoint is None else checkpoint.get("batch_count", 0)
+    for shard_number, staging_file in enumerate(staging_files):
+        if shard_number < applied_count:
+            staging_file_remove(staging_file)
+            continue
+        incr("shards_applied")
+        with span(f"apply {os.path.basename(staging_file)}"):
+            changes_apply(*staged_changes_read(staging_file), cur_date,
+                          None if checkpoint is None else {**checkpoint, "batch_count": shard_number + 1})
+        os.remove(staging_file)
@@ -0,0 +1,47 @@
+from datetime import datetime
+from typing import Optional, List
+
+from custom_operator.sharding import staged_changes_apply
+from custom_operator.run_ledger import run_key_of, run_load, run_checkpoint, staging_file_remove
+from custom_operator.instrumentation import RunMetrics, collecting, publish_metrics, METRICS_FOLDER
+
+from airflow.models.baseoperator import BaseOperator
+
+
+class StructureChangesMergeOperator(BaseOperator):
+    template_fields = ("staging_files",)
+
+    def __init__(self, name: str, staging_files: List[str], metrics_folder: Optional[str] = METRICS_FOLDER,
+                 resumable: bool = True, **kwargs):
+        super().__init__(**kwargs)
+        self.name = name
+        # staging files of the shards in the plan order, usually the output of the mapped monitoring task
+        self.staging_files = staging_files
+        # folder of the run metrics file, None to push the metrics to XCom only
+        self.metrics_folder = metrics_folder
+        # checkpoint every applied shard in the run ledger, a retried task skips the committed shards
+        self.resumable = resumable
+
+    def execute(self, context):
+        metrics = RunMetrics(self.task_id)
+        with collecting(metrics):
+            staging_files = [staging_file for staging_file in self.staging_files if staging_file is not None]
+            run_key = run_key_of(context, self.task_id) if self.resumable else None
+            run = run_load(run_key) if run_key is not None else None
+            if run is not None and run.status == "finished":
+                self.log.info("Run %s is already finished", run_key)
+                # the try which finished the run may have died before removing the applied files
+                for staging_file in staging_files:
+                    staging_file_remove(staging_file)
+            else:
+                cur_date = run.cur_date if run is not None else datetime.now()
+                checkpoint = None if run_key is None else \
+                    {"run_key": run_key, "status": "applying", "batch_count": 0 if run is None else run.batch_count}
+                if run is not None:
+                    self.log.info("Resuming run %s after %d shards", run_key, run.batch_count)
+                staged_changes_apply(staging_files, cur_date, checkpoint)
+                if run_key is not None:
+                    run_checkpoint(run_key, "finished", cur_date, batch_count=len(staging_files))
+                self.log.info("Applied changes of %d shards", len(staging_files))
+        metrics_file = publish_metrics(metrics, context, self.task_id, self.metrics_folder)
+        self.log.info("Run metrics: %s, written to %s", metrics.counters, metrics_file)
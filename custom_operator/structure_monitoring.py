@@ -0,0 +1,703 @@
+import os
+import heapq
+import pandas
+from datetime import datetime
+from typing import List, Dict
+
+from custom_operator.core_objects import DBFile, DBFolder, DBFileVersion, DBFolderStats
+from custom_operator.database_initialization import get_engine, stage_keys, session_scope
+from custom_operator.filesystem_parser import scan_struct, scan_struct_sorted, path_depth, subtree_bounds, \
+    HOME_FOLDER
+from custom_operator.tree_snapshot import TreeSnapshot
+from custom_operator.path_dictionary import paths_intern, paths_lookup, path_ids_assign
+from custom_operator.run_ledger import run_save
+from custom_operator.folder_stats import stats_changes, stats_before_write, stats_after_write
+from custom_operator.instrumentation import span, incr
+
+from sqlalchemy import update, delete, select, and_, bindparam, text, INTEGER
+
+
+# full: list every directory; incremental: don't list directories with unchanged mtime, stat their files;
+# trust_dir_mtime: don't touch files of directories with unchanged mtime at all
+SCAN_MODES = ["full", "incremental", "trust_dir_mtime"]
+# default limit of the bound parameters in one statement of the older SQLite builds
+SQLITE_MAX_VARIABLES = 999
+# columns of the scanned (_c, _p) and stored sides of the diff frames
+DIFF_COLUMNS = ["id_c", "name_c", "description_c", "is_dir_c", "parent_folder_id_c", "create_date_c", "modify_date_c",
+                "child_count_c", "size_c", "inode_c", "device_c", "content_hash_c", "name_p", "description_p",
+                "id", "name", "is_dir", "parent_id", "parent_name", "create_date", "modify_date", "child_count",
+                "size", "inode", "device", "content_hash", "level", "content_changed"]
+
+
+def nullable(value):
+    return None if pandas.isna(value) else value
+
+
+def nullable_int(value):
+    return None if pandas.isna(value) else int(value)
+
+
+# hierarchy of the stored folders and of the stored files below the given subtree root, each ordered by name
+HIERARCHY_QUERY_FILES = [os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "sql", query_file)
+                         for query_file in ("folders_hierarchy.sql", "files_hierarchy.sql")]
+
+
+def struct_list_initialization(known_struct=None, trust_dir_mtime=False, root_folder=HOME_FOLDER, max_depth=None):
+    return TreeSnapshot.from_records(scan_struct(root_folder, known_struct=known_struct,
+                                                 trust_dir_mtime=trust_dir_mtime, max_depth=max_depth))
+
+
+def rows_insert(s, rows_to_insert):
+    """
+    Insert the new rows within the session transaction
+    :param s: session
+    :param rows_to_insert: list of (full name, object) tuples, the names are resolved to path ids
+    :return: None
+    """
+    s.bulk_save_objects(path_ids_assign(s.connection(), rows_to_insert))
+    incr("rows_inserted", len(rows_to_insert))
+
+
+def rows_update(s, rows_to_update):
+    """
+    Update the rows by id within the session transaction
+    :param s: session
+    :param rows_to_update: list of dictionaries with the "id", "is_dir" and "columns" (new values) keys,
+                           the moved entries also have the "path" key of the new full name
+    :return: amount of the executed statements
+    """
+    # the moved entries get the path ids of their new names
+    path_ids = paths_intern(s.connection(), [ur["path"] for ur in rows_to_update if "path" in ur])
+    # group the rows by the target table and the set of updated columns,
+    # every group is sent as a single executemany statement
+    update_groups: Dict = {}
+    for ur in rows_to_update:
+        if "path" in ur:
+            ur["columns"]["path_id"] = path_ids[ur["path"]]
+        group_key = (ur["is_dir"] == 1, tuple(sorted(ur["columns"])))
+        update_groups.setdefault(group_key, []).append({"b_id": ur["id"], **ur["columns"]})
+
+    for (is_dir, columns), group_rows in update_groups.items():
+        table = DBFolder.__table__ if is_dir else DBFile.__table__
+        upd = update(table) \
+            .values({column: bindparam(column) for column in columns}) \
+            .where(table.c.id == bindparam("b_id"))
+        s.connection().execute(upd, group_rows)
+    incr("rows_updated", len(rows_to_update))
+    return len(update_groups)
+
+
+def chunked(items, chunk_size=SQLITE_MAX_VARIABLES):
+    """
+    Split the list into chunks small enough to be bound as parameters of one statement
+    :param items: list to split
+    :param chunk_size: max length of a chunk
+    :return: generator of the list slices
+    """
+    for chunk_start in range(0, len(items), chunk_size):
+        yield items[chunk_start:chunk_start + chunk_size]
+
+
+def rows_delete(s, rows_to_delete):
+    """
+    Delete the files and folders by id within the session transaction
+    :param s: session
+    :param rows_to_delete: list of ids of the files and folders
+    :return: tuple of the amounts of the deleted files and folders and of the executed statements
+    """
+    conn = s.connection()
+    # classify all ids with the single query against the staged ids
+    stage_table = stage_keys(conn, "stage_delete_ids", set(rows_to_delete))
+    folder_id_set = set(conn.execute(
+        select(DBFolder.id).join(stage_table, DBFolder.id == stage_table.c.key)).scalars())
+    stage_table.drop(conn)
+
+    # ID is in the DBFolder, otherwise ID is in the DBFile
+    folder_ids: List = [del_id for del_id in rows_to_delete if del_id in folder_id_set]
+    file_ids: List = [del_id for del_id in rows_to_delete if del_id not in folder_id_set]
+
+    statement_count = 1
+    for ids_chunk in chunked(file_ids):
+        conn.execute(delete(DBFile).where(DBFile.id.in_(ids_chunk)))
+        statement_count += 1
+    for ids_chunk in chunked(folder_ids):
+        conn.execute(delete(DBFolderStats).where(DBFolderStats.folder_id.in_(ids_chunk)))
+        conn.execute(delete(DBFolder).where(DBFolder.id.in_(ids_chunk)))
+        statement_count += 2
+    incr("rows_deleted", len(file_ids) + len(folder_ids))
+    return len(file_ids), len(folder_ids), statement_count
+
+
+def next_versions_read(conn, path_ids):
+    """
+    Calculate the next version labels of the change set from its active versions, nothing is written
+    :param conn: connection
+    :param path_ids: dictionary of the full name to the path id of the known names of the change set
+    :return: dictionary of the full name to the next version label, brand new files (1) are missing
+    """
+    if not path_ids:
+        return {}
+
+    stage_table = stage_keys(conn, "stage_version_keys", set(path_ids.values()), key_type=INTEGER)
+    # read all active versions of the change set
+    cur_active_versions = pandas.read_sql(
+        select(DBFileVersion.path_id, DBFileVersion.version)
+        .join(stage_table, DBFileVersion.path_id == stage_table.c.key)
+        .where(DBFileVersion.is_active == 1), conn)
+    stage_table.drop(conn)
+
+    if cur_active_versions["path_id"].duplicated().any():
+        # something wrong, more than one active version
+        raise Exception("Many active versions of file")
+
+    path_versions: Dict = dict(zip(cur_active_versions["path_id"].astype(int),
+                                   cur_active_versions["version"].astype(int) + 1))
+    return {name: path_versions[path_id] for name, path_id in path_ids.items() if path_id in path_versions}
+
+
+def versions_close(conn, path_ids, cur_date):
+    """
+    Disable the active versions of the change set with the single statement
+    :param conn: connection with an open transaction
+    :param path_ids: iterable of unique path ids of the versions
+    :param cur_date: current date to set as the version end
+    :return: None
+    """
+    stage_table = stage_keys(conn, "stage_version_keys", path_ids, key_type=INTEGER)
+    conn.execute(update(DBFileVersion)
+                 .values({"is_active": False, "version_end": cur_date})
+                 .where(and_(DBFileVersion.path_id.in_(select(stage_table.c.key)),
+                             DBFileVersion.is_active == 1)))
+    stage_table.drop(conn)
+
+
+def known_struct_index(db_struct_frame):
+    """
+    Index the stored structure by folder name for the incremental scan
+    :param db_struct_frame: DataFrame of the stored files and folders hierarchy
+    :return: dictionary of folder name to its modify_date, child_count and list of children
+    """
+    known_struct: Dict = {}
+    for row in db_struct_frame.itertuples(index=False):
+        parent_dir = known_struct.setdefault(row.parent_name,
+                                             {"modify_date": None, "child_count": None, "children": []})
+        parent_dir["children"].append({"name": row.name,
+                                       "is_dir": row.is_dir == 1,
+                                       "create_date": row.create_date.to_pydatetime(),
+                                       "modify_date": row.modify_date.to_pydatetime(),
+                                       "size": nullable_int(row.size),
+                                       "inode": nullable_int(row.inode),
+                                       "device": nullable_int(row.device)})
+        if row.is_dir == 1:
+            cur_dir = known_struct.setdefault(row.name, {"modify_date": None, "child_count": None, "children": []})
+            cur_dir["modify_date"] = row.modify_date.to_pydatetime()
+            cur_dir["child_count"] = nullable_int(row.child_count)
+    return known_struct
+
+
+def hierarchy_queries():
+    """
+    :return: list of the folders and the files hierarchy queries
+    """
+    queries: List = []
+    for query_file in HIERARCHY_QUERY_FILES:
+        with open(query_file, "r") as f:
+            queries.append(text(f.read()))
+    return queries
+
+
+def hierarchy_params(root_folder):
+    subtree_start, subtree_end = subtree_bounds(os.path.abspath(root_folder))
+    return {"subtree_start": subtree_start, "subtree_end": subtree_end}
+
+
+def struct_changes_discovery(scan_mode="full", content_hash=False, root_folder=HOME_FOLDER, max_depth=None):
+    """
+    Compare the subtree on the filesystem with the stored one, the subtree root itself is not compared
+    :param scan_mode: one of SCAN_MODES
+    :param content_hash: detect modifications of the files by the content hash
+    :param root_folder: full name of the subtree root
+    :param max_depth: amount of the levels below the root to compare, None for the whole subtree
+    :return: tuple of the added, modified and deleted entries DataFrames
+    """
+    with span("db_read"), get_engine().connect() as conn:
+        db_struct_frame = pandas.concat([pandas.read_sql(query, conn, params=hierarchy_params(root_folder))
+                                         for query in hierarchy_queries()], ignore_index=True)
+    db_struct_frame = db_struct_frame.astype({"create_date": "datetime64[ns]", "modify_date": "datetime64[ns]"})
+    if max_depth is not None:
+        db_struct_frame = db_struct_frame[db_struct_frame["level"] <= path_depth(os.path.abspath(root_folder)) +
+                                          max_depth]
+    incr("db_entries_read", db_struct_frame.shape[0])
+
+    known_struct = None
+    if scan_mode != "full":
+        known_struct = known_struct_index(db_struct_frame)
+    with span("scan"):
+        snapshot = struct_list_initialization(known_struct, trust_dir_mtime=scan_mode == "trust_dir_mtime",
+                                              root_folder=root_folder, max_depth=max_depth)
+    incr("snapshot_bytes", snapshot.memory_size())
+    if content_hash:
+        with span("content_hash"):
+            # only the scan of the whole tree knows which cached signatures are stale
+            snapshot.content_hashes_fill(prune_cache=max_depth is None and
+                                         os.path.abspath(root_folder) == HOME_FOLDER)
+
+    # the subtree root may be gone, the frame keeps its columns anyway
+    cur_struct_frame = snapshot.to_frame()
+
+    with span("diff"):
+        diff_frame = cur_struct_frame.merge(db_struct_frame, how="outer",
+                                            left_on="name_c", right_on="name",
+                                            suffixes=["_left", "_right"], indicator=True)
+
+        added_entries = diff_frame[diff_frame["_merge"] == "left_only"]
+        deleted_entries = diff_frame[diff_frame["_merge"] == "right_only"]
+        modified_entries = diff_frame[diff_frame["_merge"] == "both"]
+        mtime_changed = modified_entries["modify_date_c"] != modified_entries["modify_date"]
+        if content_hash:
+            # files with known hashes are compared by content, the rest by mtime;
+            # rows with the same content but outdated stored stat or hash are updated without a new version
+            hash_known = modified_entries["content_hash_c"].notna() & modified_entries["content_hash"].notna()
+            hash_changed = \
+                modified_entries["content_hash_c"].fillna("") != modified_entries["content_hash"].fillna("")
+            content_changed = (hash_known & hash_changed) | (~hash_known & mtime_changed)
+            modified_entries = modified_entries.assign(content_changed=content_changed)
+            modified_entries = modified_entries[mtime_changed | hash_changed]
+        else:
+            modified_entries = modified_entries[mtime_changed].assign(content_changed=True)
+
+    # ids are generated only for the added entries and their parents
+    added_entries = added_entries.assign(
+        id_c=[snapshot.entry_id(int(position)) for position in added_entries["index_c"]],
+        parent_folder_id_c=[snapshot.entry_id(int(position)) for position in added_entries["parent_index_c"]])
+    modified_entries = modified_entries.assign(id_c=None, parent_folder_id_c=None)
+    deleted_entries = deleted_entries.assign(id_c=None, parent_folder_id_c=None)
+    return tuple(entries.drop(columns=["index_c", "parent_index_c"])
+                 for entries in [added_entries, modified_entries, deleted_entries])
+
+
+def db_struct_stream(chunk_size, root_folder=HOME_FOLDER):
+    """
+    Read the stored hierarchy ordered by name: the folders and the files are read by two server-side cursors
+    in the order of their name indexes, chunk by chunk, and merged, so nothing is sorted in the database
+    :param chunk_size: amount of rows fetched at once
+    :param root_folder: full name of the subtree root
+    :return: generator of row dictionaries with the dates converted to datetime
+    """
+    # both cursors of the connection read the same snapshot
+    with get_engine().connect() as conn:
+        db_rows = [db_rows_read(conn, query, hierarchy_params(root_folder), chunk_size)
+                   for query in hierarchy_queries()]
+        yield from heapq.merge(*db_rows, key=lambda db_row: db_row["name"])
+
+
+def db_rows_read(conn, query, params, chunk_size):
+    """
+    :return: generator of the rows of the query as dictionaries with the dates converted to datetime
+    """
+    result = conn.execution_options(stream_results=True).execute(query, params)
+    for rows in result.partitions(chunk_size):
+        for row in rows:
+            db_row = dict(row._mapping)
+            db_row["create_date"] = datetime.fromisoformat(db_row["create_date"])
+            db_row["modify_date"] = datetime.fromisoformat(db_row["modify_date"])
+            yield db_row
+
+
+def scanned_entry_columns(record):
+    """
+    Convert the record of the sorted scan to the columns of the scanned side of the diff frames
+    :param record: entry record with the "ParentID" and "ChildCount" keys
+    :return: dictionary of the columns
+    """
+    return {"id_c": record["ID"],
+            "name_c": record["FileName"],
+            "description_c": None,
+            "is_dir_c": record["IsDirectory"],
+            "parent_folder_id_c": record["ParentID"],
+            "create_date_c": datetime.fromtimestamp(record["CreateDate"]),
+            "modify_date_c": datetime.fromtimestamp(record["ModifyDate"]),
+            "child_count_c": record["ChildCount"],
+            "size_c": None if record["IsDirectory"] else record["Size"],
+            "inode_c": record["Inode"],
+            "device_c": record["Device"],
+            "content_hash_c": None,
+            "name_p": os.path.dirname(record["FileName"]),
+            "description_p": None}
+
+
+def changes_batch(added_rows, modified_rows, deleted_rows):
+    return (pandas.DataFrame.from_records(added_rows, columns=DIFF_COLUMNS),
+            pandas.DataFrame.from_records(modified_rows, columns=DIFF_COLUMNS),
+            pandas.DataFrame.from_records(deleted_rows, columns=DIFF_COLUMNS))
+
+
+def struct_changes_stream(batch_size, root_folder=HOME_FOLDER, resume_after=None):
+    """
+    Streaming version of struct_changes_discovery: the sorted scan of the tree is merge-joined
+    against the stored hierarchy read in the same order, so the memory doesn't depend on the tree size
+    :param batch_size: max amount of change events in one batch, also the size of the cursor chunk
+    :param root_folder: full name of the subtree root
+    :param resume_after: compare only the entries after this full name, e.g. the checkpoint of an interrupted run
+    :return: generator of (added_entries, modified_entries, deleted_entries, last_name) batches, every entry
+    up to last_name is compared once the batch is applied
+    """
+    # the root folder is not compared, same as in struct_changes_discovery
+    cur_records = (record for record in scan_struct_sorted(root_folder, resume_after)
+                   if record["ParentID"] is not None)
+    db_rows = (db_row for db_row in db_struct_stream(batch_size, root_folder)
+               if resume_after is None or db_row["name"] > resume_after)
+
+    added_rows: List = []
+    modified_rows: List = []
+    deleted_rows: List = []
+    last_name = resume_after
+    cur_record = next(cur_records, None)
+    db_row = next(db_rows, None)
+    while cur_record is not None or db_row is not None:
+        if db_row is None or (cur_record is not None and cur_record["FileName"] < db_row["name"]):
+            added_rows.append(scanned_entry_columns(cur_record))
+            last_name = cur_record["FileName"]
+            cur_record = next(cur_records, None)
+        elif cur_record is None or db_row["name"] < cur_record["FileName"]:
+            deleted_rows.append(db_row)
+            last_name = db_row["name"]
+            db_row = next(db_rows, None)
+        else:
+            cur_columns = scanned_entry_columns(cur_record)
+            if cur_columns["modify_date_c"] != db_row["modify_date"]:
+                modified_rows.append({**cur_columns, **db_row, "content_changed": True})
+            last_name = db_row["name"]
+            cur_record = next(cur_records, None)
+            db_row = next(db_rows, None)
+
+        if len(added_rows) + len(modified_rows) + len(deleted_rows) >= batch_size:
+            yield changes_batch(added_rows, modified_rows, deleted_rows) + (last_name,)
+            added_rows, modified_rows, deleted_rows = [], [], []
+
+    if added_rows or modified_rows or deleted_rows:
+        yield changes_batch(added_rows, modified_rows, deleted_rows) + (last_name,)
+
+
+def parent_folders_resolution(conn, added_entries_frame, path_ids, scan_ids=None):
+    """
+    Resolve ids of the parent folders of the added (or moved) entries with the single query.
+    Stored folders keep their id, brand new folders use the id generated by the scan
+    :param conn: connection
+    :param added_entries_frame: DataFrame of the added entries
+    :param path_ids: dictionary of the full name to the path id of the known parent names
+    :param scan_ids: dictionary of the scan id to the stored id of the folders added or moved by the change set,
+                     these parents are resolved without the lookup by name (see change_set_scan_ids)
+    :return: Series of parent folder ids aligned with the frame index
+    """
+    scan_parent_ids = added_entries_frame["parent_folder_id_c"].map(scan_ids or {})
+    # a parent name unknown to the path dictionary can't be a stored folder
+    parent_path_ids = added_entries_frame["name_p"].map(path_ids)
+    lookup_path_ids = set(parent_path_ids[scan_parent_ids.isna()].dropna().astype(int))
+    stage_table = stage_keys(conn, "stage_parent_path_ids", lookup_path_ids, key_type=INTEGER)
+    db_parent_entries = pandas.read_sql(
+        select(DBFolder.id, DBFolder.path_id).join(stage_table, DBFolder.path_id == stage_table.c.key), conn)
+    stage_table.drop(conn)
+
+    if db_parent_entries["path_id"].duplicated().any():
+        raise Exception("Many parent folders")
+
+    db_parent_ids = parent_path_ids.map(db_parent_entries.set_index("path_id")["id"])
+    # new parent folder
+    return scan_parent_ids.fillna(db_parent_ids).fillna(added_entries_frame["parent_folder_id_c"])
+
+
+def moves_detection(added_entries_frame, deleted_entries_frame):
+    """
+    Pair the deleted and added entries which are the same filesystem object: the same device, inode
+    and modification date (and the same size and content hash, when both are known, for files).
+    Objects seen more than once on a side (hard links) are not paired
+    :param added_entries_frame: DataFrame of the added entries
+    :param deleted_entries_frame: DataFrame of the deleted entries
+    :return: tuple of the added, moved and deleted entries DataFrames; a moved entry has the scanned columns
+             of its new location and the stored columns of the old one
+    """
+    moved_entries = pandas.DataFrame(columns=DIFF_COLUMNS)
+    if added_entries_frame.empty or deleted_entries_frame.empty:
+        return added_entries_frame, moved_entries, deleted_entries_frame
+
+    scanned_columns = [column for column in DIFF_COLUMNS if column.endswith("_c") or column.endswith("_p")]
+    stored_columns = [column for column in DIFF_COLUMNS if column not in scanned_columns + ["content_changed"]]
+    added_keys = added_entries_frame[scanned_columns].dropna(subset=["device_c", "inode_c"]) \
+        .astype({"device_c": "int64", "inode_c": "int64"}) \
+        .drop_duplicates(["device_c", "inode_c"], keep=False)
+    deleted_keys = deleted_entries_frame[stored_columns].dropna(subset=["device", "inode"]) \
+        .astype({"device": "int64", "inode": "int64"}) \
+        .drop_duplicates(["device", "inode"], keep=False)
+
+    pairs = added_keys.rename_axis("added_index").reset_index() \
+        .merge(deleted_keys.rename_axis("deleted_index").reset_index(),
+               left_on=["device_c", "inode_c"], right_on=["device", "inode"])
+    # a rename keeps the mtime (the ctime changes), a reused inode of a new object has a new mtime
+    is_dir = pairs["is_dir_c"].astype(bool)
+    hashes_known = pairs["content_hash_c"].notna() & pairs["content_hash"].notna()
+    pairs = pairs[(is_dir == (pairs["is_dir"] == 1)) & (is_dir | (pairs["size_c"] == pairs["size"]))
+                  & (pairs["modify_date_c"] == pairs["modify_date"])
+                  & (~hashes_known | (pairs["content_hash_c"] == pairs["content_hash"]))]
+    if pairs.empty:
+        return added_entries_frame, moved_entries, deleted_entries_frame
+
+    moved_entries = pairs.assign(content_changed=False)[DIFF_COLUMNS]
+    return (added_entries_frame.drop(index=pairs["added_index"]),
+            moved_entries,
+            deleted_entries_frame.drop(index=pairs["deleted_index"]))
+
+
+def change_set_scan_ids(added_entries_frame, moved_entries_frame):
+    """
+    :return: dictionary of the scan id to the stored id of the folders added (the scan id is kept)
+             and moved (the stored id is kept) by the change set
+    """
+    scan_ids: Dict = {}
+    added_folders = added_entries_frame[added_entries_frame["is_dir_c"].astype(bool)]
+    scan_ids.update(zip(added_folders["id_c"], added_folders["id_c"]))
+    moved_folders = moved_entries_frame[moved_entries_frame["is_dir_c"].astype(bool)]
+    scan_ids.update(zip(moved_folders["id_c"], moved_folders["id"]))
+    return scan_ids
+
+
+def added_entries_handling(added_entries_frame, cur_date, next_versions, parent_ids):
+    """
+    :return: list of (full name, object) tuples of the new entries and of their versions
+    """
+    data_to_add: List = []
+    if added_entries_frame.empty:
+        return data_to_add
+
+    for index, entry in added_entries_frame.iterrows():
+        parent_id = parent_ids[index]
+
+        if entry["is_dir_c"] == 1:
+            data_row = DBFolder(id=entry["id_c"], description=entry["description_c"], parent_id=parent_id,
+                                create_date=entry["create_date_c"], modify_date=entry["modify_date_c"],
+                                child_count=int(entry["child_count_c"]), inode=nullable_int(entry["inode_c"]),
+                                device=nullable_int(entry["device_c"]), depth=path_depth(entry["name_c"]))
+            data_to_add.append((entry["name_c"], data_row))
+        else:
+            data_row = DBFile(id=entry["id_c"], description=entry["description_c"], folder_id=parent_id,
+                              create_date=entry["create_date_c"], modify_date=entry["modify_date_c"],
+                              size=nullable_int(entry["size_c"]), inode=nullable_int(entry["inode_c"]),
+                              device=nullable_int(entry["device_c"]), content_hash=nullable(entry["content_hash_c"]),
+                              depth=path_depth(entry["name_c"]))
+            data_to_add.append((entry["name_c"], data_row))
+
+        next_version = next_versions.get(entry["name_c"], 1)
+
+        data_row = DBFileVersion(file_id=entry["id_c"], description=entry["description_c"], folder_id=parent_id,
+                                 create_date=entry["create_date_c"], modify_date=entry["modify_date_c"],
+                                 is_active=True, version=next_version, op_type='c', version_start=cur_date,
+                                 version_end=pandas.Timestamp.max)
+        data_to_add.append((entry["name_c"], data_row))
+    return data_to_add
+
+
+def modified_entries_handling(modified_entries_frame, cur_date, next_versions):
+    data_to_update: List = []
+    data_to_add: List = []
+
+    for index, entry in modified_entries_frame.iterrows():
+        update_columns = {"create_date": entry["create_date_c"],
+                          "modify_date": entry["modify_date_c"]
+                          }
+        update_columns["inode"] = nullable_int(entry["inode_c"])
+        update_columns["device"] = nullable_int(entry["device_c"])
+        if entry["is_dir_c"] == 1:
+            update_columns["child_count"] = int(entry["child_count_c"])
+        else:
+            update_columns["size"] = nullable_int(entry["size_c"])
+            update_columns["content_hash"] = nullable(entry["content_hash_c"])
+        data_to_update.append({"id": entry["id"],
+                               "is_dir": entry["is_dir_c"],
+                               "columns": update_columns
+                               })
+
+        # stat refresh only, the content is the same
+        if not entry["content_changed"]:
+            continue
+
+        next_version = next_versions.get(entry["name"], 1)
+
+        data_row = DBFileVersion(file_id=entry["id"], description=entry["description_c"], folder_id=entry["parent_id"],
+                                 create_date=entry["create_date_c"], modify_date=entry["modify_date_c"],
+                                 is_active=True, version=next_version, op_type='m', version_start=cur_date,
+                                 version_end=pandas.Timestamp.max)
+        data_to_add.append((entry["name"], data_row))
+
+    return data_to_update, data_to_add
+
+
+def moved_entries_handling(moved_entries_frame, cur_date, next_versions, parent_ids):
+    """
+    Moved entries keep their id, the stored row is rewritten in place with the new name, parent and stat,
+    one version with the "r" operation is added at the new name
+    :return: tuple of the rows to update (by id) and the (full name, version) tuples to insert
+    """
+    data_to_update: List = []
+    data_to_add: List = []
+    if moved_entries_frame.empty:
+        return data_to_update, data_to_add
+
+    for index, entry in moved_entries_frame.iterrows():
+        parent_id = parent_ids[index]
+        update_columns = {"create_date": entry["create_date_c"],
+                          "modify_date": entry["modify_date_c"],
+                          "inode": nullable_int(entry["inode_c"]),
+                          "device": nullable_int(entry["device_c"]),
+                          "depth": path_depth(entry["name_c"])}
+        if entry["is_dir_c"] == 1:
+            update_columns.update({"parent_id": parent_id,
+                                   "child_count": int(entry["child_count_c"])})
+        else:
+            update_columns.update({"folder_id": parent_id,
+                                   "size": nullable_int(entry["size_c"]),
+                                   "content_hash": nullable(entry["content_hash_c"])})
+        data_to_update.append({"id": entry["id"],
+                               "is_dir": entry["is_dir_c"],
+                               "path": entry["name_c"],
+                               "columns": update_columns
+                               })
+
+        # the version chain of the object continues from its old name
+        next_version = next_versions.get(entry["name"], 1)
+
+        data_row = DBFileVersion(file_id=entry["id"], description=entry["description_c"], folder_id=parent_id,
+                                 create_date=entry["create_date_c"], modify_date=entry["modify_date_c"],
+                                 is_active=True, version=next_version, op_type='r', version_start=cur_date,
+                                 version_end=pandas.Timestamp.max)
+        data_to_add.append((entry["name_c"], data_row))
+    return data_to_update, data_to_add
+
+
+def deleted_entries_handling(deleted_entries_frame, cur_date, next_versions):
+    data_to_delete: List = []
+    data_to_add: List = []
+
+    for index, entry in deleted_entries_frame.iterrows():
+        data_to_delete.append(entry["id"])
+
+        next_version = next_versions.get(entry["name"], 1)
+
+        data_row = DBFileVersion(file_id=entry["id"], description=entry["description_c"], folder_id=entry["parent_id"],
+                                 create_date=entry["create_date"], modify_date=entry["modify_date"], is_active=True,
+                                 version=next_version, op_type='d', version_start=cur_date,
+                                 version_end=pandas.Timestamp.max)
+        data_to_add.append((entry["name"], data_row))
+    return data_to_delete, data_to_add
+
+
+def changes_prepare(added_frame, modified_frame, deleted_frame, cur_date):
+    """
+    Turn the change set into the rows to write: pair the moves, resolve the parent folders and build
+    the version rows. The names are resolved to path ids once, the versions and the parents are read by path id
+    from the stored state, so the earlier change sets must be written before the next one is prepared
+    :param cur_date: current date to set in versions
+    :return: dictionary of the write batch (see changes_write)
+    """
+    added_frame, moved_frame, deleted_frame = moves_detection(added_frame, deleted_frame)
+    scan_ids = change_set_scan_ids(added_frame, moved_frame)
+    incr("entries_added", added_frame.shape[0])
+    incr("entries_modified", modified_frame.shape[0])
+    incr("entries_moved", moved_frame.shape[0])
+    incr("entries_deleted", deleted_frame.shape[0])
+
+    # the active versions of the whole change set are closed at once, moved entries close both names
+    content_changed = modified_frame["content_changed"].astype(bool)
+    rollover_names = set(list(added_frame["name_c"]) + list(modified_frame.loc[content_changed, "name"]) +
+                         list(moved_frame["name"]) + list(moved_frame["name_c"]) + list(deleted_frame["name"]))
+    with get_engine().connect() as conn:
+        # names unknown to the path dictionary have neither versions nor stored folders
+        path_ids = paths_lookup(conn, rollover_names | set(added_frame["name_p"]) | set(moved_frame["name_p"]))
+        next_versions = next_versions_read(conn, {name: path_ids[name] for name in rollover_names
+                                                  if name in path_ids})
+        moved_parent_ids = parent_folders_resolution(conn, moved_frame, path_ids, scan_ids) \
+            if not moved_frame.empty else None
+        added_parent_ids = parent_folders_resolution(conn, added_frame, path_ids, scan_ids) \
+            if not added_frame.empty else None
+
+    data_to_move, moved_versions = moved_entries_handling(moved_frame, cur_date, next_versions, moved_parent_ids)
+    data_to_modify, modified_versions = modified_entries_handling(modified_frame, cur_date, next_versions)
+    data_to_delete, deleted_versions = deleted_entries_handling(deleted_frame, cur_date, next_versions)
+    data_to_add = added_entries_handling(added_frame, cur_date, next_versions, added_parent_ids)
+
+    return {"rollover_path_ids": [path_ids[name] for name in rollover_names if name in path_ids],
+            "folder_stats": stats_changes(data_to_add, modified_frame, moved_frame, data_to_move, deleted_frame),
+            "moved_rows": data_to_move,
+            "moved_versions": moved_versions,
+            "added_rows": data_to_add,
+            "modified_rows": data_to_modify,
+            "modified_versions": modified_versions,
+            "deleted_ids": data_to_delete,
+            "deleted_versions": deleted_versions}
+
+
+def changes_write(write_batch, cur_date, checkpoint=None):
+    """
+    Write the batch prepared by changes_prepare in a single transaction
+    :param write_batch: dictionary of the write batch
+    :param cur_date: current date to set as the end of the closed versions
+    :param checkpoint: dictionary of the run ledger columns (see run_save) committed in the same transaction,
+    None if the run isn't checkpointed
+    :return: dictionary of the amounts of the updated rows, the deleted files and folders and of the statements,
+    also counted by the active metrics
+    """
+    with session_scope() as s:
+        if write_batch["rollover_path_ids"]:
+            with span("versions_rollover"):
+                versions_close(s.connection(), write_batch["rollover_path_ids"], cur_date)
+
+        # the old parents are resolved before the moves and the deletes
+        with span("folder_stats"):
+            carried_stats = stats_before_write(s.connection(), write_batch["folder_stats"])
+
+        # moves go first, the old names are free for the added entries afterwards
+        with span("apply_moved"):
+            update_statements = rows_update(s, write_batch["moved_rows"])
+            rows_insert(s, write_batch["moved_versions"])
+
+        with span("apply_added"):
+            rows_insert(s, write_batch["added_rows"])
+
+        with span("apply_modified"):
+            update_statements += rows_update(s, write_batch["modified_rows"])
+            rows_insert(s, write_batch["modified_versions"])
+
+        with span("apply_deleted"):
+            file_count, folder_count, delete_statements = \
+                rows_delete(s, write_batch["deleted_ids"]) if write_batch["deleted_ids"] else (0, 0, 0)
+            rows_insert(s, write_batch["deleted_versions"])
+
+        # the new parents are resolved once all entries are stored
+        with span("folder_stats"):
+            stats_after_write(s.connection(), write_batch["folder_stats"], carried_stats)
+
+        if checkpoint is not None:
+            run_save(s.connection(), cur_date=cur_date, **checkpoint)
+    write_counts = {"rows_updated": len(write_batch["moved_rows"]) + len(write_batch["modified_rows"]),
+                    "update_statements": update_statements,
+                    "files_deleted": file_count,
+                    "folders_deleted": folder_count,
+                    "delete_statements": delete_statements}
+    for counter in ["update_statements", "files_deleted", "folders_deleted", "delete_statements"]:
+        incr(counter, write_counts[counter])
+    return write_counts
+
+
+def changes_apply(added_frame, modified_frame, deleted_frame, cur_date, checkpoint=None):
+    """
+    Prepare and write the change set in a single transaction (see changes_prepare and changes_write)
+    :return: dictionary of the write amounts (see changes_write)
+    """
+    with span("changes_prepare"):
+        write_batch = changes_prepare(added_frame, modified_frame, deleted_frame, cur_date)
+    return changes_write(write_batch, cur_date, checkpoint)
+
+# if __name__ == "__main__":
+    # added_frame, modified_frame, deleted_frame = struct_changes_discovery()
+
+    # cur_date = datetime.now()
+    # changes_apply(added_frame, modified_frame, deleted_frame, cur_date)
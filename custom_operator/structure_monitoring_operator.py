@@ -1,282 +1,183 @@
-import pandas
+import os
 from datetime import datetime
-from typing import List, Dict
-
-from custom_operator.core_objects import DBFile, DBFolder, DBFileVersion
-from custom_operator.database_initialization import project_engine
-from custom_operator.filesystem_parser import populate_struct, populate_db_list, HOME_FOLDER
-from custom_operator.decorator_helpers import sql_decorator_factory
+from typing import Optional, List
+
+from custom_operator.db_init import model_creation
+from custom_operator.filesystem_parser import HOME_FOLDER, configure_exclusions
+from custom_operator.structure_monitoring import SCAN_MODES, struct_changes_stream, changes_apply
+from custom_operator.pipeline import pipelined_changes_apply
+from custom_operator.sharding import subtrees_changes_discovery, changes_stage, staged_changes_read
+from custom_operator.run_ledger import run_key_of, run_load, run_checkpoint, staging_file_remove, stale_runs_cleanup, \
+    RUN_STAGING_FOLDER
+from custom_operator.change_journal import journal_changes, journal_catch_up, journal_commit
+from custom_operator.instrumentation import RunMetrics, collecting, span, incr, publish_metrics, METRICS_FOLDER
 
 from airflow.models.baseoperator import BaseOperator
 
-from sqlalchemy import update, delete, and_
-
-
-def struct_list_initialization():
-    root_struct: Dict = {}
-    populate_struct(HOME_FOLDER, root_struct)
-
-    struct_frame = pandas.DataFrame.from_dict(root_struct, orient="index",
-                                              columns=["ID", "FileName", "IsDirectory", "CreateDate", "ModifyDate"])
-
-    slash_list: List = []
-    for index, row in struct_frame.iterrows():
-        slash_list.append(row["FileName"].count("/"))
-    struct_frame["SlashCount"] = slash_list
-
-    root_dir_frame = struct_frame[struct_frame["SlashCount"] == struct_frame["SlashCount"].min()]
-    if root_dir_frame.shape[0] > 1:
-        raise Exception("Multiple root entries")
-    root_dir_row = root_dir_frame.iloc[0]
-
-    db_list: List = []
-    populate_db_list(struct_frame, root_dir_row, None, int(root_dir_row["SlashCount"]),
-                     int(root_dir_row["SlashCount"]), db_list)
-
-    return db_list
-
-
-@sql_decorator_factory(op_type="insert")
-def tables_insert(rows_to_insert, **kwargs):
-    # print("Tables insert call")
-
-    s = kwargs["session"]
-    try:
-        s.bulk_save_objects(rows_to_insert)
-        s.commit()
-    except Exception as e:
-        print(f"Failed to insert rows: {e}")
-        s.rollback()
-    finally:
-        s.close()
-
-
-@sql_decorator_factory(op_type="update")
-def tables_update(rows_to_update, **kwargs):
-    # print("Tables update call")
-
-    s = kwargs["session"]
-    if rows_to_update is not None:
-        try:
-            for ur in rows_to_update:
-                upd = None
-                # check if the item is directory
-                # new values are stored by the "columns" key
-                if ur["is_dir"] == 1:
-                    upd = update(DBFolder) \
-                        .values(ur["columns"]) \
-                        .where(DBFolder.foldername == ur["name"])
-                else:
-                    upd = update(DBFile) \
-                        .values(ur["columns"]) \
-                        .where(DBFile.filename == ur["name"])
-                s.execute(upd)
-            s.commit()
-        except Exception as e:
-            print(f"Failed to update rows: {e}")
-            s.rollback()
-        finally:
-            s.close()
-
-
-@sql_decorator_factory(op_type="delete")
-def tables_delete(rows_to_delete, **kwargs):
-    # print("Tables delete call")
-
-    s = kwargs["session"]
-    if rows_to_delete is not None:
-        try:
-            folder_ids: List = []
-            file_ids: List = []
-            for del_id in rows_to_delete:
-                if s.query(DBFolder.id).filter_by(id=del_id).first() is not None:
-                    # ID is in the DBFolder
-                    folder_ids.append(del_id)
-                else:
-                    # ID is in the DBFile
-                    file_ids.append(del_id)
-            s.execute(delete(DBFile).where(DBFile.id.in_(file_ids)))
-            s.commit()
-            s.execute(delete(DBFolder).where(DBFolder.id.in_(folder_ids)))
-            s.commit()
-        except Exception as e:
-            print(f"Failed to delete rows: {e}")
-            s.rollback()
-        finally:
-            s.close()
-
-
-def current_version_update(v_filename, cur_date):
-    """
-    Disables current version of a file and calculates the next version label
-    :param v_filename: filename key for the version
-    :param cur_date: current date to set in version
-    :return: next version label of a file
-    """
-    print("Update version call")
-
-    conn = project_engine.connect()
-    # read the row by the filename and is_active state
-    cur_active_version = pandas.read_sql("SELECT * FROM DBFileVersion "
-                                         "WHERE filename='{0}' AND is_active=TRUE".format(v_filename), conn)
-
-    if cur_active_version.shape[0] > 1:
-        # something wrong, more than one active version
-        raise Exception("Many active versions of file")
-    elif cur_active_version.shape[0] == 0:
-        # brand new file, return initial version
-        return 1
-
-    # perform update of the current version of the file
-    with project_engine.connect() as conn:
-        upd = update(DBFileVersion) \
-            .values({"is_active": False, "version_end": cur_date}) \
-            .where(and_(DBFileVersion.filename == v_filename, DBFileVersion.is_active == 1))
-        conn.execute(upd)
-        conn.commit()
-
-    # return increased next version
-    return int(cur_active_version.iloc[0]["version"] + 1)
-
-
-def struct_changes_discovery():
-    cur_struct_list = struct_list_initialization()
-
-    with open("../sql/files_folders_hierarchy.sql", "r") as f:
-        query = f.read()
-
-    conn = project_engine.connect()
-    db_struct_frame = pandas.read_sql(query, conn)
-    db_struct_frame = db_struct_frame.astype({"create_date": "datetime64[ns]", "modify_date": "datetime64[ns]"})
-
-    cur_struct_frame = pandas.DataFrame(x.as_dict() for x in cur_struct_list)
-
-    cur_struct_frame = cur_struct_frame.merge(cur_struct_frame,
-                                              left_on="parent_folder_id", right_on="id", suffixes=("_c", "_p"))
-
-    cur_struct_frame = cur_struct_frame.drop(
-        columns=["id_p", "is_dir_p", "parent_folder_id_p", "create_date_p", "modify_date_p"])
-
-    diff_frame = cur_struct_frame.merge(db_struct_frame, how="outer",
-                                        left_on="name_c", right_on="name",
-                                        suffixes=["_left", "_right"], indicator=True)
-
-    added_entries = diff_frame[diff_frame["_merge"] == "left_only"]
-    deleted_entries = diff_frame[diff_frame["_merge"] == "right_only"]
-    modified_entries = diff_frame[diff_frame["_merge"] == "both"]
-    modified_entries = modified_entries[modified_entries["modify_date_c"] != modified_entries["modify_date"]]
-
-    return added_entries, modified_entries, deleted_entries
-
-
-def added_entries_handling(added_entries_frame, cur_date):
-    data_to_add: List = []
-
-    for index, entry in added_entries_frame.iterrows():
-        conn = project_engine.connect()
-        db_parent_entry = pandas.read_sql(
-            "SELECT * FROM DBFolder WHERE foldername='{0}'".format(entry["name_p"]), conn)
-
-        if db_parent_entry.shape[0] > 1:
-            raise Exception("Many parent folders")
-
-        parent_id = 0
-        if db_parent_entry.shape[0] == 0:
-            # new parent folder
-            parent_id = entry["parent_folder_id_c"]
-        else:
-            parent_id = db_parent_entry.iloc[0]["id"]
-
-        if entry["is_dir_c"] == 1:
-            data_to_add.append(DBFolder(id=entry["id_c"], foldername=entry["name_c"],
-                                        description=entry["description_c"], parent_id=parent_id,
-                                        create_date=entry["create_date_c"], modify_date=entry["modify_date_c"]))
-        else:
-            data_to_add.append(DBFile(id=entry["id_c"], filename=entry["name_c"],
-                                      description=entry["description_c"], folder_id=parent_id,
-                                      create_date=entry["create_date_c"], modify_date=entry["modify_date_c"]))
-
-        next_version = current_version_update(entry["name_c"], cur_date)
-
-        data_to_add.append(DBFileVersion(file_id=entry["id_c"], filename=entry["name_c"],
-                                         description=entry["description_c"], folder_id=parent_id,
-                                         create_date=entry["create_date_c"], modify_date=entry["modify_date_c"],
-                                         is_active=True, version=next_version, op_type='c',
-                                         version_start=cur_date, version_end=pandas.Timestamp.max))
-    return data_to_add
-
-
-def modified_entries_handling(modified_entries_frame, cur_date):
-    data_to_update: List = []
-    data_to_add: List = []
-
-    for index, entry in modified_entries_frame.iterrows():
-        data_to_update.append({"name": entry["name"],
-                               "is_dir": entry["is_dir_c"],
-                               "columns": {"create_date": entry["create_date_c"],
-                                           "modify_date": entry["modify_date_c"]
-                                           }
-                               })
-
-        next_version = current_version_update(entry["name"], cur_date)
-
-        data_to_add.append(DBFileVersion(file_id=entry["id"], filename=entry["name"],
-                                         description=entry["description_c"], folder_id=entry["parent_id"],
-                                         create_date=entry["create_date_c"], modify_date=entry["modify_date_c"],
-                                         is_active=True, version=next_version, op_type='m',
-                                         version_start=cur_date, version_end=pandas.Timestamp.max))
-
-    return data_to_update, data_to_add
-
-
-def deleted_entries_handling(deleted_entries_frame, cur_date):
-    data_to_delete: List = []
-    data_to_add: List = []
-
-    for index, entry in deleted_entries_frame.iterrows():
-        data_to_delete.append(entry["id"])
-
-        next_version = current_version_update(entry["name"], cur_date)
-
-        data_to_add.append(DBFileVersion(file_id=entry["id"], filename=entry["name"],
-                                         description=entry["description_c"], folder_id=entry["parent_id"],
-                                         create_date=entry["create_date"], modify_date=entry["modify_date"],
-                                         is_active=True, version=next_version, op_type='d',
-                                         version_start=cur_date, version_end=pandas.Timestamp.max))
-    return data_to_delete, data_to_add
-
 
 class StructureMonitoringOperator(BaseOperator):
-    def __init__(self, name: str, **kwargs):
+    def __init__(self, name: str, scan_mode: str = "full", stream_batch_size: Optional[int] = None,
+                 content_hash: bool = False, metrics_folder: Optional[str] = METRICS_FOLDER,
+                 subtree_roots: Optional[List[str]] = None, max_depth: Optional[int] = None,
+                 staging_folder: Optional[str] = None, use_journal: bool = False,
+                 exclude_patterns: Optional[List[str]] = None, max_file_size: Optional[int] = None,
+                 max_file_age: Optional[float] = None, resumable: bool = True, stream_pipeline: bool = True,
+                 **kwargs):
         super().__init__(**kwargs)
+        if scan_mode not in SCAN_MODES:
+            raise Exception(f"Unknown scan mode {scan_mode}")
+        if stream_batch_size is not None and (scan_mode != "full" or content_hash):
+            raise Exception("Streaming diff supports only the full scan mode without content hashes")
+        if stream_batch_size is not None and (staging_folder is not None or max_depth is not None):
+            raise Exception("Streaming diff can't be staged or limited by depth")
+        if use_journal and (stream_batch_size is not None or staging_folder is not None or
+                            subtree_roots is not None or max_depth is not None):
+            raise Exception("Change journal is consumed only by the monitoring of the whole tree")
         self.name = name
-        
-    def execute(self, context):
-        added_frame, modified_frame, deleted_frame = struct_changes_discovery()
+        self.scan_mode = scan_mode
+        # if set, the tree is diffed as a stream and the changes are applied in batches of this size
+        self.stream_batch_size = stream_batch_size
+        # detect modifications by the content hash instead of mtime
+        self.content_hash = content_hash
+        # folder of the run metrics file, None to push the metrics to XCom only
+        self.metrics_folder = metrics_folder
+        # roots of the monitored subtrees (the roots themselves are not compared), the whole tree by default
+        self.subtree_roots = subtree_roots if subtree_roots is not None else [HOME_FOLDER]
+        # amount of the levels below the subtree roots to compare, None for the whole subtrees
+        self.max_depth = max_depth
+        # if set, the changes are not applied but saved to this folder for StructureChangesMergeOperator,
+        # the name of the staging file is returned to XCom
+        self.staging_folder = staging_folder
+        # compare only the paths journaled by the watcher since the last run (see change_journal),
+        # the whole tree is compared if the journal can't be trusted
+        self.use_journal = use_journal
+        # gitignore-style globs of the entries which are not monitored, None for EXCLUDED_PATTERNS;
+        # files bigger than max_file_size bytes or not modified for max_file_age seconds are not monitored too
+        self.exclude_patterns = exclude_patterns
+        self.max_file_size = max_file_size
+        self.max_file_age = max_file_age
+        # checkpoint the run in the run ledger (see run_ledger), a retried task applies the staged change set
+        # or resumes the stream after the last committed batch instead of scanning the whole tree again
+        self.resumable = resumable
+        # scan and diff the stream in the producer thread while the batches are written (see pipeline)
+        self.stream_pipeline = stream_pipeline
 
-        cur_date = datetime.now()
-        data_to_add = added_entries_handling(added_frame, cur_date)
-        tables_insert(rows_to_insert=data_to_add)
-
-        data_to_modify, data_to_add = modified_entries_handling(modified_frame, cur_date)
-        tables_update(rows_to_update=data_to_modify)
-        tables_insert(rows_to_insert=data_to_add)
-
-        data_to_delete, data_to_add = deleted_entries_handling(deleted_frame, cur_date)
-        tables_delete(rows_to_delete=data_to_delete)
-        tables_insert(rows_to_insert=data_to_add)
-
-# if __name__ == "__main__":
-    # added_frame, modified_frame, deleted_frame = struct_changes_discovery()
-
-    # cur_date = datetime.now()
-    # data_to_add = added_entries_handling(added_frame, cur_date)
-    # tables_insert(rows_to_insert=data_to_add)
-
-    # data_to_modify, data_to_add = modified_entries_handling(modified_frame, cur_date)
-    # tables_update(rows_to_update=data_to_modify)
-    # tables_insert(rows_to_insert=data_to_add)
-
-    # data_to_delete, data_to_add = deleted_entries_handling(deleted_frame, cur_date)
-    # tables_delete(rows_to_delete=data_to_delete)
-    # tables_insert(rows_to_insert=data_to_add)
+    def execute(self, context):
+        configure_exclusions(self.exclude_patterns, self.max_file_size, self.max_file_age)
+        metrics = RunMetrics(self.task_id)
+        with collecting(metrics):
+            # shards only stage their changes, there is nothing to resume
+            run_key = run_key_of(context, self.task_id) if self.resumable and self.staging_folder is None else None
+            staging_file = self.monitoring_run(run_key)
+        metrics_file = publish_metrics(metrics, context, self.task_id, self.metrics_folder)
+        self.log.info("Run metrics: %s, written to %s", metrics.counters, metrics_file)
+        return staging_file
+
+    def monitoring_run(self, run_key=None):
+        # bring an existing database up to the current model;
+        # shards only read the database, the model is prepared by the planning task
+        if self.staging_folder is None:
+            with span("model_creation"):
+                model_creation()
+
+        if run_key is not None:
+            removed_count = stale_runs_cleanup()
+            if removed_count > 0:
+                self.log.info("Removed %d staged change sets of the finished and stale runs", removed_count)
+
+        run = run_load(run_key) if run_key is not None else None
+        if run is not None and run.status == "finished":
+            self.log.info("Run %s is already finished", run_key)
+            return None
+
+        if self.stream_batch_size is not None:
+            self.stream_run(run_key, run)
+            return None
+
+        # the end of the run is committed in the transaction of its changes
+        finished_checkpoint = None if run_key is None else {"run_key": run_key, "status": "finished",
+                                                            "staging_file": None}
+        journal_offset = None
+        if self.use_journal:
+            with span("journal_read"):
+                journal_paths, journal_offset = journal_changes()
+            if journal_paths is not None:
+                # all journaled scopes are applied at once, the offset is committed afterwards: a crash in between
+                # makes the next run compare the same scopes again, which finds nothing to change
+                with span("journal_catch_up"):
+                    journal_catch_up(journal_paths, self.scan_mode, self.content_hash, datetime.now(),
+                                     checkpoint=finished_checkpoint)
+                journal_commit(journal_offset)
+                return None
+
+        if run is not None and run.status == "discovered" and run.staging_file is not None and \
+                os.path.exists(run.staging_file):
+            # the interrupted try has discovered the changes, nothing of them is committed
+            self.log.info("Resuming run %s with the change set staged to %s", run_key, run.staging_file)
+            added_frame, modified_frame, deleted_frame = staged_changes_read(run.staging_file)
+            cur_date, staging_file = run.cur_date, run.staging_file
+            # the offset of this try is newer than the staged changes, the next run catches up from the old one
+            journal_offset = None
+        else:
+            with span("struct_changes_discovery"):
+                added_frame, modified_frame, deleted_frame = subtrees_changes_discovery(
+                    self.subtree_roots, self.scan_mode, self.content_hash, self.max_depth)
+            self.log.info("Discovered %d added, %d modified, %d deleted entries",
+                          added_frame.shape[0], modified_frame.shape[0], deleted_frame.shape[0])
+
+            if self.staging_folder is not None:
+                with span("changes_stage"):
+                    staging_file = changes_stage(added_frame, modified_frame, deleted_frame, self.staging_folder)
+                self.log.info("Changes staged to %s", staging_file)
+                return staging_file
+
+            cur_date, staging_file = datetime.now(), None
+            if run_key is not None:
+                with span("changes_stage"):
+                    staging_file = changes_stage(added_frame, modified_frame, deleted_frame, RUN_STAGING_FOLDER)
+                run_checkpoint(run_key, "discovered", cur_date, staging_file=staging_file)
+
+        # the whole change set and the end of the run are committed in one transaction
+        with span("changes_apply"):
+            write_counts = changes_apply(added_frame, modified_frame, deleted_frame, cur_date, finished_checkpoint)
+        self.log.info("Updated %d rows with %d statements, deleted %d files and %d folders with %d statements",
+                      write_counts["rows_updated"], write_counts["update_statements"], write_counts["files_deleted"],
+                      write_counts["folders_deleted"], write_counts["delete_statements"])
+        staging_file_remove(staging_file)
+        if journal_offset is not None:
+            journal_commit(journal_offset)
+        return None
+
+    def stream_run(self, run_key, run):
+        cur_date = run.cur_date if run is not None else datetime.now()
+        start_index, resume_after, batch_count = 0, None, 0
+        if run is not None and run.root_folder in self.subtree_roots:
+            start_index, resume_after, batch_count = \
+                self.subtree_roots.index(run.root_folder), run.last_name, run.batch_count
+            self.log.info("Resuming run %s in %s after %s", run_key, run.root_folder, resume_after)
+
+        checkpoint = None
+        for subtree_root in self.subtree_roots[start_index:]:
+            if run_key is not None:
+                checkpoint = {"run_key": run_key, "status": "applying", "root_folder": subtree_root,
+                              "batch_count": batch_count}
+                run_checkpoint(cur_date=cur_date, last_name=resume_after, **checkpoint)
+            change_batches = struct_changes_stream(self.stream_batch_size, subtree_root, resume_after)
+            if self.stream_pipeline:
+                with span("pipelined_changes_apply"):
+                    root_batch_count = pipelined_changes_apply(change_batches, cur_date, checkpoint=checkpoint)
+            else:
+                # every batch is written before the next one is prepared
+                root_batch_count = 0
+                for added_frame, modified_frame, deleted_frame, last_name in change_batches:
+                    incr("stream_batches")
+                    root_batch_count += 1
+                    batch_checkpoint = None if checkpoint is None else \
+                        {**checkpoint, "last_name": last_name, "batch_count": batch_count + root_batch_count}
+                    with span("changes_apply"):
+                        changes_apply(added_frame, modified_frame, deleted_frame, cur_date, batch_checkpoint)
+            self.log.info("Streaming diff of %s finished, %d batches written", subtree_root, root_batch_count)
+            batch_count += root_batch_count
+            resume_after = None
+        if run_key is not None:
+            run_checkpoint(run_key, "finished", cur_date, batch_count=batch_count)
@@ -0,0 +1,181 @@
+import os
+import sys
+import pandas
+from array import array
+from uuid import uuid4
+from datetime import datetime
+from typing import List, Dict, Optional
+
+from custom_operator.content_hashing import FileStat, content_hashes
+
+# stored instead of None in the integer columns
+MISSING = -1
+
+
+class TreeSnapshot:
+    """
+    Compact in-memory form of the scanned tree. An entry is a position in the parallel typed arrays:
+    the end of its name component in the shared bytes buffer, the position of the parent (MISSING for the root)
+    and the stat columns. Full names and ids are produced only on demand, ids are generated only
+    for the requested entries. Parents always precede their content
+    """
+    def __init__(self):
+        # encoded name components one after another, the root is stored as a single component with its full name
+        self.names = bytearray()
+        self.name_end = array("q")
+        self.parent = array("i")
+        self.is_dir = array("b")
+        self.create_date = array("d")
+        self.modify_date = array("d")
+        self.size = array("q")
+        self.inode = array("q")
+        self.device = array("q")
+        self.child_count = array("i")
+        # filled only for the content hash comparison, None for folders and unreadable files
+        self.content_hash: Optional[List] = None
+        self.ids: Dict = {}
+
+    def __len__(self):
+        return len(self.parent)
+
+    def component(self, position):
+        """
+        :return: name component of the entry
+        """
+        name_start = self.name_end[position - 1] if position > 0 else 0
+        return os.fsdecode(bytes(self.names[name_start:self.name_end[position]]))
+
+    def append(self, component, parent, record):
+        """
+        Add the entry of the record (see entry_record), the child count of the parent grows by one
+        :return: position of the entry
+        """
+        position = len(self.parent)
+        self.names += os.fsencode(component)
+        self.name_end.append(len(self.names))
+        self.parent.append(parent)
+        self.is_dir.append(1 if record["IsDirectory"] else 0)
+        self.create_date.append(record["CreateDate"])
+        self.modify_date.append(record["ModifyDate"])
+        self.size.append(MISSING if record["IsDirectory"] or record["Size"] is None else record["Size"])
+        self.inode.append(MISSING if record["Inode"] is None else record["Inode"])
+        self.device.append(MISSING if record.get("Device") is None else record["Device"])
+        self.child_count.append(0)
+        if parent != MISSING:
+            self.child_count[parent] += 1
+        return position
+
+    @classmethod
+    def from_records(cls, entry_records):
+        """
+        Build the snapshot from the walker records, a directory record must precede the records of its content
+        (true for scan_struct and scan_struct_sorted)
+        :param entry_records: iterable of entry records (see entry_record)
+        :return: TreeSnapshot
+        """
+        snapshot = cls()
+        # full names of the directories to their positions, needed only while the snapshot is built
+        dir_positions: Dict = {}
+        # directories which were not listed come with their own child count
+        own_child_counts: Dict = {}
+        for record in entry_records:
+            full_name = record["FileName"]
+            parent_name, component = os.path.split(full_name)
+            parent = dir_positions.get(parent_name, MISSING)
+            if parent == MISSING:
+                if len(snapshot) > 0:
+                    raise Exception("Multiple root entries")
+                component = full_name
+            position = snapshot.append(component, parent, record)
+            if record["IsDirectory"]:
+                dir_positions[full_name] = position
+                if "ChildCount" in record:
+                    own_child_counts[position] = record["ChildCount"]
+        for position, child_count in own_child_counts.items():
+            snapshot.child_count[position] = child_count
+        return snapshot
+
+    def full_names(self):
+        """
+        :return: list of the full names of the entries, parents are resolved before their content
+        """
+        names: List = []
+        for position in range(len(self.parent)):
+            parent = self.parent[position]
+            component = self.component(position)
+            names.append(component if parent == MISSING else os.path.join(names[parent], component))
+        return names
+
+    def entry_id(self, position):
+        """
+        :return: id of the entry, generated on the first request
+        """
+        if position == MISSING:
+            return None
+        entry_id = self.ids.get(position)
+        if entry_id is None:
+            entry_id = self.ids[position] = str(uuid4())
+        return entry_id
+
+    def file_positions(self):
+        return [position for position in range(len(self.is_dir)) if not self.is_dir[position]]
+
+    def content_hashes_fill(self, prune_cache=True):
+        """
+        Fill the content hashes of the files (see content_hashes)
+        :param prune_cache: remove cached signatures which are not part of the snapshot
+        :return: None
+        """
+        names = self.full_names()
+        positions = self.file_positions()
+        files = [FileStat(names[position], self.nullable(self.inode, position), self.nullable(self.size, position),
+                          datetime.fromtimestamp(self.modify_date[position]),
+                          datetime.fromtimestamp(self.create_date[position])) for position in positions]
+        self.content_hash = [None] * len(self.parent)
+        for position, file_content_hash in zip(positions, content_hashes(files, prune_cache=prune_cache)):
+            self.content_hash[position] = file_content_hash
+
+    def nullable(self, column, position):
+        return None if column[position] == MISSING else column[position]
+
+    def memory_size(self):
+        """
+        :return: amount of bytes held by the snapshot: the allocated columns, the names buffer,
+        the generated ids and the content hashes
+        """
+        columns_size = sum(sys.getsizeof(column)
+                           for column in [self.names, self.name_end, self.parent, self.is_dir, self.create_date,
+                                          self.modify_date, self.size, self.inode, self.device, self.child_count])
+        ids_size = sys.getsizeof(self.ids) + sum(sys.getsizeof(entry_id) for entry_id in self.ids.values())
+        hashes_size = 0 if self.content_hash is None else sys.getsizeof(self.content_hash) + \
+            sum(sys.getsizeof(content_hash) for content_hash in self.content_hash if content_hash is not None)
+        return columns_size + ids_size + hashes_size
+
+    def to_frame(self, include_root=False):
+        """
+        Convert the snapshot to the scanned side of the diff frames, the positions are kept
+        in the "index_c" and "parent_index_c" columns instead of ids
+        :param include_root: keep the root entry in the frame
+        :return: DataFrame
+        """
+        names = self.full_names()
+        is_dir = [bool(flag) for flag in self.is_dir]
+        frame = pandas.DataFrame({
+            "index_c": range(len(names)),
+            "name_c": names,
+            "description_c": None,
+            "is_dir_c": is_dir,
+            "parent_index_c": self.parent,
+            "create_date_c": [datetime.fromtimestamp(timestamp) for timestamp in self.create_date],
+            "modify_date_c": [datetime.fromtimestamp(timestamp) for timestamp in self.modify_date],
+            "child_count_c": [self.child_count[position] if is_dir[position] else None
+                              for position in range(len(names))],
+            "size_c": [self.nullable(self.size, position) for position in range(len(names))],
+            "inode_c": [self.nullable(self.inode, position) for position in range(len(names))],
+            "device_c": [self.nullable(self.device, position) for position in range(len(names))],
+            "content_hash_c": self.content_hash if self.content_hash is not None else None,
+            "name_p": [names[parent] if parent != MISSING else None for parent in self.parent],
+            "description_p": None})
+        if not include_root:
+            frame = frame[frame["parent_index_c"] != MISSING]
+        return frame
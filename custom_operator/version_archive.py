@@ -0,0 +1,120 @@
+import os
+import pandas
+from datetime import datetime, timedelta
+from typing import List
+
+from sqlalchemy import select, delete, and_, text
+
+from custom_operator.core_objects import DBFileVersion, DBPath
+from custom_operator.database_initialization import get_engine
+from custom_operator.instrumentation import span, incr
+
+try:
+    # parquet engine of pandas, needed only once something is archived
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+ARCHIVE_FOLDER = "/opt/airflow/archive/DBFileVersion"
+# closed versions are kept in the database for this amount of days after their end
+RETENTION_DAYS = 90
+ARCHIVE_CHUNK_SIZE = 100000
+# archived versions are partitioned by the month of their end
+PARTITION_PREFIX = "version_end_month="
+
+
+def parquet_check():
+    if pyarrow is None:
+        raise Exception("pyarrow is required to read and write the version archive")
+
+
+def partition_month(ts):
+    return ts.strftime("%Y-%m")
+
+
+def archive_files(archive_folder=ARCHIVE_FOLDER, min_version_end=None):
+    """
+    :param archive_folder: root folder of the archive
+    :param min_version_end: skip the partitions of the versions closed before the month of this date
+    :return: sorted list of the archive files of the matching partitions
+    """
+    if not os.path.isdir(archive_folder):
+        return []
+    min_partition = None if min_version_end is None else PARTITION_PREFIX + partition_month(min_version_end)
+    files: List = []
+    for partition in sorted(os.listdir(archive_folder)):
+        if not partition.startswith(PARTITION_PREFIX) or (min_partition is not None and partition < min_partition):
+            continue
+        partition_folder = os.path.join(archive_folder, partition)
+        files.extend(os.path.join(partition_folder, file_name) for file_name in sorted(os.listdir(partition_folder))
+                     if file_name.endswith(".parquet"))
+    return files
+
+
+def archived_versions(filters=None, min_version_end=None, archive_folder=ARCHIVE_FOLDER):
+    """
+    Read the archived versions
+    :param filters: row filters of pyarrow in the disjunctive normal form (list of lists of the conditions)
+    :param min_version_end: read only the partitions which may hold versions closed after this date
+    :param archive_folder: root folder of the archive
+    :return: DataFrame of the versions, None if there are no archive files to read
+    """
+    files = archive_files(archive_folder, min_version_end)
+    if not files:
+        return None
+    parquet_check()
+    return pandas.concat([pandas.read_parquet(file_name, filters=filters) for file_name in files],
+                         ignore_index=True)
+
+
+def versions_compaction(retention_days=RETENTION_DAYS, archive_folder=ARCHIVE_FOLDER, chunk_size=ARCHIVE_CHUNK_SIZE,
+                        cur_date=None):
+    """
+    Move the closed versions which ended before the retention window to the Parquet archive, chunk by chunk.
+    A chunk file is named by its id range and written before its rows are deleted, so a rerun after a failure
+    rewrites the same file and the readers drop the rows present in both places by id
+    :param retention_days: amount of days the closed versions are kept in the database
+    :param archive_folder: root folder of the archive
+    :param chunk_size: amount of versions archived at once
+    :param cur_date: current date, the retention window ends at it
+    :return: amount of archived versions
+    """
+    parquet_check()
+    cutoff = (cur_date or datetime.now()) - timedelta(days=retention_days)
+    archived_count = 0
+    last_id = 0
+    engine = get_engine()
+    while True:
+        with span("archive_read"), engine.connect() as conn:
+            # the archive is self-contained, the versions keep their names along with the path ids
+            chunk = pandas.read_sql(
+                select(DBFileVersion.__table__, DBPath.path.label("filename"))
+                .join(DBPath, DBFileVersion.path_id == DBPath.id)
+                .where(and_(DBFileVersion.id > last_id, DBFileVersion.is_active == 0,
+                            DBFileVersion.version_end < cutoff))
+                .order_by(DBFileVersion.id).limit(chunk_size), conn)
+        if chunk.empty:
+            break
+        first_id, last_id = int(chunk["id"].iloc[0]), int(chunk["id"].iloc[-1])
+
+        with span("archive_write"):
+            for month, month_chunk in chunk.groupby(chunk["version_end"].map(partition_month)):
+                partition_folder = os.path.join(archive_folder, PARTITION_PREFIX + month)
+                os.makedirs(partition_folder, exist_ok=True)
+                month_chunk.to_parquet(os.path.join(partition_folder, f"part-{first_id:012d}-{last_id:012d}.parquet"),
+                                       index=False)
+        with span("archive_delete"), engine.begin() as conn:
+            conn.execute(delete(DBFileVersion)
+                         .where(and_(DBFileVersion.id.between(first_id, last_id), DBFileVersion.is_active == 0,
+                                     DBFileVersion.version_end < cutoff)))
+        archived_count += chunk.shape[0]
+        incr("versions_archived", chunk.shape[0])
+        print(f"Archived {chunk.shape[0]} versions, ids {first_id}-{last_id}")
+
+    if archived_count > 0:
+        # return the freed pages to the filesystem and refresh planner statistics
+        with span("vacuum"), engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+            conn.execute(text("VACUUM"))
+            conn.execute(text("ANALYZE"))
+    print(f"Version compaction finished, {archived_count} versions archived before {cutoff}")
+    return archived_count
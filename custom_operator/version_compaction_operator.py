@@ -0,0 +1,35 @@
+from datetime import datetime
+from typing import Optional
+
+from custom_operator.db_init import model_creation
+from custom_operator.version_archive import versions_compaction, RETENTION_DAYS, ARCHIVE_FOLDER
+from custom_operator.instrumentation import RunMetrics, collecting, span, publish_metrics, METRICS_FOLDER
+
+from airflow.models.baseoperator import BaseOperator
+
+
+class VersionCompactionOperator(BaseOperator):
+    def __init__(self, name: str, retention_days: int = RETENTION_DAYS, archive_folder: str = ARCHIVE_FOLDER,
+                 metrics_folder: Optional[str] = METRICS_FOLDER, **kwargs) -> None:
+        super().__init__(**kwargs)
+        self.name = name
+        # closed versions which ended earlier than this amount of days ago are archived
+        self.retention_days = retention_days
+        # root folder of the Parquet archive, read back by version_queries
+        self.archive_folder = archive_folder
+        # folder of the run metrics file, None to push the metrics to XCom only
+        self.metrics_folder = metrics_folder
+
+    def execute(self, context):
+        metrics = RunMetrics(self.task_id)
+        with collecting(metrics):
+            with span("model_creation"):
+                model_creation()
+            with span("versions_compaction"):
+                archived_count = versions_compaction(self.retention_days, self.archive_folder,
+                                                     cur_date=datetime.now())
+        self.log.info("Archived %d versions to %s", archived_count, self.archive_folder)
+
+        metrics_file = publish_metrics(metrics, context, self.task_id, self.metrics_folder)
+        self.log.info("Run metrics: %s, written to %s", metrics.counters, metrics_file)
+        return archived_count
@@ -0,0 +1,168 @@
+import os
+import heapq
+import pandas
+from typing import List
+
+from sqlalchemy import select, and_, or_
+
+from custom_operator.core_objects import DBFileVersion, DBPath
+from custom_operator.database_initialization import get_engine
+from custom_operator.filesystem_parser import subtree_bounds
+from custom_operator.version_archive import archived_versions, ARCHIVE_FOLDER
+
+# versions keep the interned key of the name, the name itself comes from DBPath (see versions_select)
+VERSION_COLUMNS = [DBFileVersion.id, DBFileVersion.file_id, DBPath.path.label("filename"), DBFileVersion.description,
+                   DBFileVersion.folder_id, DBFileVersion.create_date, DBFileVersion.modify_date, DBFileVersion.op_type,
+                   DBFileVersion.version, DBFileVersion.version_start, DBFileVersion.version_end]
+VERSION_COLUMN_NAMES = [column.name for column in VERSION_COLUMNS]
+
+
+def versions_select():
+    return select(*VERSION_COLUMNS).join(DBPath, DBFileVersion.path_id == DBPath.id)
+
+
+def frame_rows(frames):
+    """
+    :return: generator of the rows of the DataFrames as dictionaries
+    """
+    for frame in frames:
+        yield from frame.to_dict("records")
+
+
+def query_frames(statement, order_columns, chunk_size, archived=None):
+    """
+    Read the query result with a server-side cursor, chunk by chunk. The archived versions are merged
+    into the stored ones in the order of the result, the stored rows which are already archived
+    (interrupted compaction) are skipped
+    :return: generator of DataFrames of at most chunk_size rows
+    """
+    with get_engine().connect() as conn:
+        conn = conn.execution_options(stream_results=True)
+        db_frames = pandas.read_sql(statement, conn, chunksize=chunk_size)
+        if archived is None:
+            yield from db_frames
+            return
+
+        archived_ids = set(archived["id"])
+        db_rows = (row for row in frame_rows(db_frames) if row["id"] not in archived_ids)
+        rows: List = []
+        for row in heapq.merge(frame_rows([archived]), db_rows,
+                               key=lambda version_row: tuple(version_row[column] for column in order_columns)):
+            rows.append(row)
+            if len(rows) >= chunk_size:
+                yield pandas.DataFrame(rows, columns=VERSION_COLUMN_NAMES)
+                rows = []
+        if rows:
+            yield pandas.DataFrame(rows, columns=VERSION_COLUMN_NAMES)
+
+
+def query_result(statement, order_columns, archived=None, chunk_size=None):
+    """
+    :param statement: select statement of the versions
+    :param order_columns: order of the result, the archived versions are merged in this order
+    :param archived: DataFrame of the archived versions of the query (see archived_versions), None if there are none
+    :param chunk_size: amount of rows in a chunk, None to read the whole result at once
+    :return: DataFrame, or generator of DataFrames if chunk_size is set
+    """
+    if archived is not None:
+        archived = archived[VERSION_COLUMN_NAMES].sort_values(order_columns, ignore_index=True) \
+            if not archived.empty else None
+    if chunk_size is not None:
+        return query_frames(statement, order_columns, chunk_size, archived)
+    with get_engine().connect() as conn:
+        frame = pandas.read_sql(statement, conn)
+    if archived is None:
+        return frame
+    return pandas.concat([archived, frame], ignore_index=True).drop_duplicates("id") \
+        .sort_values(order_columns, ignore_index=True)
+
+
+def subtree_condition(subtree):
+    """
+    :param subtree: full name of the subtree root
+    :return: condition selecting the versions of the root and of the entries below it by the name range
+    """
+    abs_subtree = os.path.abspath(subtree)
+    subtree_start, subtree_end = subtree_bounds(abs_subtree)
+    return or_(DBPath.path == abs_subtree, and_(DBPath.path >= subtree_start, DBPath.path < subtree_end))
+
+
+def archive_filters(conditions, subtree=None):
+    """
+    :param conditions: list of the pyarrow filter conditions
+    :param subtree: full name of the subtree root, None for the whole tree
+    :return: pyarrow filters of the archive, the same as the subtree_condition
+    """
+    if subtree is None:
+        return [conditions]
+    abs_subtree = os.path.abspath(subtree)
+    subtree_start, subtree_end = subtree_bounds(abs_subtree)
+    return [conditions + [("filename", "==", abs_subtree)],
+            conditions + [("filename", ">=", subtree_start), ("filename", "<", subtree_end)]]
+
+
+def tree_as_of(ts, subtree=None, chunk_size=None, archive_folder=ARCHIVE_FOLDER):
+    """
+    Files and folders which existed at the given time: the versions whose interval contains it,
+    deletion versions excluded. The archive is read only if it holds versions closed after the time
+    :param ts: point in time (datetime)
+    :param subtree: full name of the subtree root, None for the whole tree
+    :param chunk_size: stream the result in chunks of this size (see query_result)
+    :param archive_folder: root folder of the version archive (see versions_compaction)
+    :return: versions ordered by name, every folder precedes its content
+    """
+    conditions = [DBFileVersion.version_start <= ts, DBFileVersion.version_end > ts, DBFileVersion.op_type != 'd']
+    if subtree is not None:
+        conditions.append(subtree_condition(subtree))
+    archived = archived_versions(archive_filters([("version_start", "<=", ts), ("version_end", ">", ts),
+                                                  ("op_type", "!=", "d")], subtree), min_version_end=ts,
+                                 archive_folder=archive_folder)
+    return query_result(versions_select().where(and_(*conditions)).order_by(DBPath.path),
+                        ["filename"], archived, chunk_size)
+
+
+def history(path, chunk_size=None, archive_folder=ARCHIVE_FOLDER):
+    """
+    All versions of the filesystem objects ever stored under the name, the versions they had
+    under the other names (before or after a move) are included
+    :param path: full name of the file or folder
+    :param chunk_size: stream the result in chunks of this size (see query_result)
+    :param archive_folder: root folder of the version archive (see versions_compaction)
+    :return: versions ordered by their start
+    """
+    abs_path = os.path.abspath(path)
+    with get_engine().connect() as conn:
+        file_ids = set(conn.execute(select(DBFileVersion.file_id)
+                                    .join(DBPath, DBFileVersion.path_id == DBPath.id)
+                                    .where(DBPath.path == abs_path)).scalars())
+    archived_names = archived_versions([[("filename", "==", abs_path)]], archive_folder=archive_folder)
+    if archived_names is not None:
+        file_ids.update(archived_names["file_id"])
+
+    archived = archived_versions([[("file_id", "in", sorted(file_ids))]], archive_folder=archive_folder) \
+        if file_ids else None
+    return query_result(versions_select()
+                        .where(DBFileVersion.file_id.in_(sorted(file_ids)))
+                        .order_by(DBFileVersion.version_start, DBFileVersion.id),
+                        ["version_start", "id"], archived, chunk_size)
+
+
+def changes_between(start_ts, end_ts, subtree=None, chunk_size=None, archive_folder=ARCHIVE_FOLDER):
+    """
+    Versions created in the time range, every version is a change of its entry (see op_type)
+    :param start_ts: exclusive start of the range (datetime)
+    :param end_ts: inclusive end of the range (datetime)
+    :param subtree: full name of the subtree root, None for the whole tree
+    :param chunk_size: stream the result in chunks of this size (see query_result)
+    :param archive_folder: root folder of the version archive (see versions_compaction)
+    :return: versions ordered by their start and name
+    """
+    conditions = [DBFileVersion.version_start > start_ts, DBFileVersion.version_start <= end_ts]
+    if subtree is not None:
+        conditions.append(subtree_condition(subtree))
+    # a version ends after it starts, the older partitions can't hold the range
+    archived = archived_versions(archive_filters([("version_start", ">", start_ts), ("version_start", "<=", end_ts)],
+                                                 subtree), min_version_end=start_ts, archive_folder=archive_folder)
+    return query_result(versions_select().where(and_(*conditions))
+                        .order_by(DBFileVersion.version_start, DBPath.path),
+                        ["version_start", "filename"], archived, chunk_size)
@@ -1,7 +1,7 @@
 import pandas
 import os
 from datetime import datetime
-from custom_operator.filesystem_parser import HOME_FOLDER, populate_struct, populate_db_list
+from custom_operator.filesystem_parser import HOME_FOLDER
 from custom_operator.core_objects import Base, DBFile, DBFileVersion, DBFolder
 
 from sqlalchemy import create_engine
@@ -12,6 +12,7 @@ from airflow import DAG
 from airflow.operators.python import BranchPythonOperator, PythonOperator, PythonVirtualenvOperator
 from airflow.utils.dates import days_ago
 from custom_operator.db_init_operator import DBInitOperator
+from custom_operator.db_init import initial_load_pending
 from custom_operator.structure_monitoring_operator import StructureMonitoringOperator
 
 
@@ -45,7 +46,8 @@ with DAG(
     )
     
     def db_init_choice():
-        if os.path.isfile('local_database.db'):
+        # an interrupted initial load is resumed by the next db_init run
+        if os.path.isfile('local_database.db') and not initial_load_pending():
             return 'struct_monitor'
         else:
             return 'db_init'
@@ -0,0 +1,42 @@
+from airflow import DAG
+from airflow.operators.python import PythonOperator
+from airflow.utils.dates import days_ago
+from custom_operator.sharding import shards_plan, STAGING_FOLDER
+from custom_operator.structure_monitoring_operator import StructureMonitoringOperator
+from custom_operator.structure_changes_merge_operator import StructureChangesMergeOperator
+
+
+args = {
+    'owner': 'airflow',
+}
+
+with DAG(
+    dag_id='sharded_structure_dag',
+    default_args=args,
+    schedule_interval=None,
+    start_date=days_ago(2),
+    tags=['example'],
+) as dag:
+
+    # the root level shard and the balanced groups of the top level subtrees
+    shards_planning = PythonOperator(
+        task_id='shards_planning',
+        python_callable=shards_plan,
+        op_kwargs={'shard_count': 4}
+    )
+
+    # every shard is scanned and diffed by its own mapped task, the changes are staged to files
+    shard_monitor = StructureMonitoringOperator.partial(
+        task_id='shard_monitor',
+        name='custom_shard_monitor',
+        staging_folder=STAGING_FOLDER
+    ).expand_kwargs(shards_planning.output)
+
+    # the single writer applies the staged changes in the plan order
+    changes_merge = StructureChangesMergeOperator(
+        task_id='changes_merge',
+        name='custom_changes_merge',
+        staging_files=shard_monitor.output
+    )
+
+    shards_planning >> shard_monitor >> changes_merge
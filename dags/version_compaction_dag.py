@@ -0,0 +1,24 @@
+from airflow import DAG
+from airflow.utils.dates import days_ago
+from custom_operator.version_compaction_operator import VersionCompactionOperator
+
+
+args = {
+    'owner': 'airflow',
+}
+
+with DAG(
+    dag_id='version_compaction_dag',
+    default_args=args,
+    schedule_interval='@weekly',
+    start_date=days_ago(2),
+    catchup=False,
+    tags=['example'],
+) as dag:
+
+    # closed versions older than the retention window are moved to the Parquet archive
+    versions_compaction = VersionCompactionOperator(
+        task_id='versions_compaction',
+        name='custom_versions_compaction',
+        retention_days=90
+    )
@@ -0,0 +1,24 @@
+-- stored files of the subtree ordered by the full name;
+-- names are materialized paths kept in DBPath, so the subtree is a range lookup on the path index,
+-- which also returns the rows in order without a sort; CROSS JOIN keeps DBPath as the outer loop
+-- the parent is left joined: the content of a folder deleted by a committed stream batch is still read by the retry
+SELECT
+    dbfl.id,
+    p.path AS name,
+    0 AS is_dir,
+    dbfl.folder_id AS parent_id,
+    pp.path AS parent_name,
+    dbfl.create_date,
+    dbfl.modify_date,
+    NULL AS child_count,
+    dbfl.size,
+    dbfl.inode,
+    dbfl.device,
+    dbfl.content_hash,
+    dbfl.depth AS level
+FROM DBPath p
+     CROSS JOIN DBFile dbfl on dbfl.path_id = p.id
+     LEFT JOIN DBFolder pdbf on dbfl.folder_id = pdbf.id
+     LEFT JOIN DBPath pp on pdbf.path_id = pp.id
+WHERE p.path >= :subtree_start AND p.path < :subtree_end
+ORDER BY p.path;
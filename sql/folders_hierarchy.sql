@@ -0,0 +1,25 @@
+-- stored folders of the subtree ordered by the full name;
+-- names are materialized paths kept in DBPath, so the subtree is a range lookup on the path index,
+-- which also returns the rows in order without a sort; CROSS JOIN keeps DBPath as the outer loop
+-- the parent is left joined: the content of a folder deleted by a committed stream batch is still read by the retry
+-- the subtree root itself is excluded
+SELECT
+    dbf.id,
+    p.path AS name,
+    1 AS is_dir,
+    dbf.parent_id,
+    pp.path AS parent_name,
+    dbf.create_date,
+    dbf.modify_date,
+    dbf.child_count,
+    NULL AS size,
+    dbf.inode,
+    dbf.device,
+    NULL AS content_hash,
+    dbf.depth AS level
+FROM DBPath p
+     CROSS JOIN DBFolder dbf on dbf.path_id = p.id
+     LEFT JOIN DBFolder pdbf on dbf.parent_id = pdbf.id
+     LEFT JOIN DBPath pp on pdbf.path_id = pp.id
+WHERE p.path >= :subtree_start AND p.path < :subtree_end
+ORDER BY p.path;
@@ -0,0 +1,46 @@
+import sqlite3
+
+import pytest
+
+from custom_operator.database_initialization import configure_database, LOCAL_SQLITE_URL
+from custom_operator.db_init import model_creation, bulk_initial_load
+from helpers import tree_create
+
+
+@pytest.fixture
+def database(tmp_path):
+    """
+    Empty database of the model in the temporary folder
+    :return: full name of the database file
+    """
+    db_file = str(tmp_path / "local_database.db")
+    configure_database(url=f"sqlite:///{db_file}")
+    model_creation()
+    yield db_file
+    configure_database(url=LOCAL_SQLITE_URL)
+
+
+@pytest.fixture
+def root(tmp_path):
+    root_folder = tmp_path / "root_folder"
+    root_folder.mkdir()
+    return str(root_folder)
+
+
+@pytest.fixture
+def db(database):
+    connection = sqlite3.connect(database)
+    yield connection
+    connection.close()
+
+
+@pytest.fixture
+def loaded(database, root):
+    """
+    Tree of a few folders and files loaded by the bulk initial load
+    :return: full name of the root folder
+    """
+    tree_create(root, {"report.txt": "quarterly", "a/f1": "f1", "a/b/f2": "f2", "a/b/c/f3": "f3",
+                       "a/b/c/f4": "f4", "d/f5": "f5"})
+    bulk_initial_load(root_folder=root)
+    return root
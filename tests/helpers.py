@@ -0,0 +1,96 @@
+import os
+from datetime import datetime
+
+from custom_operator.pipeline import pipelined_changes_apply
+from custom_operator.structure_monitoring import struct_changes_discovery, struct_changes_stream, changes_apply
+
+
+def tree_create(root, files):
+    """
+    Create the files (with their folders) below the root
+    :param root: full name of the root folder
+    :param files: dictionary of the relative file name to its content
+    :return: None
+    """
+    for name, content in files.items():
+        full_name = os.path.join(root, name)
+        os.makedirs(os.path.dirname(full_name), exist_ok=True)
+        with open(full_name, "w") as f:
+            f.write(content)
+
+
+def monitoring_run(root, **kwargs):
+    """
+    Discover and apply the changes of the tree in one change set
+    :return: tuple of the discovered added, modified and deleted entries DataFrames
+    """
+    frames = struct_changes_discovery(root_folder=root, **kwargs)
+    changes_apply(*frames, datetime.now())
+    return frames
+
+
+def stored_names(db):
+    return {name for name, in db.execute("SELECT p.path FROM DBFolder f JOIN DBPath p ON p.id = f.path_id UNION ALL "
+                                         "SELECT p.path FROM DBFile f JOIN DBPath p ON p.id = f.path_id")}
+
+
+def folder_id(db, name):
+    folder, = db.execute("SELECT f.id FROM DBFolder f JOIN DBPath p ON p.id = f.path_id WHERE p.path = ?",
+                         (name,)).fetchone()
+    return folder
+
+
+def folder_name(db, folder):
+    name, = db.execute("SELECT p.path FROM DBFolder f JOIN DBPath p ON p.id = f.path_id WHERE f.id = ?",
+                       (folder,)).fetchone()
+    return name
+
+
+def tree_names(root):
+    names = set()
+    for folder, folder_names, file_names in os.walk(root):
+        names.add(folder)
+        names.update(os.path.join(folder, file_name) for file_name in file_names)
+    return names
+
+
+def orphan_files(db):
+    return db.execute("SELECT f.id FROM DBFile f LEFT JOIN DBFolder p ON p.id = f.folder_id "
+                      "WHERE p.id IS NULL").fetchall()
+
+
+def stream_monitoring_run(root, batch_size, pipelined=False):
+    """
+    Discover and apply the changes of the tree as a stream, one change set per batch
+    :param pipelined: apply the batches through the pipeline, one after another otherwise
+    :return: amount of the batches
+    """
+    cur_date = datetime.now()
+    if pipelined:
+        return pipelined_changes_apply(struct_changes_stream(batch_size, root), cur_date)
+    batch_count = 0
+    for added_frame, modified_frame, deleted_frame, last_name in struct_changes_stream(batch_size, root):
+        changes_apply(added_frame, modified_frame, deleted_frame, cur_date)
+        batch_count += 1
+    return batch_count
+
+
+def db_state(db, known_ids):
+    """
+    State of the stored tree and of the versions independent of the generated ids and of the run dates
+    :param known_ids: ids stored before the compared runs, the other ids are replaced by "new"
+    :return: tuple of the sorted entry and version rows
+    """
+    def stable_id(entry_id):
+        return entry_id if entry_id in known_ids else "new"
+
+    entries = db.execute("SELECT f.id, p.path, pp.path, NULL, f.modify_date, f.child_count FROM DBFolder f "
+                         "JOIN DBPath p ON p.id = f.path_id LEFT JOIN DBFolder pf ON pf.id = f.parent_id "
+                         "LEFT JOIN DBPath pp ON pp.id = pf.path_id UNION ALL "
+                         "SELECT f.id, p.path, pp.path, f.size, f.modify_date, NULL FROM DBFile f "
+                         "JOIN DBPath p ON p.id = f.path_id JOIN DBFolder pf ON pf.id = f.folder_id "
+                         "JOIN DBPath pp ON pp.id = pf.path_id").fetchall()
+    versions = db.execute("SELECT v.file_id, p.path, v.op_type, v.version, v.is_active FROM DBFileVersion v "
+                          "JOIN DBPath p ON p.id = v.path_id").fetchall()
+    return (sorted((stable_id(entry_id),) + tuple(columns) for entry_id, *columns in entries),
+            sorted((stable_id(file_id),) + tuple(columns) for file_id, *columns in versions))
@@ -0,0 +1,50 @@
+import pytest
+
+from custom_operator import db_init
+from custom_operator.db_init import bulk_initial_load, initial_load_pending
+from helpers import tree_create, stored_names, tree_names, orphan_files, monitoring_run
+
+FILES = {f"{folder}/f{index}": str(index) for folder in ["a", "a/b", "c"] for index in range(3)}
+
+
+def load_checkpoint(db):
+    return db.execute("SELECT last_name, chunk_count, entry_count, finished FROM DBLoadCheckpoint").fetchone()
+
+
+def test_load_in_chunks(database, db, root):
+    tree_create(root, FILES)
+    # the root, 3 folders and 9 files
+    assert bulk_initial_load(root_folder=root, chunk_size=4) == 13
+    assert stored_names(db) == tree_names(root)
+    assert load_checkpoint(db)[1:] == (4, 13, 1)
+    # every entry gets its first version
+    assert db.execute("SELECT count(*) FROM DBFileVersion WHERE op_type = 'i' AND is_active = 1").fetchone() == (13,)
+    assert bulk_initial_load(root_folder=root, chunk_size=4) == 0
+
+
+def test_interrupted_load_resumes_after_checkpoint(database, db, root, monkeypatch):
+    tree_create(root, FILES)
+    original, calls = db_init.load_chunk_commit, []
+
+    def failing(*args, **kwargs):
+        calls.append(None)
+        if len(calls) == 3:
+            raise RuntimeError("crash")
+        return original(*args, **kwargs)
+    monkeypatch.setattr(db_init, "load_chunk_commit", failing)
+    with pytest.raises(RuntimeError):
+        bulk_initial_load(root_folder=root, chunk_size=4)
+    monkeypatch.undo()
+    last_name, chunk_count, entry_count, finished = load_checkpoint(db)
+    assert (chunk_count, entry_count, finished) == (2, 8, 0)
+    assert initial_load_pending(root)
+    assert len(stored_names(db)) == 8 and max(stored_names(db)) == last_name
+
+    # the retry loads only the entries after the checkpoint (the total is returned),
+    # their parents come from the stored folders
+    assert bulk_initial_load(root_folder=root, chunk_size=4) == 13
+    assert not initial_load_pending(root)
+    assert stored_names(db) == tree_names(root)
+    assert orphan_files(db) == []
+    assert db.execute("SELECT count(*) FROM DBFileVersion").fetchone() == (13,)
+    assert all(frame.empty for frame in monitoring_run(root))
@@ -0,0 +1,95 @@
+import os
+from datetime import datetime, timedelta
+
+import pytest
+
+from custom_operator.change_journal import coalesce_event, journal_scopes, journal_append, journal_changes, \
+    journal_commit, journal_catch_up, IN_CREATE, IN_DELETE, IN_MODIFY, IN_MOVED_FROM, IN_MOVED_TO, IN_ISDIR
+from helpers import tree_create, stored_names, tree_names, orphan_files, folder_id, monitoring_run
+
+ROOT = "/r"
+
+
+def test_coalesce_event():
+    pending = {}
+    coalesce_event(pending, "/r/a/f1", IN_MODIFY)
+    coalesce_event(pending, "/r/a/f2", IN_CREATE)
+    coalesce_event(pending, "/r/g", IN_CREATE | IN_ISDIR)
+    # the entry event doesn't downgrade the subtree one
+    coalesce_event(pending, "/r/g", IN_MODIFY)
+    assert pending == {"/r/a/f1": "entry", "/r/a/f2": "entry", "/r/a": "entry", "/r/g": "subtree", "/r": "entry"}
+    coalesce_event(pending, None, 0)
+    assert pending[None] == "overflow"
+
+
+def test_journal_scopes():
+    changes = {"/r/a/f1": "entry", "/r/a": "entry", "/r/g": "subtree", "/r/g/h": "subtree", "/r/g/h/f": "entry",
+               "/r/a/b/f2": "entry", "/other/f": "entry", "/r": "entry"}
+    parent_dirs, subtree_roots = journal_scopes(changes, ROOT)
+    # the nested subtree and the directories inside the subtrees are left to the top subtree
+    assert subtree_roots == ["/r/g"]
+    assert parent_dirs == ["/r", "/r/a", "/r/a/b"]
+
+
+@pytest.fixture
+def journal(database):
+    """
+    Journal with the offset of the consumer and a running watcher, nothing is journaled after the offset
+    """
+    journal_append({}, datetime.now())
+    journal_changes()
+    journal_commit(0)
+
+
+def test_consumer_without_offset_needs_full_scan(database):
+    journal_append({"/r/a": "entry"}, datetime.now())
+    assert journal_changes() == (None, 1)
+
+
+def test_journal_changes_since_offset(journal):
+    journal_append({"/r/a": "entry", "/r/g": "subtree"}, datetime.now())
+    changes, journal_offset = journal_changes()
+    assert changes == {"/r/a": "entry", "/r/g": "subtree"}
+    journal_commit(journal_offset)
+    assert journal_changes() == ({}, journal_offset)
+
+
+@pytest.mark.parametrize("event_type", ["overflow", "gap"])
+def test_lost_events_need_full_scan(journal, event_type):
+    journal_append({"/r/a": "entry", None: event_type}, datetime.now())
+    assert journal_changes()[0] is None
+
+
+def test_stopped_watcher_needs_full_scan(journal):
+    journal_append({"/r/a": "entry"}, datetime.now() - timedelta(minutes=5))
+    assert journal_changes()[0] is None
+
+
+def journaled(root, events):
+    """
+    :param events: list of (relative name, inotify mask) tuples of the changes made to the tree
+    :return: dictionary of the journaled paths to their event type
+    """
+    pending = {}
+    for name, mask in events:
+        coalesce_event(pending, os.path.join(root, name), mask)
+    return pending
+
+
+def test_journal_catch_up(loaded, db):
+    b_id = folder_id(db, os.path.join(loaded, "a/b"))
+    with open(os.path.join(loaded, "a/f1"), "w") as f:
+        f.write("f1 changed")
+    os.remove(os.path.join(loaded, "d/f5"))
+    tree_create(loaded, {"g/h/f8": "f8"})
+    os.rename(os.path.join(loaded, "a/b"), os.path.join(loaded, "a/b2"))
+    changes = journaled(loaded, [("a/f1", IN_MODIFY), ("d/f5", IN_DELETE), ("g", IN_CREATE | IN_ISDIR),
+                                 ("a/b", IN_MOVED_FROM | IN_ISDIR), ("a/b2", IN_MOVED_TO | IN_ISDIR)])
+
+    journal_catch_up(changes, root_folder=loaded)
+    assert stored_names(db) == tree_names(loaded)
+    assert orphan_files(db) == []
+    # both names of the moved folder are compared in one change set, so the move keeps the folder
+    assert folder_id(db, os.path.join(loaded, "a/b2")) == b_id
+    # the journaled parts cover every change of the tree
+    assert all(frame.empty for frame in monitoring_run(loaded))
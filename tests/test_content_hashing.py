@@ -0,0 +1,76 @@
+import os
+
+import pytest
+
+from custom_operator.instrumentation import RunMetrics, collecting
+from custom_operator.version_queries import history
+from helpers import monitoring_run
+
+
+def hashed_run(root):
+    """
+    Monitoring run with the content hashes
+    :return: tuple of the modified entries DataFrame and the run counters
+    """
+    with collecting(RunMetrics("hash")) as metrics:
+        added_frame, modified_frame, deleted_frame = monitoring_run(root, content_hash=True)
+    return modified_frame, metrics.counters
+
+
+@pytest.fixture
+def hashed(loaded):
+    """
+    Loaded tree after the first run with the content hashes, which stores the hashes of all files
+    """
+    modified_frame, counters = hashed_run(loaded)
+    assert not modified_frame["content_changed"].any()
+    assert counters["files_hashed"] == 6
+    return loaded
+
+
+def stored_hash(db, name):
+    content_hash, = db.execute("SELECT f.content_hash FROM DBFile f JOIN DBPath p ON p.id = f.path_id "
+                               "WHERE p.path = ?", (name,)).fetchone()
+    return content_hash
+
+
+def test_first_run_stores_hashes_without_versions(hashed, db):
+    assert db.execute("SELECT count(*) FROM DBFile WHERE content_hash IS NULL").fetchone() == (0,)
+    assert list(history(os.path.join(hashed, "a/f1"))["op_type"]) == ["i"]
+
+
+def test_unchanged_tree_reads_hashes_from_cache(hashed):
+    modified_frame, counters = hashed_run(hashed)
+    assert modified_frame.empty
+    assert counters["hashes_cached"] == 6 and counters["files_hashed"] == 0
+
+
+def test_same_size_rewrite_with_kept_mtime(hashed, db):
+    name = os.path.join(hashed, "a/b/f2")
+    stat = os.stat(name)
+    hash_before = stored_hash(db, name)
+    with open(name, "w") as f:
+        f.write("x2")
+    os.utime(name, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    assert os.stat(name).st_size == stat.st_size and os.stat(name).st_mtime_ns == stat.st_mtime_ns
+
+    modified_frame, counters = hashed_run(hashed)
+    # the change time is part of the signature, so only the rewritten file is hashed again
+    assert counters["files_hashed"] == 1
+    assert list(modified_frame["name"]) == [name] and modified_frame["content_changed"].all()
+    assert stored_hash(db, name) != hash_before
+    assert list(history(name)["op_type"]) == ["i", "m"]
+
+
+def test_touch_refreshes_stat_without_version(hashed, db):
+    name = os.path.join(hashed, "d/f5")
+    hash_before = stored_hash(db, name)
+    stat = os.stat(name)
+    os.utime(name, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+
+    modified_frame, counters = hashed_run(hashed)
+    assert list(modified_frame["name"]) == [name] and not modified_frame["content_changed"].any()
+    assert stored_hash(db, name) == hash_before
+    assert list(history(name)["op_type"]) == ["i"]
+    # the next run finds nothing to change
+    assert hashed_run(hashed)[0].empty
@@ -0,0 +1,69 @@
+import time
+
+import pytest
+
+from custom_operator.exclusion_rules import ExclusionRules, glob_regex
+
+ROOT = "/r"
+
+
+@pytest.mark.parametrize("pattern, target, matched", [
+    ("*.log", "app.log", True),
+    ("*.log", "logs/app.log", False),
+    ("f?o", "foo", True),
+    ("f?o", "f/o", False),
+    ("**/cache", "cache", True),
+    ("**/cache", "a/b/cache", True),
+    ("a/**", "a/b/c", True),
+    ("[ab]c", "bc", True),
+    ("[!a]c", "ac", False),
+    ("[!a]c", "bc", True),
+    ("a.b", "axb", False),
+    ("a+b", "a+b", True),
+])
+def test_glob_regex(pattern, target, matched):
+    assert bool(glob_regex(pattern).match(target)) == matched
+
+
+@pytest.mark.parametrize("patterns, abs_item, is_dir, excluded", [
+    # a plain name matches at any level
+    (["venv"], "/r/venv", True, True),
+    (["venv"], "/r/a/venv", False, True),
+    (["venv"], "/r/venv2", True, False),
+    # a trailing "/" matches only directories
+    (["venv/"], "/r/a/venv", True, True),
+    (["venv/"], "/r/a/venv", False, False),
+    # a leading or inner "/" anchors the pattern to the root
+    (["/build"], "/r/build", True, True),
+    (["/build"], "/r/src/build", True, False),
+    (["docs/*.md"], "/r/docs/a.md", False, True),
+    (["docs/*.md"], "/r/x/docs/a.md", False, False),
+    (["/build"], "/other/build", True, False),
+    (["**/cache"], "/r/a/b/cache", True, True),
+    # the last matching rule wins
+    (["*.tmp", "!keep.tmp"], "/r/a/keep.tmp", False, False),
+    (["*.tmp", "!keep.tmp"], "/r/a/drop.tmp", False, True),
+    (["!keep.tmp", "*.tmp"], "/r/a/keep.tmp", False, True),
+    (["*", "!*.py"], "/r/a.py", False, False),
+    (["*", "!*.py"], "/r/a.txt", False, True),
+    # comments and empty lines are skipped
+    (["# venv", "", "  "], "/r/# venv", True, False),
+    ([], "/r/anything", True, False),
+])
+def test_name_excluded(patterns, abs_item, is_dir, excluded):
+    rules = ExclusionRules(patterns, root=ROOT)
+    assert rules.name_excluded(abs_item, abs_item.rsplit("/", 1)[1], is_dir) == excluded
+
+
+@pytest.mark.parametrize("max_size, max_age, size, age, excluded", [
+    (10, None, 11, 0, True),
+    (10, None, 10, 0, False),
+    (10, None, None, 0, False),
+    (None, 60, 5, 120, True),
+    (None, 60, 5, 30, False),
+    (10, 60, 5, 30, False),
+    (None, None, 10 ** 9, 10 ** 6, False),
+])
+def test_file_excluded(max_size, max_age, size, age, excluded):
+    rules = ExclusionRules([], max_size=max_size, max_age=max_age, root=ROOT)
+    assert rules.file_excluded(size, time.time() - age) == excluded
@@ -0,0 +1,22 @@
+import os
+import shutil
+
+from custom_operator.filesystem_parser import scan_dir, scan_struct_sorted
+from helpers import tree_create
+
+
+def test_scan_dir_of_removed_directory(root):
+    tree_create(root, {"f": "f"})
+    assert scan_dir(os.path.join(root, "gone")) == ([], [], 0)
+    assert scan_dir(os.path.join(root, "f")) == ([], [], 0)
+
+
+def test_sorted_scan_survives_directory_removed_during_scan(root):
+    tree_create(root, {"a/b/f1": "f1", "a/f2": "f2", "z/f3": "f3"})
+    records = scan_struct_sorted(root)
+    root_record = next(records)
+    assert root_record["ChildCount"] == 2
+    # a is listed by the root, then removed before its own listing
+    shutil.rmtree(os.path.join(root, "a"))
+    names = [record["FileName"] for record in records]
+    assert names == [os.path.join(root, "a"), os.path.join(root, "z"), os.path.join(root, "z/f3")]
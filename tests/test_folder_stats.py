@@ -0,0 +1,37 @@
+import os
+
+from custom_operator.db_init import model_upgrade
+from custom_operator.folder_stats import folder_stats
+from helpers import tree_names
+
+
+def rollups_drop(db):
+    # database upgraded from the model without the sizes and the rollups
+    db.execute("UPDATE DBFile SET size = NULL")
+    db.execute("DELETE FROM DBFolderStats")
+    db.commit()
+
+
+def test_upgrade_fills_sizes_before_rebuild(loaded, db):
+    rollups_drop(db)
+    model_upgrade()
+
+    file_names = [name for name in tree_names(loaded) if os.path.isfile(name)]
+    stats = folder_stats(loaded)
+    assert stats["file_count"] == len(file_names)
+    assert stats["total_size"] == sum(os.stat(name).st_size for name in file_names)
+    assert db.execute("SELECT count(*) FROM DBFile WHERE size IS NULL").fetchone() == (0,)
+
+
+def test_upgrade_keeps_gone_file_without_size(loaded, db):
+    rollups_drop(db)
+    gone_size = os.stat(os.path.join(loaded, "report.txt")).st_size
+    os.remove(os.path.join(loaded, "report.txt"))
+    model_upgrade()
+
+    file_names = [name for name in tree_names(loaded) if os.path.isfile(name)]
+    stats = folder_stats(loaded)
+    assert stats["file_count"] == len(file_names) + 1
+    assert stats["total_size"] == sum(os.stat(name).st_size for name in file_names)
+    assert gone_size > 0
+    assert db.execute("SELECT count(*) FROM DBFile WHERE size IS NULL").fetchone() == (1,)
@@ -0,0 +1,15 @@
+from custom_operator.database_initialization import get_engine
+from custom_operator.structure_monitoring import hierarchy_queries, hierarchy_params, db_struct_stream
+from helpers import tree_names
+
+
+def test_queries_are_not_sorted_in_database(loaded):
+    with get_engine().connect() as conn:
+        for query in hierarchy_queries():
+            plan = conn.exec_driver_sql(f"EXPLAIN QUERY PLAN {query.text}", hierarchy_params(loaded)).all()
+            assert not [row for row in plan if "TEMP B-TREE" in row[-1]]
+
+
+def test_stream_is_ordered_by_name(loaded):
+    names = [db_row["name"] for db_row in db_struct_stream(2, loaded)]
+    assert names == sorted(tree_names(loaded) - {loaded})
@@ -0,0 +1,110 @@
+import os
+import sqlite3
+from datetime import datetime
+
+import pytest
+
+from custom_operator.database_initialization import configure_database, LOCAL_SQLITE_URL
+from custom_operator.db_init import model_upgrade, model_creation
+from custom_operator.filesystem_parser import path_depth
+from custom_operator.folder_stats import folder_stats
+from custom_operator.version_queries import history
+from helpers import tree_create, monitoring_run, stored_names, tree_names
+
+
+def index_names(db, table_name):
+    return {name for _, name, *columns in db.execute(f'PRAGMA index_list("{table_name}")')}
+
+
+def test_path_id_indexes_are_replaced_by_unique_ones(loaded, db):
+    for table_name in ["DBFile", "DBFolder"]:
+        db.execute(f'DROP INDEX "ux_{table_name}_path_id"')
+        db.execute(f'CREATE INDEX "ix_{table_name}_path_id" ON "{table_name}" (path_id)')
+    db.commit()
+
+    model_upgrade()
+    for table_name in ["DBFile", "DBFolder"]:
+        assert f"ux_{table_name}_path_id" in index_names(db, table_name)
+        assert f"ix_{table_name}_path_id" not in index_names(db, table_name)
+    path_id, = db.execute("SELECT path_id FROM DBFile LIMIT 1").fetchone()
+    with pytest.raises(sqlite3.IntegrityError):
+        db.execute("UPDATE DBFile SET path_id = ?", (path_id,))
+
+
+# schema of the database created before the model was upgraded
+BASELINE_SCHEMA = """
+CREATE TABLE "DBFolder" (id VARCHAR NOT NULL, foldername VARCHAR NOT NULL, description VARCHAR,
+    parent_id VARCHAR, create_date TIMESTAMP NOT NULL, modify_date TIMESTAMP, PRIMARY KEY (id),
+    FOREIGN KEY(parent_id) REFERENCES "DBFolder" (id));
+CREATE TABLE "DBFile" (id VARCHAR NOT NULL, filename VARCHAR NOT NULL, description VARCHAR,
+    folder_id VARCHAR NOT NULL, create_date TIMESTAMP NOT NULL, modify_date TIMESTAMP, PRIMARY KEY (id),
+    FOREIGN KEY(folder_id) REFERENCES "DBFolder" (id));
+CREATE TABLE "DBFileVersion" (id INTEGER NOT NULL, file_id VARCHAR NOT NULL, filename VARCHAR NOT NULL,
+    description VARCHAR, folder_id VARCHAR, create_date TIMESTAMP NOT NULL, modify_date TIMESTAMP NOT NULL,
+    is_active BOOLEAN NOT NULL, op_type CHAR NOT NULL, version INTEGER NOT NULL, version_start TIMESTAMP NOT NULL,
+    version_end TIMESTAMP NOT NULL, PRIMARY KEY (id));
+"""
+
+
+def stat_date(name):
+    return str(datetime.fromtimestamp(os.stat(name).st_mtime))
+
+
+@pytest.fixture
+def baseline(tmp_path, root):
+    """
+    Database of the baseline schema holding the loaded tree
+    :return: tuple of the root folder and the sqlite3 connection
+    """
+    tree_create(root, {"report.txt": "quarterly", "a/f1": "f1", "a/b/f2": "f2"})
+    db_file = str(tmp_path / "baseline.db")
+    connection = sqlite3.connect(db_file)
+    connection.executescript(BASELINE_SCHEMA)
+    folders = {root: None, os.path.join(root, "a"): root, os.path.join(root, "a/b"): os.path.join(root, "a")}
+    connection.executemany("INSERT INTO DBFolder VALUES (?, ?, NULL, ?, ?, ?)",
+                           [(name, name, parent, stat_date(name), stat_date(name)) for name, parent in folders.items()])
+    for file_name in ["report.txt", "a/f1", "a/b/f2"]:
+        name = os.path.join(root, file_name)
+        connection.execute("INSERT INTO DBFile VALUES (?, ?, NULL, ?, ?, ?)",
+                           (name, name, os.path.dirname(name), stat_date(name), stat_date(name)))
+        connection.execute("INSERT INTO DBFileVersion (file_id, filename, folder_id, create_date, modify_date, "
+                           "is_active, op_type, version, version_start, version_end) "
+                           "VALUES (?, ?, ?, ?, ?, 1, 'i', 1, ?, '9999-12-31 23:59:59.999999')",
+                           (name, name, os.path.dirname(name), stat_date(name), stat_date(name), str(datetime.now())))
+    connection.commit()
+    configure_database(url=f"sqlite:///{db_file}")
+    yield root, connection
+    connection.close()
+    configure_database(url=LOCAL_SQLITE_URL)
+
+
+def column_names(db, table_name):
+    return {name for _, name, *columns in db.execute(f'PRAGMA table_info("{table_name}")')}
+
+
+def test_baseline_database_upgrade(baseline):
+    root, db = baseline
+    model_creation()
+
+    assert "foldername" not in column_names(db, "DBFolder") and "filename" not in column_names(db, "DBFile")
+    assert "filename" not in column_names(db, "DBFileVersion")
+    assert stored_names(db) == tree_names(root)
+    assert db.execute("SELECT p.path, v.version FROM DBFileVersion v JOIN DBPath p ON p.id = v.path_id "
+                      "WHERE p.path = ?", (os.path.join(root, "a/f1"),)).fetchall() == [(os.path.join(root, "a/f1"), 1)]
+    assert db.execute("SELECT depth, child_count FROM DBFolder WHERE id = ?", (os.path.join(root, "a"),)).fetchone() \
+        == (path_depth(os.path.join(root, "a")), 2)
+    for table_name in ["DBFile", "DBFolder"]:
+        assert f"ux_{table_name}_path_id" in index_names(db, table_name)
+    # the rollups are rebuilt with the sizes read from the files
+    root_stats = folder_stats(root)
+    assert (root_stats["file_count"], root_stats["total_size"]) == (3, len("quarterly") + len("f1") + len("f2"))
+    # an up-to-date database is left as it is
+    model_creation()
+    assert stored_names(db) == tree_names(root)
+
+    # the upgraded database is monitored as usual
+    assert all(frame.empty for frame in monitoring_run(root))
+    with open(os.path.join(root, "a/f1"), "w") as f:
+        f.write("f1 changed")
+    monitoring_run(root)
+    assert list(history(os.path.join(root, "a/f1"))["version"]) == [1, 2]
@@ -0,0 +1,103 @@
+import os
+from datetime import datetime, timedelta
+
+import pandas
+
+from custom_operator.structure_monitoring import moves_detection, struct_changes_discovery, changes_apply, \
+    DIFF_COLUMNS
+from custom_operator.version_queries import history
+from helpers import monitoring_run, stored_names, tree_names, folder_id, folder_name
+
+MODIFY_DATE = datetime(2024, 1, 1, 12, 0, 0)
+
+
+def added_frame(**columns):
+    row = {column: None for column in DIFF_COLUMNS}
+    row.update({"id_c": "new", "name_c": "/r/unrelated.bin", "is_dir_c": 0, "modify_date_c": MODIFY_DATE,
+                "size_c": 9, "inode_c": 42, "device_c": 1})
+    row.update(columns)
+    return pandas.DataFrame([row], columns=DIFF_COLUMNS)
+
+
+def deleted_frame(**columns):
+    row = {column: None for column in DIFF_COLUMNS}
+    row.update({"id": "old", "name": "/r/report.txt", "is_dir": 0, "modify_date": MODIFY_DATE,
+                "size": 9, "inode": 42, "device": 1})
+    row.update(columns)
+    return pandas.DataFrame([row], columns=DIFF_COLUMNS)
+
+
+def test_rename_is_paired():
+    added, moved, deleted = moves_detection(added_frame(), deleted_frame())
+    assert added.empty and deleted.empty
+    assert list(moved["id"]) == ["old"] and list(moved["name_c"]) == ["/r/unrelated.bin"]
+
+
+def test_reused_inode_with_new_mtime_is_not_paired():
+    added, moved, deleted = moves_detection(added_frame(modify_date_c=MODIFY_DATE + timedelta(seconds=5)),
+                                            deleted_frame())
+    assert moved.empty
+    assert list(added["id_c"]) == ["new"] and list(deleted["id"]) == ["old"]
+
+
+def test_different_content_hash_is_not_paired():
+    added, moved, deleted = moves_detection(added_frame(content_hash_c="aaa"), deleted_frame(content_hash="bbb"))
+    assert moved.empty
+
+
+def test_reused_folder_inode_is_not_paired():
+    added, moved, deleted = moves_detection(
+        added_frame(is_dir_c=1, size_c=None, modify_date_c=MODIFY_DATE + timedelta(seconds=5)),
+        deleted_frame(is_dir=1, size=None))
+    assert moved.empty
+
+
+def test_delete_then_create_with_reused_inode(loaded, db):
+    report = os.path.join(loaded, "report.txt")
+    report_stat = os.stat(report)
+    os.remove(report)
+    unrelated = os.path.join(loaded, "unrelated.bin")
+    with open(unrelated, "w") as f:
+        f.write("x" * report_stat.st_size)
+    os.utime(unrelated, (report_stat.st_atime + 5, report_stat.st_mtime + 5))
+
+    added, modified, deleted = struct_changes_discovery(root_folder=loaded)
+    # the filesystem reuses the inode of the deleted file for the new one
+    added = added.assign(inode_c=report_stat.st_ino, device_c=report_stat.st_dev)
+    changes_apply(added, modified, deleted, datetime.now())
+
+    report_ops = db.execute("SELECT v.op_type FROM DBFileVersion v JOIN DBPath p ON p.id = v.path_id "
+                            "WHERE p.path = ? ORDER BY v.id", (report,)).fetchall()
+    unrelated_ops = db.execute("SELECT v.op_type, v.file_id FROM DBFileVersion v JOIN DBPath p ON p.id = v.path_id "
+                               "WHERE p.path = ? ORDER BY v.id", (unrelated,)).fetchall()
+    assert [op for op, in report_ops] == ["i", "d"]
+    assert [op for op, file_id in unrelated_ops] == ["c"]
+    report_id, = db.execute("SELECT file_id FROM DBFileVersion v JOIN DBPath p ON p.id = v.path_id "
+                            "WHERE p.path = ? AND op_type = 'd'", (report,)).fetchone()
+    assert unrelated_ops[0][1] != report_id
+
+
+def test_moved_folder_keeps_ids(loaded, db):
+    b_id = folder_id(db, os.path.join(loaded, "a/b"))
+    os.rename(os.path.join(loaded, "a/b"), os.path.join(loaded, "d/b2"))
+    monitoring_run(loaded)
+
+    assert stored_names(db) == tree_names(loaded)
+    assert folder_name(db, b_id) == os.path.join(loaded, "d/b2")
+    # the folder, its subfolder and three files
+    assert db.execute("SELECT count(*) FROM DBFileVersion WHERE op_type = 'r'").fetchone() == (5,)
+    assert db.execute("SELECT count(*) FROM DBFileVersion WHERE op_type IN ('c', 'd')").fetchone() == (0,)
+
+
+def test_moved_file_continues_its_versions(loaded, db):
+    old_name, new_name = os.path.join(loaded, "a/f1"), os.path.join(loaded, "d/f1-moved")
+    with open(old_name, "w") as f:
+        f.write("f1 changed")
+    monitoring_run(loaded)
+    os.rename(old_name, new_name)
+    monitoring_run(loaded)
+
+    frame = history(new_name)
+    assert list(frame["op_type"]) == ["i", "m", "r"]
+    assert list(frame["version"]) == [1, 2, 3]
+    assert frame["file_id"].nunique() == 1
@@ -0,0 +1,135 @@
+import os
+from datetime import datetime, timedelta
+
+import pytest
+
+from custom_operator import structure_monitoring, pipeline
+from custom_operator.change_journal import journal_catch_up
+from custom_operator.pipeline import pipelined_changes_apply
+from custom_operator.run_ledger import run_checkpoint, run_load, stale_runs_cleanup
+from custom_operator.sharding import changes_stage, staged_changes_read
+from custom_operator.structure_monitoring import struct_changes_discovery, struct_changes_stream, changes_apply
+from helpers import tree_create, stored_names, tree_names, orphan_files, db_state
+
+RUN_KEY = "dag.task.run"
+
+
+def failing_at(monkeypatch, module, name, call_number):
+    """
+    Make the call_number-th call of the module function fail like a crashed worker
+    """
+    original = getattr(module, name)
+    calls = []
+
+    def failing(*args, **kwargs):
+        calls.append(None)
+        if len(calls) == call_number:
+            raise RuntimeError("crash")
+        return original(*args, **kwargs)
+    monkeypatch.setattr(module, name, failing)
+
+
+def tree_change(root):
+    with open(os.path.join(root, "a/f1"), "w") as f:
+        f.write("f1 changed")
+    os.remove(os.path.join(root, "d/f5"))
+    os.rename(os.path.join(root, "a/b"), os.path.join(root, "b"))
+    tree_create(root, {"e/f6": "f6", "b/c/f7": "f7"})
+
+
+def test_crashed_write_is_rolled_back_and_resumed(loaded, db, tmp_path, monkeypatch):
+    state_before = db_state(db, set())
+    tree_change(loaded)
+    cur_date = datetime.now()
+    staging_file = changes_stage(*struct_changes_discovery(root_folder=loaded), str(tmp_path / "runs"))
+    run_checkpoint(RUN_KEY, "discovered", cur_date, staging_file=staging_file)
+
+    # the deletes fail after the moves, the additions and the modifications are written
+    failing_at(monkeypatch, structure_monitoring, "rows_delete", 1)
+    with pytest.raises(RuntimeError):
+        changes_apply(*staged_changes_read(staging_file), cur_date, {"run_key": RUN_KEY, "status": "finished"})
+    monkeypatch.undo()
+    assert db_state(db, set()) == state_before
+    assert run_load(RUN_KEY).status == "discovered"
+
+    # the retry applies the staged change set
+    changes_apply(*staged_changes_read(staging_file), cur_date,
+                  {"run_key": RUN_KEY, "status": "finished", "staging_file": None})
+    run = run_load(RUN_KEY)
+    assert (run.status, run.staging_file) == ("finished", None)
+    assert stored_names(db) == tree_names(loaded)
+    assert orphan_files(db) == []
+
+
+def test_crashed_stream_resumes_after_last_batch(loaded, db, monkeypatch):
+    tree_change(loaded)
+    cur_date = datetime.now()
+    checkpoint = {"run_key": RUN_KEY, "status": "applying", "root_folder": loaded, "batch_count": 0}
+    run_checkpoint(cur_date=cur_date, **checkpoint)
+
+    failing_at(monkeypatch, pipeline, "changes_write", 2)
+    with pytest.raises(RuntimeError):
+        pipelined_changes_apply(struct_changes_stream(2, loaded), cur_date, checkpoint=checkpoint)
+    monkeypatch.undo()
+    run = run_load(RUN_KEY)
+    assert run.batch_count == 1 and run.last_name is not None
+
+    # the retry walks only the names after the committed batch
+    batch_count = pipelined_changes_apply(struct_changes_stream(2, loaded, run.last_name), cur_date,
+                                          checkpoint={**checkpoint, "batch_count": run.batch_count})
+    assert run_load(RUN_KEY).batch_count == 1 + batch_count
+    assert stored_names(db) == tree_names(loaded)
+    assert orphan_files(db) == []
+    assert sum(batch[0].shape[0] + batch[1].shape[0] + batch[2].shape[0]
+               for batch in struct_changes_stream(2, loaded)) == 0
+
+
+def test_journal_scopes_are_applied_in_one_transaction(loaded, db, monkeypatch):
+    state_before = db_state(db, set())
+    tree_create(loaded, {"g/h/f8": "f8", "a/f9": "f9"})
+    os.remove(os.path.join(loaded, "d/f5"))
+    changes = {os.path.join(loaded, "g"): "subtree", os.path.join(loaded, "a/f9"): "entry",
+               os.path.join(loaded, "d/f5"): "entry"}
+
+    failing_at(monkeypatch, structure_monitoring, "rows_delete", 1)
+    with pytest.raises(RuntimeError):
+        journal_catch_up(changes, root_folder=loaded, checkpoint={"run_key": RUN_KEY, "status": "finished"})
+    monkeypatch.undo()
+    assert db_state(db, set()) == state_before
+    assert run_load(RUN_KEY) is None
+
+    journal_catch_up(changes, root_folder=loaded, checkpoint={"run_key": RUN_KEY, "status": "finished"})
+    assert run_load(RUN_KEY).status == "finished"
+    # the content of the new subtree is attached to its root added by the directory scope
+    assert stored_names(db) == tree_names(loaded)
+    assert orphan_files(db) == []
+
+
+def staged_file(staging_folder, age):
+    staging_file = os.path.join(staging_folder, f"changes_{age.days}_{age.seconds}.pkl")
+    with open(staging_file, "w") as f:
+        f.write("staged")
+    file_time = (datetime.now() - age).timestamp()
+    os.utime(staging_file, (file_time, file_time))
+    return staging_file
+
+
+def test_stale_runs_cleanup(db, tmp_path):
+    staging_folder = str(tmp_path / "runs")
+    os.makedirs(staging_folder)
+    old, fresh = timedelta(days=3), timedelta(minutes=5)
+    finished_file, stale_file, fresh_file, orphan_old, orphan_fresh = \
+        [staged_file(staging_folder, age) for age in [fresh, old, fresh * 2, old + fresh, fresh * 3]]
+    run_checkpoint("finished", "finished", datetime.now(), staging_file=finished_file)
+    run_checkpoint("stale", "discovered", datetime.now(), staging_file=stale_file)
+    run_checkpoint("fresh", "discovered", datetime.now(), staging_file=fresh_file)
+    db.execute("UPDATE DBMonitoringRun SET update_date = ? WHERE run_key = 'stale'", (str(datetime.now() - old),))
+    db.commit()
+
+    # the files of the finished and the stale runs and the old file no run refers to
+    assert stale_runs_cleanup(staging_folder) == 3
+    assert sorted(os.listdir(staging_folder)) == sorted(os.path.basename(staging_file)
+                                                        for staging_file in [fresh_file, orphan_fresh])
+    assert run_load("finished").staging_file is None and run_load("stale").staging_file is None
+    assert run_load("fresh").staging_file == fresh_file
+    assert stale_runs_cleanup(staging_folder) == 0
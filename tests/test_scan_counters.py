@@ -0,0 +1,41 @@
+import os
+from datetime import datetime
+
+from custom_operator.instrumentation import RunMetrics, collecting
+from custom_operator.structure_monitoring import struct_changes_discovery, changes_apply
+from helpers import monitoring_run
+
+
+def scan_counters(root, **kwargs):
+    with collecting(RunMetrics("scan")) as metrics:
+        monitoring_run(root, **kwargs)
+    return metrics.counters
+
+
+def test_full_scan_lists_every_directory(loaded):
+    counters = scan_counters(loaded)
+    # the root, a, a/b, a/b/c and d
+    assert counters["directories_listed"] == 5
+    assert "directories_replayed" not in counters
+
+
+def test_incremental_scan_counts_replayed_directories(loaded):
+    os.remove(os.path.join(loaded, "a/b/c/f4"))
+    counters = scan_counters(loaded, scan_mode="incremental")
+    # the root (not compared, so its mtime isn't known) and the directory with the new mtime are listed
+    assert counters["directories_listed"] == 2
+    assert counters["directories_replayed"] == 3
+
+
+def test_write_counts_reach_metrics(loaded):
+    os.remove(os.path.join(loaded, "d/f5"))
+    os.remove(os.path.join(loaded, "a/b/c/f4"))
+    os.rename(os.path.join(loaded, "report.txt"), os.path.join(loaded, "report2.txt"))
+    with collecting(RunMetrics("write")) as metrics:
+        frames = struct_changes_discovery(root_folder=loaded)
+        write_counts = changes_apply(*frames, datetime.now())
+    assert write_counts["files_deleted"] == metrics.counters["files_deleted"] == 2
+    assert write_counts["folders_deleted"] == 0
+    assert write_counts["rows_updated"] >= 1
+    for counter in ["update_statements", "delete_statements"]:
+        assert metrics.counters[counter] == write_counts[counter] > 0
@@ -0,0 +1,108 @@
+import os
+import shutil
+from datetime import datetime
+
+import pytest
+
+from custom_operator import sharding
+from custom_operator.db_init import bulk_initial_load
+from custom_operator.run_ledger import run_load
+from custom_operator.sharding import shards_plan, subtrees_changes_discovery, changes_stage, staged_changes_apply
+from helpers import tree_create, monitoring_run, stored_names, tree_names, orphan_files
+
+RUN_KEY = "dag.merge.run"
+
+
+@pytest.fixture
+def sharded(database, root):
+    """
+    Loaded tree of the top level subtrees of different sizes, changed after the load
+    :return: full name of the root folder
+    """
+    tree_create(root, {**{f"big/f{index}": str(index) for index in range(20)},
+                       **{f"mid/m/f{index}": str(index) for index in range(4)},
+                       "small/f": "f", "tiny/f": "f", "top.txt": "top"})
+    bulk_initial_load(root_folder=root)
+    tree_create(root, {"new/n/f": "f", "top2.txt": "top", "mid/m/f9": "9"})
+    shutil.rmtree(os.path.join(root, "tiny"))
+    os.rename(os.path.join(root, "big/f0"), os.path.join(root, "small/f0"))
+    return root
+
+
+def shards_stage(root, staging_folder, shard_count=2):
+    """
+    Discover and stage the changes of every shard of the plan, like the mapped monitoring tasks
+    :return: list of the staging files in the plan order
+    """
+    return [changes_stage(*subtrees_changes_discovery(shard["subtree_roots"], max_depth=shard["max_depth"]),
+                          staging_folder)
+            for shard in shards_plan(root, shard_count)]
+
+
+def test_shards_plan(sharded):
+    plan = shards_plan(sharded, shard_count=2)
+    assert plan[0] == {"subtree_roots": [sharded], "max_depth": 1}
+    shard_roots = [shard["subtree_roots"] for shard in plan[1:]]
+    # the removed directory is still planned, its stored subtree is deleted by its shard
+    assert sorted(name for roots in shard_roots for name in roots) == \
+        sorted(os.path.join(sharded, name) for name in ["big", "mid", "new", "small", "tiny"])
+    # the heaviest subtree takes a shard of its own
+    assert [os.path.join(sharded, "big")] in shard_roots
+    assert all(shard["max_depth"] is None for shard in plan[1:])
+
+
+def test_more_shards_than_subtrees(sharded):
+    plan = shards_plan(sharded, shard_count=10)
+    assert len(plan) == 6 and all(len(shard["subtree_roots"]) == 1 for shard in plan)
+
+
+def test_staged_shards_are_merged(sharded, db, tmp_path):
+    staging_files = shards_stage(sharded, str(tmp_path / "staging"))
+    staged_changes_apply(staging_files, datetime.now())
+    assert stored_names(db) == tree_names(sharded)
+    assert orphan_files(db) == []
+    assert not any(os.path.exists(staging_file) for staging_file in staging_files)
+    # the merged state is the same as the one of a single run
+    assert all(frame.empty for frame in monitoring_run(sharded))
+
+
+def test_interrupted_merge_skips_committed_shards(sharded, db, tmp_path, monkeypatch):
+    staging_files = shards_stage(sharded, str(tmp_path / "staging"))
+    cur_date = datetime.now()
+    checkpoint = {"run_key": RUN_KEY, "status": "applying", "batch_count": 0}
+    original, calls = sharding.changes_apply, []
+
+    def failing(*args, **kwargs):
+        calls.append(None)
+        if len(calls) == 2:
+            raise RuntimeError("crash")
+        return original(*args, **kwargs)
+    monkeypatch.setattr(sharding, "changes_apply", failing)
+    with pytest.raises(RuntimeError):
+        staged_changes_apply(staging_files, cur_date, checkpoint)
+    monkeypatch.undo()
+    assert run_load(RUN_KEY).batch_count == 1
+    assert not os.path.exists(staging_files[0]) and os.path.exists(staging_files[1])
+
+    staged_changes_apply(staging_files, cur_date, {**checkpoint, "batch_count": run_load(RUN_KEY).batch_count})
+    assert run_load(RUN_KEY).batch_count == len(staging_files)
+    assert stored_names(db) == tree_names(sharded)
+    assert orphan_files(db) == []
+
+
+def test_merge_operator_resumes(sharded, db, tmp_path, monkeypatch):
+    merge_operator = pytest.importorskip("custom_operator.structure_changes_merge_operator")
+    staging_files = shards_stage(sharded, str(tmp_path / "staging"))
+    context = {"run_id": "run"}
+    monkeypatch.setattr(sharding, "changes_apply", None)
+    with pytest.raises(TypeError):
+        merge_operator.StructureChangesMergeOperator(task_id="merge", name="merge", staging_files=staging_files,
+                                                     metrics_folder=None).execute(context)
+    monkeypatch.undo()
+    assert run_load(".merge.run") is None
+
+    merge_operator.StructureChangesMergeOperator(task_id="merge", name="merge", staging_files=staging_files + [None],
+                                                 metrics_folder=None).execute(context)
+    run = run_load(".merge.run")
+    assert (run.status, run.batch_count) == ("finished", len(staging_files))
+    assert stored_names(db) == tree_names(sharded)
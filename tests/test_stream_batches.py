@@ -0,0 +1,65 @@
+import os
+import sqlite3
+
+import pytest
+
+from custom_operator.database_initialization import configure_database, dispose_engine, LOCAL_SQLITE_URL
+from custom_operator.db_init import bulk_initial_load, model_creation
+from helpers import tree_create, stream_monitoring_run, stored_names, tree_names, orphan_files, folder_id, \
+    folder_name, db_state
+
+
+@pytest.mark.parametrize("pipelined", [False, True])
+def test_renamed_parent_across_batches(database, db, root, pipelined):
+    tree_create(root, {f"p/f{index}": str(index) for index in range(6)})
+    tree_create(root, {"z/f": "f"})
+    bulk_initial_load(root_folder=root)
+    p_id = folder_id(db, os.path.join(root, "p"))
+
+    # the first batch pairs p and p-new as a move, most files of p-new come in the next batches
+    os.rename(os.path.join(root, "p"), os.path.join(root, "p-new"))
+    assert stream_monitoring_run(root, batch_size=4, pipelined=pipelined) > 1
+
+    assert orphan_files(db) == []
+    assert stored_names(db) == tree_names(root)
+    assert folder_name(db, p_id) == os.path.join(root, "p-new")
+    assert db.execute("SELECT count(*) FROM DBFile WHERE folder_id = ?", (p_id,)).fetchone() == (6,)
+    # the next run finds nothing to change
+    assert stream_monitoring_run(root, batch_size=4, pipelined=pipelined) == 0
+
+
+def test_pipelined_run_matches_sequential(tmp_path, root):
+    tree_create(root, {**{f"p/f{index}": str(index) for index in range(6)},
+                       "q/x": "x", "z/f": "f", "z/g/h": "h"})
+    sequential_db, pipelined_db = str(tmp_path / "sequential.db"), str(tmp_path / "pipelined.db")
+    try:
+        configure_database(url=f"sqlite:///{sequential_db}")
+        model_creation()
+        bulk_initial_load(root_folder=root)
+        dispose_engine()
+        with sqlite3.connect(sequential_db) as source, sqlite3.connect(pipelined_db) as target:
+            source.backup(target)
+
+        os.rename(os.path.join(root, "p"), os.path.join(root, "p-new"))
+        with open(os.path.join(root, "z/f"), "w") as f:
+            f.write("changed")
+        os.remove(os.path.join(root, "q/x"))
+        tree_create(root, {"n/new": "new", "p-new/f9": "9"})
+
+        states = []
+        for db_file, pipelined in [(sequential_db, False), (pipelined_db, True)]:
+            configure_database(url=f"sqlite:///{db_file}")
+            with sqlite3.connect(db_file) as db:
+                known_ids = {entry_id for entry_id, in
+                             db.execute("SELECT id FROM DBFolder UNION SELECT id FROM DBFile")}
+            assert stream_monitoring_run(root, batch_size=3, pipelined=pipelined) > 1
+            dispose_engine()
+            with sqlite3.connect(db_file) as db:
+                states.append(db_state(db, known_ids))
+    finally:
+        configure_database(url=LOCAL_SQLITE_URL)
+
+    sequential_state, pipelined_state = states
+    assert pipelined_state == sequential_state
+    entries, versions = sequential_state
+    assert {path for entry_id, path, *columns in entries} == tree_names(root)
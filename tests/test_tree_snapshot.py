@@ -0,0 +1,34 @@
+import os
+from uuid import uuid4
+
+from custom_operator.tree_snapshot import TreeSnapshot
+
+
+def entry_record(name, is_dir, position):
+    return {"FileName": name, "IsDirectory": is_dir, "CreateDate": 1.0 + position, "ModifyDate": 2.0 + position,
+            "Size": None if is_dir else position, "Inode": 100 + position, "Device": 1}
+
+
+def test_full_names_round_trip():
+    # an undecodable name comes from the walker as surrogate escapes
+    names = ["/r", "/r/a", "/r/a/f1", "/r/b", "/r/b/" + os.fsdecode(b"caf\xe9"), "/r/b/näme", "/r/a/f1.txt"]
+    records = [entry_record(name, name in ("/r", "/r/a", "/r/b"), position) for position, name in enumerate(names)]
+    snapshot = TreeSnapshot.from_records(records)
+    assert snapshot.full_names() == names
+    assert [snapshot.child_count[position] for position in (0, 1, 3)] == [2, 2, 2]
+
+
+def test_memory_size_of_unique_names():
+    records = [entry_record("/r", True, 0)]
+    folders = ["/r"]
+    for position in range(1, 20000):
+        name = f"{folders[position % len(folders)]}/{uuid4().hex[:12]}"
+        records.append(entry_record(name, position % 20 == 0, position))
+        if position % 20 == 0:
+            folders.append(name)
+    snapshot = TreeSnapshot.from_records(records)
+    memory_size = snapshot.memory_size()
+    assert memory_size / len(records) < 100
+    # the generated ids are held by the snapshot as well
+    snapshot.entry_id(1)
+    assert snapshot.memory_size() > memory_size
@@ -0,0 +1,110 @@
+import os
+from datetime import datetime
+
+import pytest
+
+from custom_operator import version_archive
+from custom_operator.version_archive import versions_compaction
+from custom_operator.version_queries import tree_as_of, history, changes_between
+from helpers import monitoring_run
+
+
+@pytest.fixture
+def compacted(loaded, tmp_path):
+    """
+    Loaded tree with a modified and a deleted file, their closed versions are moved to the archive
+    :return: tuple of the root folder, the archive folder, the time before the changes
+    and the tree as of that time read before the compaction
+    """
+    before_change = datetime.now()
+    with open(os.path.join(loaded, "a/f1"), "w") as f:
+        f.write("f1 changed")
+    os.remove(os.path.join(loaded, "d/f5"))
+    monitoring_run(loaded)
+    tree_before = tree_as_of(before_change)
+
+    archive_folder = str(tmp_path / "archive")
+    assert versions_compaction(retention_days=0, archive_folder=archive_folder) > 0
+    return loaded, archive_folder, before_change, tree_before
+
+
+def test_tree_as_of_reads_custom_archive_folder(compacted):
+    root, archive_folder, before_change, tree_before = compacted
+    frame = tree_as_of(before_change, archive_folder=archive_folder)
+    assert list(frame["filename"]) == list(tree_before["filename"])
+    assert list(frame["id"]) == list(tree_before["id"])
+
+
+def test_chunks_merge_archive_in_order(compacted):
+    root, archive_folder, before_change, tree_before = compacted
+    chunks = list(tree_as_of(before_change, chunk_size=2, archive_folder=archive_folder))
+    assert all(chunk.shape[0] <= 2 for chunk in chunks)
+    names = [name for chunk in chunks for name in chunk["filename"]]
+    # the archived versions of a/f1 and d/f5 are in their places, every folder precedes its content
+    assert names == sorted(names) == list(tree_before["filename"])
+
+
+def stored_versions(db, closed=True):
+    return db.execute("SELECT count(*) FROM DBFileVersion WHERE is_active = ?", (0 if closed else 1,)).fetchone()[0]
+
+
+def test_compaction_moves_closed_versions(compacted, db):
+    root, archive_folder, before_change, tree_before = compacted
+    assert stored_versions(db) == 0
+    # every name keeps its active version, the deleted file its deletion
+    assert stored_versions(db, closed=False) == len(tree_before)
+    partitions = os.listdir(archive_folder)
+    assert partitions == [f"version_end_month={datetime.now():%Y-%m}"]
+    # nothing is left to archive
+    assert versions_compaction(retention_days=0, archive_folder=archive_folder) == 0
+
+
+def test_compaction_keeps_versions_within_retention(loaded, db, tmp_path):
+    os.remove(os.path.join(loaded, "d/f5"))
+    monitoring_run(loaded)
+    closed = stored_versions(db)
+    assert versions_compaction(retention_days=1, archive_folder=str(tmp_path / "archive")) == 0
+    assert stored_versions(db) == closed > 0
+    assert not os.path.exists(tmp_path / "archive")
+
+
+def test_history_across_archive(compacted):
+    root, archive_folder, before_change, tree_before = compacted
+    frame = history(os.path.join(root, "a/f1"), archive_folder=archive_folder)
+    assert list(frame["op_type"]) == ["i", "m"]
+    assert list(frame["version"]) == [1, 2]
+    # the archived version is the only one left without the archive
+    assert list(history(os.path.join(root, "a/f1"), archive_folder=archive_folder + "-missing")["op_type"]) == ["m"]
+
+
+def test_changes_between_across_archive(compacted):
+    root, archive_folder, before_change, tree_before = compacted
+    frame = changes_between(datetime(2000, 1, 1), datetime.now(), subtree=os.path.join(root, "d"),
+                            archive_folder=archive_folder)
+    assert list(zip(frame["filename"], frame["op_type"])) == [
+        (os.path.join(root, "d"), "i"), (os.path.join(root, "d/f5"), "i"),
+        (os.path.join(root, "d"), "m"), (os.path.join(root, "d/f5"), "d")]
+
+
+def test_interrupted_compaction_is_rerun(loaded, db, tmp_path, monkeypatch):
+    before_change = datetime.now()
+    os.remove(os.path.join(loaded, "d/f5"))
+    monitoring_run(loaded)
+    tree_before = tree_as_of(before_change)
+    archive_folder = str(tmp_path / "archive")
+
+    def failing_delete(*args, **kwargs):
+        raise RuntimeError("interrupted")
+    # the archive file is written, the stored rows are not deleted
+    monkeypatch.setattr(version_archive, "delete", failing_delete)
+    with pytest.raises(RuntimeError):
+        versions_compaction(retention_days=0, archive_folder=archive_folder)
+    monkeypatch.undo()
+    closed = stored_versions(db)
+    assert closed > 0
+    # the rows present in both places are read once
+    assert list(tree_as_of(before_change, archive_folder=archive_folder)["id"]) == list(tree_before["id"])
+
+    assert versions_compaction(retention_days=0, archive_folder=archive_folder) == closed
+    assert stored_versions(db) == 0
+    assert list(tree_as_of(before_change, archive_folder=archive_folder)["id"]) == list(tree_before["id"])
@@ -0,0 +1,63 @@
+import os
+from datetime import datetime
+
+import pandas
+import pytest
+
+from custom_operator.version_queries import tree_as_of, history, changes_between
+from helpers import monitoring_run, tree_names
+
+
+@pytest.fixture
+def changed(loaded):
+    """
+    Loaded tree after one monitoring run which modified, deleted and renamed a file
+    :return: tuple of the root folder, the names before the run, the time between the load and the run
+    """
+    names_before = tree_names(loaded)
+    before_run = datetime.now()
+    with open(os.path.join(loaded, "a/f1"), "w") as f:
+        f.write("f1 changed")
+    os.remove(os.path.join(loaded, "d/f5"))
+    os.rename(os.path.join(loaded, "report.txt"), os.path.join(loaded, "report2.txt"))
+    monitoring_run(loaded)
+    return loaded, names_before, before_run
+
+
+def test_tree_as_of(changed):
+    root, names_before, before_run = changed
+    assert set(tree_as_of(before_run)["filename"]) == names_before
+    assert set(tree_as_of(datetime.now())["filename"]) == tree_names(root)
+
+
+def test_tree_as_of_subtree_is_ordered(changed):
+    root, names_before, before_run = changed
+    subtree = os.path.join(root, "a")
+    frame = tree_as_of(before_run, subtree=subtree)
+    assert list(frame["filename"]) == sorted(name for name in names_before
+                                             if name == subtree or name.startswith(subtree + "/"))
+
+
+def test_tree_as_of_chunks(changed):
+    root, names_before, before_run = changed
+    chunks = list(tree_as_of(before_run, chunk_size=2))
+    assert all(chunk.shape[0] <= 2 for chunk in chunks)
+    assert list(pandas.concat(chunks)["filename"]) == list(tree_as_of(before_run)["filename"])
+
+
+def test_history_follows_rename(changed):
+    root, names_before, before_run = changed
+    frame = history(os.path.join(root, "report2.txt"))
+    assert list(frame["op_type"]) == ["i", "r"]
+    assert list(frame["filename"]) == [os.path.join(root, "report.txt"), os.path.join(root, "report2.txt")]
+    assert frame["file_id"].nunique() == 1
+
+
+def test_changes_between(changed):
+    root, names_before, before_run = changed
+    frame = changes_between(before_run, datetime.now())
+    file_ops = {name: op_type for name, op_type in zip(frame["filename"], frame["op_type"])
+                if not os.path.isdir(name)}
+    assert file_ops == {os.path.join(root, "a/f1"): "m", os.path.join(root, "d/f5"): "d",
+                        os.path.join(root, "report2.txt"): "r"}
+    assert changes_between(datetime.now(), datetime.now()).empty